@@ -38,7 +38,7 @@ from girder_plugin_worker.utils import jobInfoSpec
 from girder_worker.app import app
 
 from .constants import FIELD_STATUS_CODE, PluginSettings, SettingDefault
-from .lib import update_citation
+from .lib import http_session, update_citation
 from .lib.events import (
     copy_versions_and_runs,
     cullIdleInstances,
@@ -49,7 +49,7 @@ from .lib.events import (
 )
 from .lib.metrics import _MetricsHandler, metricsLogger
 from .lib.orcid import ORCID
-from .lib.path_mapper import PathMapper
+from .lib.path_mapper import ContentAddressedPathMapper
 from .models.instance import Instance as InstanceModel
 from .models.lock import Lock as LockModel
 from .models.session import Session as SessionModel
@@ -356,12 +356,51 @@ def defaultVersionsDirsRoot():
         PluginSettings.GC_RUN_INTERVAL,
         PluginSettings.GC_COLLECT_START_FRACTION,
         PluginSettings.GC_COLLECT_END_FRACTION,
+        PluginSettings.GC_RECONCILE_INTERVAL,
+        PluginSettings.GC_TIME_BUDGET,
+        PluginSettings.CONTENT_ADDRESSED_STORAGE,
+        PluginSettings.DOWNLOAD_ACCEL_PREFIX,
+        PluginSettings.PREFETCH_BUDGET,
+        PluginSettings.TRANSFER_WORKERS,
+        PluginSettings.TRANSFER_SEGMENTS,
+        PluginSettings.TRANSFER_QUEUE,
+        PluginSettings.HTTP_POOL_CONNECTIONS,
+        PluginSettings.HTTP_POOL_MAXSIZE,
+        PluginSettings.HTTP_RETRIES,
+        PluginSettings.HTTP_BACKOFF_FACTOR,
+        PluginSettings.HTTP_CONNECT_TIMEOUT,
+        PluginSettings.HTTP_READ_TIMEOUT,
     }
 )
 def validateOtherSettings(event):
     pass
 
 
+@setting_utilities.validator(PluginSettings.GC_SORTING_SCHEME)
+def validateGCSortingScheme(doc):
+    from .lib.gc_sorting import SORTING_SCHEMES
+
+    if doc["value"] not in SORTING_SCHEMES:
+        raise ValidationException(
+            "GC sorting scheme must be one of %s." % ", ".join(sorted(SORTING_SCHEMES)),
+            "value",
+        )
+
+
+@setting_utilities.validator(PluginSettings.TRANSFER_BACKEND)
+def validateTransferBackend(doc):
+    if doc["value"] not in ("local", "celery"):
+        raise ValidationException('Transfer backend must be "local" or "celery".', "value")
+
+
+@setting_utilities.validator(PluginSettings.DOWNLOAD_OFFLOAD)
+def validateDownloadOffload(doc):
+    if doc["value"] not in ("", "x-accel-redirect", "x-sendfile"):
+        raise ValidationException(
+            'Download offload must be "", "x-accel-redirect" or "x-sendfile".', "value"
+        )
+
+
 @access.public(scope=TokenScope.DATA_READ)
 @loadmodel(model="folder", level=AccessType.READ)
 @describeRoute(
@@ -788,6 +827,23 @@ class WholeTalePlugin(GirderPlugin):
         SettingDefault.defaults[PluginSettings.GC_RUN_INTERVAL] = 10 * 60
         SettingDefault.defaults[PluginSettings.GC_COLLECT_START_FRACTION] = 0.5
         SettingDefault.defaults[PluginSettings.GC_COLLECT_END_FRACTION] = 0.5
+        SettingDefault.defaults[PluginSettings.GC_RECONCILE_INTERVAL] = 24 * 60 * 60
+        SettingDefault.defaults[PluginSettings.GC_SORTING_SCHEME] = "lru"
+        # seconds a single GC pass may spend deleting files; 0 for no limit
+        SettingDefault.defaults[PluginSettings.GC_TIME_BUDGET] = 5 * 60
+        SettingDefault.defaults[PluginSettings.CONTENT_ADDRESSED_STORAGE] = False
+        # bytes prefetched for a new session; 0 to only transfer locked items
+        SettingDefault.defaults[PluginSettings.PREFETCH_BUDGET] = 0
+        # "x-accel-redirect" (nginx) or "x-sendfile" hand cached files over to the
+        # front end server. For nginx, the prefix must be an internal location
+        # aliased to the private storage path.
+        SettingDefault.defaults[PluginSettings.DOWNLOAD_OFFLOAD] = ""
+        SettingDefault.defaults[PluginSettings.DOWNLOAD_ACCEL_PREFIX] = "/dm-private-storage/"
+        SettingDefault.defaults[PluginSettings.TRANSFER_WORKERS] = 8
+        SettingDefault.defaults[PluginSettings.TRANSFER_SEGMENTS] = 4
+        # "celery" runs transfers on girder_worker nodes; read at startup
+        SettingDefault.defaults[PluginSettings.TRANSFER_BACKEND] = "local"
+        SettingDefault.defaults[PluginSettings.TRANSFER_QUEUE] = "celery"
 
         getPlugin("oauth").load(info)
         OAuthSettings.ORCID_CLIENT_ID = "oauth.orcid_client_id"
@@ -833,33 +889,42 @@ class WholeTalePlugin(GirderPlugin):
         transfer = Transfer()
         fs = FS()
 
-        pathMapper = PathMapper()
-        from .lib.transfer_manager import SimpleTransferManager
+        # stores files once per content if dm.content_addressed_storage is on
+        pathMapper = ContentAddressedPathMapper()
+        if Setting().get(PluginSettings.TRANSFER_BACKEND) == "celery":
+            from .lib.celery_transfer import CeleryTransferManager
+
+            transferManager = CeleryTransferManager(pathMapper)
+            events.bind(
+                "jobs.job.update.after", "wholetale.dm", transferManager.jobUpdated
+            )
+        else:
+            from .lib.transfer_manager import SimpleTransferManager
 
-        transferManager = SimpleTransferManager(pathMapper)
+            transferManager = SimpleTransferManager(pathMapper)
+        lock.transferManager = transferManager
 
         # a GC that does nothing
         # fileGC = file_gc.DummyFileGC(pathMapper)
         from .lib.file_gc import (
             CollectionStrategy,
             FractionalCollectionThresholds,
-            LRUSortingScheme,
             PeriodicFileGC,
         )
 
+        # sorted according to dm.gc_sorting_scheme
         fileGC = PeriodicFileGC(
             pathMapper,
-            CollectionStrategy(
-                FractionalCollectionThresholds(),
-                LRUSortingScheme(),
-            ),
+            CollectionStrategy(FractionalCollectionThresholds()),
         )
         from .lib.cache_manager import (
             SimpleCacheManager,
         )
+        from .lib.prefetch import DataSetPrefetchPolicy
 
+        # warms the cache with session data if dm.prefetch_budget is set
         cacheManager = SimpleCacheManager(
-            Setting(), transferManager, fileGC, pathMapper
+            Setting(), transferManager, fileGC, pathMapper, DataSetPrefetchPolicy()
         )
         dm = DM(cacheManager)
         info["apiRoot"].dm = dm
@@ -884,6 +949,8 @@ class WholeTalePlugin(GirderPlugin):
         info["apiRoot"].dm.route("DELETE", ("session", ":id"), session.removeSession)
 
         info["apiRoot"].dm.route("POST", ("lock",), lock.acquireLock)
+        info["apiRoot"].dm.route("POST", ("lock", "bulk"), lock.acquireLocks)
+        info["apiRoot"].dm.route("DELETE", ("lock", "bulk"), lock.releaseLocks)
         info["apiRoot"].dm.route("DELETE", ("lock", ":id"), lock.releaseLock)
         info["apiRoot"].dm.route("GET", ("lock", ":id"), lock.getLock)
         info["apiRoot"].dm.route("GET", ("lock",), lock.listLocks)
@@ -904,6 +971,9 @@ class WholeTalePlugin(GirderPlugin):
         )
 
         info["apiRoot"].dm.route("GET", ("transfer",), transfer.listTransfers)
+        info["apiRoot"].dm.route("GET", ("transfer", "queue"), dm.getTransferQueue)
+        info["apiRoot"].dm.route("GET", ("stats",), dm.getStats)
+        info["apiRoot"].dm.route("GET", ("metrics",), dm.getMetrics)
 
         info["apiRoot"].dm.route("GET", ("fs", "item", ":itemId"), fs.getItemUnfiltered)
         info["apiRoot"].dm.route("GET", ("fs", ":id", "raw"), fs.getRawObject)
@@ -919,6 +989,10 @@ class WholeTalePlugin(GirderPlugin):
             dict = event.info
             cacheManager.itemLocked(dict["user"], dict["itemId"], dict["sessionId"])
 
+        def itemsLocked(event):
+            dict = event.info
+            cacheManager.itemsLocked(dict["user"], dict["itemIds"], dict["sessionId"])
+
         def itemUnlocked(event):
             cacheManager.itemUnlocked(event.info)
 
@@ -932,6 +1006,7 @@ class WholeTalePlugin(GirderPlugin):
             cacheManager.sessionDeleted(event.info)
 
         events.bind("dm.itemLocked", "wholetale", itemLocked)
+        events.bind("dm.itemsLocked", "wholetale", itemsLocked)
         events.bind("dm.itemUnlocked", "wholetale", itemUnlocked)
         events.bind("dm.fileDownloaded", "wholetale", fileDownloaded)
         events.bind("dm.sessionCreated", "wholetale", sessionCreated)
@@ -940,6 +1015,9 @@ class WholeTalePlugin(GirderPlugin):
         events.bind("jobs.job.update.after", "wholetale", job_update_after_handler)
         events.bind("jobs.job.update", "wholetale", updateNotification)
         events.bind("model.file.validate", "wholetale", validateFileLink)
+        events.bind(
+            "model.setting.save.after", "wholetale.http_session", http_session.settingChanged
+        )
         events.bind("oauth.auth_callback.after", "wholetale", store_other_globus_tokens)
         events.bind("heartbeat", "wholetale", cullIdleInstances)
         events.unbind("model.job.save.after", "worker")
@@ -51,6 +51,23 @@ class PluginSettings:
     GC_RUN_INTERVAL = "dm.gc_run_interval"
     GC_COLLECT_START_FRACTION = "dm.gc_collect_start_fraction"
     GC_COLLECT_END_FRACTION = "dm.gc_collect_end_fraction"
+    GC_RECONCILE_INTERVAL = "dm.gc_reconcile_interval"
+    GC_SORTING_SCHEME = "dm.gc_sorting_scheme"
+    GC_TIME_BUDGET = "dm.gc_time_budget"
+    CONTENT_ADDRESSED_STORAGE = "dm.content_addressed_storage"
+    PREFETCH_BUDGET = "dm.prefetch_budget"
+    DOWNLOAD_OFFLOAD = "dm.download_offload"
+    DOWNLOAD_ACCEL_PREFIX = "dm.download_accel_prefix"
+    TRANSFER_WORKERS = "dm.transfer_workers"
+    TRANSFER_SEGMENTS = "dm.transfer_segments"
+    TRANSFER_BACKEND = "dm.transfer_backend"
+    TRANSFER_QUEUE = "dm.transfer_queue"
+    HTTP_POOL_CONNECTIONS = "wholetale.http_pool_connections"
+    HTTP_POOL_MAXSIZE = "wholetale.http_pool_maxsize"
+    HTTP_RETRIES = "wholetale.http_retries"
+    HTTP_BACKOFF_FACTOR = "wholetale.http_backoff_factor"
+    HTTP_CONNECT_TIMEOUT = "wholetale.http_connect_timeout"
+    HTTP_READ_TIMEOUT = "wholetale.http_read_timeout"
     INFLUXDB_URL = "wholetale.influxdb_url"
     INFLUXDB_TOKEN = "wholetale.influxdb_token"
     INFLUXDB_ORG = "wholetale.influxdb_org"
@@ -126,6 +143,14 @@ SettingDefault.defaults.update(
             {"name": "icpsr", "targets": ["www.openicpsr.org"]},
         ],
         PluginSettings.ZENODO_EXTRA_HOSTS: [],
+        # hosts with a pool of kept-alive connections, and connections per host
+        PluginSettings.HTTP_POOL_CONNECTIONS: 16,
+        PluginSettings.HTTP_POOL_MAXSIZE: 32,
+        PluginSettings.HTTP_RETRIES: 3,
+        PluginSettings.HTTP_BACKOFF_FACTOR: 0.5,
+        # seconds; the read timeout applies to each read, not the whole response
+        PluginSettings.HTTP_CONNECT_TIMEOUT: 10,
+        PluginSettings.HTTP_READ_TIMEOUT: 60,
         PluginSettings.PUBLISHER_REPOS: [
             {
                 "repository": "sandbox.zenodo.org",
@@ -255,3 +280,10 @@ class TransferStatus:
     DONE = 3
     FAILED = 4
     FAILED_TEMPORARILY = 5
+
+
+class TransferPriority:
+    # Lower values are scheduled first
+    INTERACTIVE = 0
+    RESTART = 1
+    PREFETCH = 2
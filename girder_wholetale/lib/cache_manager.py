@@ -1,17 +1,32 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from ..constants import TransferPriority
 from .tm_utils import Models
 
+logger = logging.getLogger(__name__)
+
 
 class CacheManager:
-    def __init__(self, settings, transferManager, fileGC, pathMapper):
+    def __init__(self, settings, transferManager, fileGC, pathMapper, prefetchPolicy=None):
         self.settings = settings
         self.transferManager = transferManager
         self.fileGC = fileGC
         self.pathMapper = pathMapper
+        self.prefetchPolicy = prefetchPolicy
         self.lockModel = Models.lockModel
+        # sessions are scanned for prefetching one at a time, off the request thread
+        self.prefetchPool = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="DM prefetch"
+        )
 
     def itemLocked(self, user, itemId, sessionId):
         pass
 
+    def itemsLocked(self, user, itemIds, sessionId):
+        for itemId in itemIds:
+            self.itemLocked(user, itemId, sessionId)
+
     def itemUnlocked(self, itemId):
         pass
 
@@ -27,16 +42,54 @@ class CacheManager:
     def clearCache(self, force):
         self.fileGC.clearCache(force)
 
+    def prefetch(self, session):
+        """
+        Starts low priority transfers for the items of a session picked by the
+        prefetch policy.
+
+        :return: The ids of the items whose transfer was started
+        """
+        if self.prefetchPolicy is None:
+            return []
+        budget = self.prefetchPolicy.getBudget()
+        if budget <= 0:
+            return []
+        items = self.prefetchPolicy.selectItems(session, budget)
+        if not items:
+            return []
+        user = Models.userModel.load(session["ownerId"], force=True)
+        # items that got locked or prefetched in the meantime are skipped
+        itemIds = self.lockModel.tryLockForPrefetch(
+            user, session["_id"], [item["_id"] for item in items]
+        )
+        self.transferManager.startTransfers(
+            user, itemIds, session["_id"], priority=TransferPriority.PREFETCH
+        )
+        return itemIds
+
+    def _prefetch(self, session):
+        try:
+            self.prefetch(session)
+        except Exception:  # noqa
+            logger.error("Failed to prefetch session %s" % session["_id"], exc_info=1)
+
 
 class SimpleCacheManager(CacheManager):
-    def __init__(self, settings, transferManager, fileGC, pathMapper):
-        CacheManager.__init__(self, settings, transferManager, fileGC, pathMapper)
+    def __init__(self, settings, transferManager, fileGC, pathMapper, prefetchPolicy=None):
+        CacheManager.__init__(
+            self, settings, transferManager, fileGC, pathMapper, prefetchPolicy
+        )
 
     def itemLocked(self, user, itemId, sessionId):
         # initiates transfer immediately
         self.transferManager.startTransfer(user, itemId, sessionId)
         CacheManager.itemLocked(self, user, itemId, sessionId)
 
+    def itemsLocked(self, user, itemIds, sessionId):
+        self.transferManager.startTransfers(user, itemIds, sessionId)
+        for itemId in itemIds:
+            CacheManager.itemLocked(self, user, itemId, sessionId)
+
     def itemUnlocked(self, itemId):
         # notifies GC
         self.fileGC.unreacheable(itemId)
@@ -46,8 +99,9 @@ class SimpleCacheManager(CacheManager):
         self.lockModel.fileDownloaded(info)
 
     def sessionCreated(self, session):
-        # do nothing; we transfer on open()
-        pass
+        # we transfer on open(), unless the prefetch policy warms the cache first
+        if self.prefetchPolicy is not None:
+            self.prefetchPool.submit(self._prefetch, session)
 
     def sessionDeleted(self, session):
         # also nothing; we mark as unused on close()
@@ -0,0 +1,151 @@
+"""
+Runs DM transfers on girder_worker (celery) nodes instead of in the Girder
+process, when dm.transfer_backend is "celery".
+
+The API node creates the transfer document and queues a task with a Girder
+job attached. A worker runs the TransferHandler, recording progress and then
+the outcome in the transfer document. When the job ends, Girder reads that
+outcome and completes the transfer (triggering dm.fileDownloaded) or fails it
+like a local one. Task results are not used: with the default rpc:// result
+backend, only the process that queued a task can read its result, and jobs
+may be updated on any API node. Workers need the plugin installed, access to
+the Girder database and the private storage mounted at
+dm.private_storage_path. The task itself is in transfer_worker.py.
+"""
+
+import threading
+
+from bson import objectid
+from girder.models.setting import Setting
+from girder_jobs.constants import JobStatus
+from kombu import Queue
+
+from ..constants import PluginSettings, TransferPriority, TransferStatus
+from . import dm_metrics
+from .handler_factory import HandlerFactory
+from .path_mapper import ContentAddressedPathMapper
+from .tm_utils import Models, TransferException
+from .transfer_manager import (
+    SimpleTransferManager,
+    TransferProgressAggregator,
+    handlerName,
+)
+from .transfer_worker import transferItem
+
+
+class CeleryTransferManager(SimpleTransferManager):
+    """
+    Queues transfers on celery workers. Transfers are not restarted when Girder
+    restarts, since they do not run in it. Byte ranges of items that are still
+    being transferred cannot be read, as the partial files are written elsewhere.
+    """
+
+    FINAL_JOB_STATUSES = (JobStatus.SUCCESS, JobStatus.ERROR, JobStatus.CANCELED)
+    # AMQP brokers deliver higher priorities first, unlike TransferPriority
+    MAX_PRIORITY = TransferPriority.PREFETCH
+
+    def __init__(self, pathMapper):
+        # Transfers run on the workers, so there is no local scheduler and no
+        # progress to flush. Also skips restartInterruptedTransfers().
+        self.pathMapper = pathMapper
+        self.handlerFactory = HandlerFactory()
+        self.scheduler = None
+        self.progress = TransferProgressAggregator(start=False)
+        self.inFlight = {}
+        self.inFlightLock = threading.Lock()
+        self.partial = {}
+
+    def getQueue(self):
+        # declared by whichever of Girder and the workers comes first, so the
+        # workers must use the same x-max-priority (task_queue_max_priority)
+        return Queue(
+            Setting().get(PluginSettings.TRANSFER_QUEUE),
+            queue_arguments={"x-max-priority": CeleryTransferManager.MAX_PRIORITY},
+        )
+
+    def submitTransfer(self, itemId, transferId, transferHandler, priority):
+        transferItem.signature(
+            args=[str(transferId), str(itemId), str(transferHandler.user["_id"])],
+            queue=self.getQueue(),
+            priority=CeleryTransferManager.MAX_PRIORITY - priority,
+            girder_job_title="DM transfer of item %s" % itemId,
+            girder_job_other_fields={"dmTransferId": str(transferId)},
+        ).apply_async()
+
+    def jobUpdated(self, event):
+        job = event.info["job"]
+        if "dmTransferId" not in job or job.get("status") not in self.FINAL_JOB_STATUSES:
+            return
+        transfer = Models.transferModel.load(
+            objectid.ObjectId(job["dmTransferId"]), force=True
+        )
+        if transfer is None or transfer["status"] in Models.transferModel.FINAL_STATUSES:
+            return
+        user = self.getUser(transfer["ownerId"])
+        transferHandler = self.getTransferHandler(transfer["_id"], transfer["itemId"], user)
+        # the size is only known to the worker for some handlers
+        transferHandler.flen = transferHandler.flen or transferHandler.item.get("size", 0)
+        handler = handlerName(transferHandler)
+        result = transfer.get("workerResult") or {}
+        if job["status"] == JobStatus.SUCCESS:
+            transferHandler.transferTime = result.get("transferTime")
+            transferHandler.verifiedChecksums = result.get("verifiedChecksums") or {}
+            dm_metrics.TRANSFERS.inc(handler=handler, status="done")
+            dm_metrics.TRANSFER_BYTES.inc(
+                transferHandler.getTransferredByteCount(), handler=handler
+            )
+            self.transferCompleted(transfer["_id"], transferHandler)
+        else:
+            if "error" in result:
+                # temporary failures are retried, as with the local backend
+                exception = TransferException(
+                    cause=result["error"], fatal=result.get("fatal", True)
+                )
+            else:
+                exception = Exception("Transfer job %s did not succeed" % job["_id"])
+            dm_metrics.TRANSFERS.inc(handler=handler, status="failed")
+            self.transferFailed(transfer["_id"], transferHandler, exception)
+
+    def getStats(self):
+        # the transfers waiting and running on the workers
+        counts = {
+            status: Models.transferModel.collection.count_documents({"status": status})
+            for status in (TransferStatus.QUEUED, TransferStatus.TRANSFERRING)
+        }
+        return {
+            "workers": None,
+            "busy": counts[TransferStatus.TRANSFERRING],
+            "queued": counts[TransferStatus.QUEUED],
+            "utilization": None,
+        }
+
+
+class WorkerTransferManager(SimpleTransferManager):
+    """
+    What a TransferHandler running on a celery worker reports to: progress goes
+    straight to the transfer collection, and nothing is scheduled.
+    """
+
+    def __init__(self):
+        self.pathMapper = ContentAddressedPathMapper()
+        self.handlerFactory = HandlerFactory()
+        self.partial = {}
+
+    def transferProgress(self, transferId, total, current, offset=None):
+        Models.transferModel.setProgress({transferId: (total, current, offset)})
+
+    def recordSuccess(self, transferId, transferHandler):
+        result = {
+            "transferTime": transferHandler.getTransferTime(),
+            "verifiedChecksums": transferHandler.verifiedChecksums,
+        }
+        Models.transferModel.setWorkerResult(transferId, result)
+        return result
+
+    def recordFailure(self, transferId, exception):
+        # what TransferManager.transferFailed makes of the exception
+        if isinstance(exception, TransferException):
+            result = {"error": str(exception.getCause()), "fatal": exception.isFatal()}
+        else:
+            result = {"error": str(exception), "fatal": True}
+        Models.transferModel.setWorkerResult(transferId, result)
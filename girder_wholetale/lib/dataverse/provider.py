@@ -4,7 +4,6 @@ import logging
 import re
 import os
 import pathlib
-import requests
 from urllib.parse import urlparse, urlunparse, parse_qs, unquote
 
 from girder import events
@@ -13,6 +12,7 @@ from girder.models.folder import Folder
 from girder.models.setting import Setting
 
 from .auth import DataverseVerificator
+from .. import http_session
 from ..import_providers import ImportProvider
 from ..data_map import DataMap
 from ..file_map import FileMap
@@ -29,7 +29,7 @@ _CNTDISPS_REGEX = re.compile(r"^attachment; filename\*=.*''(.*)$")
 
 
 def _query_dataverse(search_url, headers=None):
-    req = requests.get(search_url, headers=headers)
+    req = http_session.get(search_url, headers=headers)
     data = req.json()["data"]
     if data['count_in_response'] != 1:
         raise ValueError
@@ -57,14 +57,14 @@ def _get_attrs_via_head(obj, url, headers=None):
     # start by regular HEAD, trick is it's gonna fail with 403
     # if the file is sitting on S3
     # see https://github.com/IQSS/dataverse/issues/5322
-    req = requests.head(url, allow_redirects=True, headers=headers)
+    req = http_session.head(url, allow_redirects=True, headers=headers)
     if req.ok:
         size = int(req.headers.get("Content-Length", default=obj.get("size", "-1")))
     else:
         # Now the magic, since S3 accepts range request, we cheat the system
         # by requesting only 100 bytes to get the headers we want.
         # Isn't it beautiful?!
-        req = requests.get(url, headers={"Range": "bytes=0-100"})
+        req = http_session.get(url, headers={"Range": "bytes=0-100"})
 
         if not req.ok or "Content-Range" not in req.headers:
             # oh well, I tried...
@@ -85,7 +85,7 @@ def _get_attrs_via_head(obj, url, headers=None):
 
 
 def _get_attrs_via_get(obj, url, headers=None):
-    req = requests.get(url, allow_redirects=True, stream=True, headers=headers)
+    req = http_session.get(url, allow_redirects=True, stream=True, headers=headers)
     md5sum = hashlib.md5()
     size = 0
     for chunk in req.iter_content(chunk_size=4096):
@@ -125,7 +125,7 @@ class DataverseImportProvider(ImportProvider):
                 urlparse(url)._replace(path='/api/info/version')
             )
         try:
-            req = requests.get(url)
+            req = http_session.get(url)
             data = req.json()
         except Exception:
             logger.warning(
@@ -176,7 +176,7 @@ class DataverseImportProvider(ImportProvider):
             )
         else:
             dataset_url = urlunparse(url)
-        req = requests.get(dataset_url, headers=headers)
+        req = http_session.get(dataset_url, headers=headers)
         return req.json()
 
     def _parse_dataset(self, url, headers=None):
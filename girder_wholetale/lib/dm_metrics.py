@@ -0,0 +1,181 @@
+"""
+Counters and histograms of the data manager, kept in memory and exposed in
+the Prometheus text format by GET /dm/metrics and as JSON by GET /dm/stats.
+"""
+
+import bisect
+import threading
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, description, labelNames=()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def labelValues(self, labels):
+        if set(labels) != set(self.labelNames):
+            raise ValueError(
+                "Metric %s takes labels %s, got %s"
+                % (self.name, self.labelNames, tuple(labels))
+            )
+        return tuple(str(labels[name]) for name in self.labelNames)
+
+    def formatLabels(self, values, extra=()):
+        pairs = list(zip(self.labelNames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join(
+            '%s="%s"' % (name, value.replace("\\", "\\\\").replace('"', '\\"'))
+            for name, value in pairs
+        )
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        with self.lock:
+            for values in sorted(self.values):
+                lines.extend(self.renderSamples(values, self.values[values]))
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [
+                dict(zip(self.labelNames, values), **self.sampleSnapshot(value))
+                for values, value in sorted(self.values.items())
+            ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        values = self.labelValues(labels)
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.labelValues(labels), 0)
+
+    def renderSamples(self, values, value):
+        return ["%s%s %s" % (self.name, self.formatLabels(values), value)]
+
+    def sampleSnapshot(self, value):
+        return {"value": value}
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, description, buckets, labelNames=()):
+        Metric.__init__(self, name, description, labelNames)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        values = self.labelValues(labels)
+        with self.lock:
+            sample = self.values.get(values)
+            if sample is None:
+                sample = {"counts": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+                self.values[values] = sample
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                sample["counts"][i] += 1
+            sample["count"] += 1
+            sample["sum"] += value
+
+    def renderSamples(self, values, sample):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, sample["counts"]):
+            cumulative += count
+            labels = self.formatLabels(values, [("le", "%g" % bound)])
+            lines.append("%s_bucket%s %s" % (self.name, labels, cumulative))
+        labels = self.formatLabels(values, [("le", "+Inf")])
+        lines.append("%s_bucket%s %s" % (self.name, labels, sample["count"]))
+        lines.append("%s_sum%s %s" % (self.name, self.formatLabels(values), sample["sum"]))
+        lines.append("%s_count%s %s" % (self.name, self.formatLabels(values), sample["count"]))
+        return lines
+
+    def sampleSnapshot(self, sample):
+        count = sample["count"]
+        return {
+            "count": count,
+            "sum": sample["sum"],
+            "mean": sample["sum"] / count if count else None,
+            "buckets": dict(zip(("%g" % b for b in self.buckets), sample["counts"])),
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labelNames=()):
+        return self.register(Counter(name, description, labelNames))
+
+    def histogram(self, name, description, buckets, labelNames=()):
+        return self.register(Histogram(name, description, buckets, labelNames))
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in sorted(self.metrics.items())}
+
+
+SECONDS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+BYTES = tuple(1024**2 * 4**i for i in range(10))
+
+REGISTRY = Registry()
+
+TRANSFERS = REGISTRY.counter(
+    "dm_transfers_total", "Transfers that ended, by handler and status", ("handler", "status")
+)
+TRANSFER_BYTES = REGISTRY.counter(
+    "dm_transfer_bytes_total", "Bytes transferred, by handler", ("handler",)
+)
+TRANSFER_DURATION = REGISTRY.histogram(
+    "dm_transfer_duration_seconds", "Duration of completed transfers", SECONDS, ("handler",)
+)
+TRANSFER_QUEUE_WAIT = REGISTRY.histogram(
+    "dm_transfer_queue_wait_seconds",
+    "Time transfers spent queued before a worker started them",
+    SECONDS,
+    ("priority",),
+)
+TRANSFER_FIRST_BYTE = REGISTRY.histogram(
+    "dm_transfer_first_byte_seconds",
+    "Time from the start of a transfer to its first written byte",
+    SECONDS,
+    ("handler",),
+)
+CHECKSUM_FAILURES = REGISTRY.counter(
+    "dm_checksum_failures_total", "Transferred files that failed checksum verification"
+)
+LOCKS = REGISTRY.counter(
+    "dm_locks_total",
+    "Locked items that were cached or being transferred (hit) or not (miss)",
+    ("result",),
+)
+GC_PASS_DURATION = REGISTRY.histogram(
+    "dm_gc_pass_duration_seconds", "Duration of GC passes that collected files", SECONDS
+)
+GC_PASS_BYTES = REGISTRY.histogram(
+    "dm_gc_pass_evicted_bytes", "Bytes evicted by GC passes that collected files", BYTES
+)
+GC_EVICTED_FILES = REGISTRY.counter("dm_gc_evicted_files_total", "Files evicted by the GC")
@@ -1,18 +1,65 @@
-from hashlib import sha256, md5
+import collections
+import hashlib
 import json
 import magic
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from girder.utility import _hash_state, ziputil, JsonEncoder
+from bson import ObjectId
+from girder.utility import ziputil, JsonEncoder
 from girder.models.folder import Folder
+from girder.models.item import Item
 from girder.constants import AccessType
+from .. import http_session
 from ..license import WholeTaleLicense
 
 
+class RemoteChecksumCache:
+    """
+    Remembers the md5 of remote files by uri and ETag (or Last-Modified), so
+    that files which did not change are not downloaded again by later exports.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(uri, headers):
+        validator = headers.get("ETag") or headers.get("Last-Modified")
+        if validator:
+            return uri, validator
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+    def put(self, key, checksum):
+        with self.lock:
+            self.entries[key] = checksum
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+remote_checksums = RemoteChecksumCache()
+
+
 class HashFileStream:
-    """Generator that computes md5 and sha256 of data returned by it"""
+    """
+    Generator that computes checksums and the size of data returned by it,
+    and, given a magic.Magic, sniffs its mimetype from the first bytes
+    """
 
-    def __init__(self, gen):
+    # how much libmagic looks at by default
+    SNIFF_SIZE = 1024 * 1024
+
+    def __init__(self, gen, algs=("md5", "sha256"), magic_wrapper=None):
         """
         This class is primarily meant to wrap Girder's download function,
         which returns iterators, hence self.x = x()
@@ -21,33 +68,43 @@ class HashFileStream:
             self.gen = gen()
         except TypeError:
             self.gen = gen
-        self.state = {
-            'md5': _hash_state.serializeHex(md5()),
-            'sha256': _hash_state.serializeHex(sha256()),
-        }
+        self.hashers = {alg: hashlib.new(alg) for alg in algs}
+        self.size = 0
+        self.magic_wrapper = magic_wrapper
+        self.head = bytearray()
 
     def __iter__(self):
         return self
 
     def __next__(self):
         nxt = next(self.gen)
-        for alg in self.state.keys():
-            checksum = _hash_state.restoreHex(self.state[alg], alg)
-            checksum.update(nxt)
-            self.state[alg] = _hash_state.serializeHex(checksum)
+        self.size += len(nxt)
+        for hasher in self.hashers.values():
+            hasher.update(nxt)
+        if self.magic_wrapper is not None and len(self.head) < self.SNIFF_SIZE:
+            self.head += nxt[:self.SNIFF_SIZE - len(self.head)]
         return nxt
 
     def __call__(self):
         """Needs to be callable, see comment in __init__"""
         return self
 
+    def hexdigest(self, alg):
+        return self.hashers[alg].hexdigest()
+
     @property
     def sha256(self):
-        return _hash_state.restoreHex(self.state['sha256'], 'sha256').hexdigest()
+        return self.hexdigest('sha256')
 
     @property
     def md5(self):
-        return _hash_state.restoreHex(self.state['md5'], 'md5').hexdigest()
+        return self.hexdigest('md5')
+
+    @property
+    def mimetype(self):
+        if self.magic_wrapper is None:
+            return None
+        return self.magic_wrapper.from_buffer(bytes(self.head)) or "application/octet-stream"
 
 
 class TaleExporter:
@@ -60,13 +117,21 @@ class TaleExporter:
        README.md: This file"""
     default_bagit = "BagIt-Version: 0.97\nTag-File-Character-Encoding: UTF-8\n"
 
-    def __init__(self, user, manifest, environment, algs=None):
+    # size of the reads from workspace files
+    chunk_size = 1024 * 1024
+    # remote files fetched at the same time to compute missing checksums
+    verify_workers = 8
+
+    def __init__(self, user, manifest, environment, algs=None, chunk_size=None):
         self.user = user
         self.manifest = manifest
         self.environment = environment
 
         if algs is None:
-            self.algs = ["md5", "sha1", "sha256"]
+            algs = ["md5", "sha1", "sha256"]
+        self.algs = algs
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
 
         zipname = os.path.basename(manifest["dct:hasVersion"]["@id"])
         self.zip_generator = ziputil.ZipGenerator(zipname)
@@ -79,9 +144,14 @@ class TaleExporter:
             WholeTaleLicense.default_spdx()
         )
         self.tale_license = WholeTaleLicense().license_from_spdx(license_spdx)
+        self._agg_index = {}
+        self._agg_index_key = None
         self.state = {}
         for alg in self.algs:
             self.state[alg] = []
+        # zip path -> (size, mimetype) of the files dumped so far
+        self.file_info = {}
+        self.magic_wrapper = magic.Magic(mime=True, uncompress=True)
 
     def list_files(self):
         """
@@ -107,7 +177,7 @@ class TaleExporter:
                     yield fullpath, relpath
 
     @staticmethod
-    def bytes_from_file(filename, chunksize=8192):
+    def bytes_from_file(filename, chunksize=chunk_size):
         with open(filename, mode="rb") as f:
             while True:
                 chunk = f.read(chunksize)
@@ -124,16 +194,49 @@ class TaleExporter:
         return (_.encode() for _ in (string,))
 
     def dump_and_checksum(self, func, zip_path):
-        hash_file_stream = HashFileStream(func)
+        """
+        Adds a file to the zip, recording its checksums, size and mimetype on
+        the way, so that it is read only once.
+
+        :return: The HashFileStream the file was read through
+        """
+        hash_file_stream = HashFileStream(
+            func, algs=self.algs, magic_wrapper=self.magic_wrapper
+        )
         for data in self.zip_generator.addFile(hash_file_stream, zip_path):
             yield data
         # MD5 is the only required alg in profile. See Manifests-Required in
         # https://raw.githubusercontent.com/fair-research/bdbag/master/profiles/bdbag-ro-profile.json
-        self.state['md5'].append((zip_path, hash_file_stream.md5))
+        # The others are computed in the same pass, for the bag manifests.
+        for alg in self.algs:
+            self.state[alg].append((zip_path, hash_file_stream.hexdigest(alg)))
+        self.file_info[zip_path] = (hash_file_stream.size, hash_file_stream.mimetype)
+        return hash_file_stream
+
+    @staticmethod
+    def aggregate_uri(path):
+        """
+        Returns the uri of the aggregate of a file added to the zip. Bags keep
+        the files of the Tale under data/.
+        """
+        if path.startswith("data/"):
+            path = path[len("data/"):]
+        return "./" + path
 
     def _agg_index_by_uri(self, uri):
+        """
+        Returns the position of the first aggregate with the given uri. The
+        uri -> position index is built on first use, and rebuilt if aggregates
+        were added or removed since.
+        """
         aggs = self.manifest["aggregates"]
-        return next((i for (i, d) in enumerate(aggs) if d['uri'] == uri), None)
+        key = (id(aggs), len(aggs))
+        if self._agg_index_key != key:
+            self._agg_index = {}
+            for i, agg in enumerate(aggs):
+                self._agg_index.setdefault(agg['uri'], i)
+            self._agg_index_key = key
+        return self._agg_index.get(uri)
 
     def append_aggergate_checksums(self):
         """
@@ -142,42 +245,84 @@ class TaleExporter:
         """
         aggs = self.manifest["aggregates"]
         for path, chksum in self.state['md5']:
-            uri = "./" + path.replace("data/", "", 1)
+            uri = self.aggregate_uri(path)
             index = self._agg_index_by_uri(uri)
             if index is not None:
                 aggs[index]['wt:md5'] = chksum
         self.verify_aggregate_checksums()
 
     def verify_aggregate_checksums(self):
-        """Check if every aggregate has a proper checksum."""
+        """
+        Check if every aggregate has a proper checksum, computing the md5 of the
+        ones that do not. Remote files are fetched concurrently, and the checksums
+        are stored in the meta.checksum of their items for the next manifests.
+        """
         algs = {f"wt:{alg}" for alg in self.algs}
-        for index, agg in enumerate(self.manifest["aggregates"]):
-            if algs - set(agg.keys()) == algs:
-                try:
-                    req = requests.get(agg["uri"], allow_redirects=True, stream=True)
-                except requests.exceptions.InvalidSchema:
-                    # globus...
-                    continue
-                md5sum = md5()
-                for chunk in req.iter_content(chunk_size=4096):
+        aggs = [
+            agg for agg in self.manifest["aggregates"] if algs - set(agg.keys()) == algs
+        ]
+        if not aggs:
+            return
+        with ThreadPoolExecutor(
+            max_workers=min(self.verify_workers, len(aggs)),
+            thread_name_prefix="ExportChecksum",
+        ) as pool:
+            checksums = list(pool.map(self._aggregate_md5, aggs))
+        for agg, checksum in zip(aggs, checksums):
+            if checksum is None:
+                continue
+            agg["wt:md5"] = checksum
+            if "wt:identifier" in agg:
+                Item().update(
+                    {"_id": ObjectId(agg["wt:identifier"])},
+                    {"$set": {"meta.checksum.md5": checksum}},
+                    multi=False,
+                )
+
+    def _aggregate_md5(self, agg):
+        item = None
+        if "wt:identifier" in agg:
+            item = Item().load(agg["wt:identifier"], force=True, fields=["dm"])
+        if item is not None and item.get("dm", {}).get("cached"):
+            try:
+                md5sum = hashlib.md5()
+                for chunk in self.bytes_from_file(item["dm"]["psPath"], self.chunk_size):
                     md5sum.update(chunk)
-                self.manifest["aggregates"][index]["wt:md5"] = md5sum.hexdigest()
+                return md5sum.hexdigest()
+            except (KeyError, FileNotFoundError):
+                pass  # collected in the meantime
+        try:
+            req = http_session.get(agg["uri"], allow_redirects=True, stream=True)
+        except requests.exceptions.InvalidSchema:
+            # globus...
+            return None
+        with req:
+            if not req.ok:
+                return None
+            key = remote_checksums.key(agg["uri"], req.headers)
+            if key is not None and (checksum := remote_checksums.get(key)):
+                return checksum
+            md5sum = hashlib.md5()
+            for chunk in req.iter_content(chunk_size=self.chunk_size):
+                md5sum.update(chunk)
+        checksum = md5sum.hexdigest()
+        if key is not None:
+            remote_checksums.put(key, checksum)
+        return checksum
 
     def append_aggregate_filesize_mimetypes(self):
         """
-        Adds the file size and mimetype to the workspace files
+        Adds the file size and mimetype recorded by dump_and_checksum to the
+        workspace files
         :return: None
         """
-        magic_wrapper = magic.Magic(mime=True, uncompress=True)
         aggs = self.manifest["aggregates"]
-        for fullpath, relpath in self.list_files():
-            uri = "./" + relpath
+        for path, (size, mimetype) in self.file_info.items():
+            uri = self.aggregate_uri(path)
             index = self._agg_index_by_uri(uri)
             if index is not None:
-                aggs[index]["wt:mimeType"] = (
-                    magic_wrapper.from_file(fullpath) or "application/octet-stream"
-                )
-                aggs[index]["wt:size"] = os.path.getsize(fullpath)
+                aggs[index]["wt:mimeType"] = mimetype
+                aggs[index]["wt:size"] = size
 
     def append_extras_filesize_mimetypes(self, extra_files):
         """
@@ -188,7 +333,7 @@ class TaleExporter:
         """
         aggs = self.manifest["aggregates"]
         for path, content in extra_files.items():
-            uri = "./" + path.replace("data/", "", 1)
+            uri = self.aggregate_uri(path)
             index = self._agg_index_by_uri(uri)
             if index is not None:
                 aggs[index]["wt:mimeType"] = "text/plain"
@@ -94,11 +94,11 @@ class BagTaleExporter(TaleExporter):
 
         # Add files from the workspace computing their checksum
         for fullpath, relpath in self.list_files():
-            yield from self.dump_and_checksum(
-                self.bytes_from_file(fullpath), 'data/' + relpath
+            stream = yield from self.dump_and_checksum(
+                self.bytes_from_file(fullpath, self.chunk_size), 'data/' + relpath
             )
             oxum["num"] += 1
-            oxum["size"] += os.path.getsize(fullpath)
+            oxum["size"] += stream.size
 
         # Compute checksums for the extrafiles
         for path, content in extra_files.items():
@@ -0,0 +1,205 @@
+"""
+Benchmarks the Tale exporters on synthetic workspaces and manifests.
+
+The "stream" benchmark measures the throughput of NativeTaleExporter.stream.
+Its "serialized" hashing replays how HashFileStream used to work, restoring
+and serializing the md5 and sha256 states around every chunk, with 8 KiB reads.
+
+The "manifest" benchmark times the updates of the manifest aggregates after
+the files are zipped, for manifests of growing sizes. Its "scan" lookup
+replays the linear search of the aggregates that was done for every file.
+
+Usage:
+
+    python -m girder_wholetale.lib.exporters.benchmark stream --files 20 --size 16M
+    python -m girder_wholetale.lib.exporters.benchmark stream --hashing serialized \\
+        --chunk-size 8K
+    python -m girder_wholetale.lib.exporters.benchmark manifest --aggregates 50000
+"""
+
+import argparse
+import contextlib
+import os
+import random
+import shutil
+import tempfile
+import time
+from unittest import mock
+
+from girder.utility import _hash_state
+
+from . import HashFileStream
+from .native import NativeTaleExporter
+
+
+class SerializedHashFileStream(HashFileStream):
+    """HashFileStream as it was, keeping only serialized hash states."""
+
+    def __init__(self, gen, algs=("md5", "sha256"), magic_wrapper=None):
+        super().__init__(gen, algs=("md5", "sha256"), magic_wrapper=magic_wrapper)
+        self.state = {
+            alg: _hash_state.serializeHex(hasher) for alg, hasher in self.hashers.items()
+        }
+
+    def __next__(self):
+        nxt = next(self.gen)
+        self.size += len(nxt)
+        for alg in self.state.keys():
+            checksum = _hash_state.restoreHex(self.state[alg], alg)
+            checksum.update(nxt)
+            self.state[alg] = _hash_state.serializeHex(checksum)
+        if self.magic_wrapper is not None and len(self.head) < self.SNIFF_SIZE:
+            self.head += nxt[:self.SNIFF_SIZE - len(self.head)]
+        return nxt
+
+    def hexdigest(self, alg):
+        if alg not in self.state:
+            return ""
+        return _hash_state.restoreHex(self.state[alg], alg).hexdigest()
+
+
+class BenchmarkExporter(NativeTaleExporter):
+    """Exports a plain directory instead of the workspace of a Tale version."""
+
+    def __init__(self, root, manifest, **kwargs):
+        super().__init__(None, manifest, {}, **kwargs)
+        self.root = root
+
+    def list_files(self):
+        for curdir, _, files in os.walk(self.root):
+            for fname in files:
+                fullpath = os.path.join(curdir, fname)
+                yield fullpath, "workspace" + fullpath[len(self.root):]
+
+
+def makeWorkspace(root, files, size):
+    """Writes files of random bytes to root and returns a manifest listing them."""
+    aggregates = []
+    block = random.randbytes(min(size, 1024 * 1024))
+    for i in range(files):
+        name = "file%05d.bin" % i
+        with open(os.path.join(root, name), "wb") as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+        aggregates.append({"uri": "./workspace/" + name})
+    return {
+        "dct:hasVersion": {"@id": "https://data.wholetale.org/api/v1/folder/benchmark"},
+        "aggregates": aggregates,
+    }
+
+
+def run(files, size, chunkSize=None, hashing="live"):
+    """
+    Exports a synthetic workspace once.
+
+    :return: A dict with the bytes read, the time taken and the throughput in MB/s
+    """
+    root = tempfile.mkdtemp()
+    try:
+        manifest = makeWorkspace(root, files, size)
+        exporter = BenchmarkExporter(root, manifest, chunk_size=chunkSize)
+        streamClass = SerializedHashFileStream if hashing == "serialized" else HashFileStream
+        # workspace files are checksummed by now, remote ones are not looked up
+        with mock.patch(
+            "girder_wholetale.lib.exporters.HashFileStream", streamClass
+        ), mock.patch.object(exporter, "verify_aggregate_checksums"):
+            start = time.perf_counter()
+            for _ in exporter.stream():
+                pass
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(root)
+    total = files * size
+    return {"bytes": total, "seconds": elapsed, "MBps": total / elapsed / 1024**2}
+
+
+def scanAggregates(exporter, uri):
+    aggs = exporter.manifest["aggregates"]
+    return next((i for (i, d) in enumerate(aggs) if d["uri"] == uri), None)
+
+
+def runManifest(aggregates, lookup="index"):
+    """
+    Adds checksums, sizes and mimetypes to a manifest with the given number of
+    aggregates, as done at the end of an export.
+
+    :return: A dict with the number of aggregates and the time taken
+    """
+    manifest = {
+        "dct:hasVersion": {"@id": "https://data.wholetale.org/api/v1/folder/benchmark"},
+        "aggregates": [
+            {"uri": "./workspace/file%07d.bin" % i} for i in range(aggregates)
+        ],
+    }
+    exporter = NativeTaleExporter(None, manifest, {})
+    exporter.state["md5"] = [
+        ("workspace/file%07d.bin" % i, "%032x" % i) for i in range(aggregates)
+    ]
+    extra_files = {"workspace/file%07d.bin" % i: "" for i in range(0, aggregates, 2)}
+    patches = [mock.patch.object(exporter, "verify_aggregate_checksums")]
+    if lookup == "scan":
+        patches.append(
+            mock.patch.object(
+                exporter, "_agg_index_by_uri", lambda uri: scanAggregates(exporter, uri)
+            )
+        )
+    with contextlib.ExitStack() as stack:
+        for patch in patches:
+            stack.enter_context(patch)
+        start = time.perf_counter()
+        exporter.append_aggergate_checksums()
+        exporter.append_extras_filesize_mimetypes(extra_files)
+        elapsed = time.perf_counter() - start
+    return {"aggregates": aggregates, "seconds": elapsed}
+
+
+def parseSize(value):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    stream = subparsers.add_parser("stream")
+    stream.add_argument("--files", type=int, default=20)
+    stream.add_argument("--size", type=parseSize, default=16 * 1024**2)
+    stream.add_argument("--chunk-size", type=parseSize, default=None)
+    stream.add_argument("--hashing", choices=("live", "serialized"), default="live")
+    stream.add_argument("--repeat", type=int, default=3)
+    manifest = subparsers.add_parser("manifest")
+    manifest.add_argument("--aggregates", type=int, default=50000)
+    manifest.add_argument("--lookup", choices=("index", "scan"), default="index")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "stream":
+        for _ in range(args.repeat):
+            result = run(args.files, args.size, args.chunk_size, args.hashing)
+            print(
+                "%-10s %10d bytes %8.3f s %10.1f MB/s"
+                % (args.hashing, result["bytes"], result["seconds"], result["MBps"])
+            )
+    else:
+        # doubling sizes up to the requested one, to show how the time grows
+        sizes = [args.aggregates]
+        while sizes[-1] >= 2000:
+            sizes.append(sizes[-1] // 2)
+        for size in reversed(sizes):
+            result = runManifest(size, args.lookup)
+            print(
+                "%-6s %10d aggregates %8.3f s %10.2f us/aggregate"
+                % (
+                    args.lookup,
+                    result["aggregates"],
+                    result["seconds"],
+                    result["seconds"] / result["aggregates"] * 1e6,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
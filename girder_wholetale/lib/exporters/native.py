@@ -12,7 +12,7 @@ class NativeTaleExporter(TaleExporter):
         # Add files from the workspace
         for fullpath, relpath in self.list_files():
             yield from self.dump_and_checksum(
-                self.bytes_from_file(fullpath), relpath
+                self.bytes_from_file(fullpath, self.chunk_size), relpath
             )
 
         # Compute checksums for extra files
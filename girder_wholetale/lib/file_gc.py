@@ -1,34 +1,45 @@
 from __future__ import with_statement
 
-import datetime
+import itertools
 import logging
-import os
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 
 from girder.models.setting import Setting
 
 from .. import constants
-from ..models.lock import Lock
 from ..models.psinfo import PSInfo
+from . import dm_metrics
+from .gc_sorting import (  # noqa: F401
+    SORTING_SCHEMES,
+    CollectionSortingScheme,
+    LRUSortingScheme,
+)
 from .tm_utils import Models
 
-BEGINNING_OF_TIME = datetime.datetime.fromtimestamp(0)
 logger = logging.getLogger(__name__)
 
 
 class FileGC:
+    # files are claimed, removed and released this many at a time
+    DELETE_BATCH_SIZE = 100
+    DELETE_WORKERS = 8
+
     def __init__(self, pathMapper):
         self.lockModel = Models.lockModel
         self.pathMapper = pathMapper
+        self.deletePool = ThreadPoolExecutor(
+            max_workers=self.DELETE_WORKERS, thread_name_prefix="DM File GC delete"
+        )
 
     def deleteFile(self, itemId):
         if self.lockModel.tryLockForDeletion(itemId):
             try:
-                path = self.pathMapper.getPSPath(itemId)
-                os.remove(path)
-                self.lockModel.fileDeleted(itemId)
+                item = self.lockModel.itemModel.load(itemId, force=True, fields=["dm"])
+                freed = self.pathMapper.removeFile(item or {"_id": itemId})
+                self.lockModel.fileDeleted(itemId, freed=freed)
                 return True
             except FileNotFoundError:
                 # well, well, wasn't there to begin with
@@ -40,17 +51,61 @@ class FileGC:
         else:
             return False
 
+    def deleteFiles(self, items):
+        """
+        Deletes the files of a batch of items. Items that are locked or already
+        being deleted are skipped.
+
+        :return: The items whose files were deleted
+        """
+        claimed = self.lockModel.tryLockManyForDeletion([item["_id"] for item in items])
+        items = [item for item in items if item["_id"] in claimed]
+        deleted = []
+        failed = []
+        shared = []
+        for item, freed in zip(items, self.deletePool.map(self.removeFile, items)):
+            if freed is None:
+                failed.append(item)
+                continue
+            deleted.append(item)
+            if not freed:
+                shared.append(item["_id"])
+        self.lockModel.filesDeleted([item["_id"] for item in deleted], shared)
+        self.lockModel.unlockManyForDeletion([item["_id"] for item in failed])
+        return deleted
+
+    def removeFile(self, item):
+        # True if the space was freed, False if the content is shared with other
+        # items, and None if the file could not be removed
+        try:
+            return self.pathMapper.removeFile(item)
+        except FileNotFoundError:
+            logger.warning("File for %s did not exist" % item["_id"])
+            return True
+        except OSError:
+            logger.error("Could not delete file for %s" % item["_id"], exc_info=1)
+            return None
+
+    def batches(self, items):
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, self.DELETE_BATCH_SIZE))
+            if not batch:
+                return
+            yield batch
+
     def clearCache(self, force):
         if force:
             items = self.lockModel._getAllCachedItems()
         else:
             items = self.lockModel.getCollectionCandidates()
-        for item in items:
+        for batch in self.batches(items):
             if force:
-                for lock in self.lockModel._getLocksForItem(item):
-                    self.lockModel.releaseLock(None, lock)
-                self.lockModel._resetLockedCount(item)
-            self.collectFile(item)
+                for item in batch:
+                    for lock in self.lockModel._getLocksForItem(item):
+                        self.lockModel.releaseLock(None, lock)
+                    self.lockModel._resetLockedCount(item)
+            self.collectFiles(batch)
 
     def unreacheable(self, itemId):
         pass
@@ -67,6 +122,9 @@ class FileGC:
     def collectFile(self, item):
         return self.deleteFile(item["_id"])
 
+    def collectFiles(self, items):
+        return self.deleteFiles(items)
+
 
 class DummyFileGC(FileGC):
     def __init__(self, pathMapper):
@@ -96,6 +154,7 @@ class PeriodicFileGC(FileGC):
     def __init__(self, pathMapper, collectionStrategy):
         FileGC.__init__(self, pathMapper)
         self.paused = False
+        self.interrupted = False
         self.collectLock = threading.Lock()
         self.collectionStrategy = collectionStrategy
         self.psInfo = PSInfo()
@@ -110,39 +169,100 @@ class PeriodicFileGC(FileGC):
 
     def _collect(self):
         # If total used space is over some collectThreshold, possibly a percentage of total space:
-        #   - List all items that are cached and not locked.
-        #   - Then sort them according to the collectionStrategy
-        #   - Delete them one by one until we are under cleanThreshold
-
-        if self.shouldCollect():
-            candidates = self.getCollectionCandidates()
-            used = 0
-            for c in candidates:
-                used = used + self.fileSize(c)
-
-            self.sortCandidates(candidates)
-
+        #   - Go through the items that are cached and not locked, in the order
+        #     given by the collectionStrategy
+        #   - Delete them in batches until we are under cleanThreshold, or the
+        #     time budget of the pass runs out
+        # Used space is accounted for as files are downloaded and deleted, and
+        # only occasionally recomputed from the private storage itself.
+
+        self.reconcileUsedSpace()
+        self.collectionStrategy.selectSortingScheme()
+        used = self.psInfo.sizeUsed()
+        if self.shouldCollect(used):
+            budget = Setting().get(constants.PluginSettings.GC_TIME_BUDGET)
+            start = time.monotonic()
+            deadline = start + budget if budget else None
+            candidates = self.getSortedCandidates()
             collected = 0
-            for c in candidates:
-                if self.collectFile(c):
-                    collected = collected + self.fileSize(c)
+            try:
+                for batch in self.candidateBatches(candidates, used):
+                    if self.interrupted:
+                        logger.info("DM file GC paused, stopping early")
+                        break
+                    deleted = self.collectFiles(batch)
+                    dm_metrics.GC_EVICTED_FILES.inc(len(deleted))
+                    for c in deleted:
+                        collected = collected + self.fileSize(c)
+                        self.collectionStrategy.itemCollected(c)
+                    if len(deleted) < len(batch):
+                        logger.info("Did not delete %s files" % (len(batch) - len(deleted)))
                     if self.shouldStopCollecting(used, collected):
-                        # keep an authoritative account of space used that isn't likely to drift
-                        self.updateUsedSpace(used - collected)
                         break
-                else:
-                    logger.info("Did not delete file %s" % c["_id"])
-
-    def shouldCollect(self):
-        return self.collectionStrategy.shouldCollect(
-            self.psInfo.totalSize(), self.psInfo.sizeUsed()
+                    if deadline is not None and time.monotonic() > deadline:
+                        logger.info(
+                            "DM file GC time budget exceeded; collected %s bytes"
+                            % collected
+                        )
+                        break
+            finally:
+                if hasattr(candidates, "close"):
+                    candidates.close()
+                self.collectionStrategy.finishCollection()
+                dm_metrics.GC_PASS_DURATION.observe(time.monotonic() - start)
+                dm_metrics.GC_PASS_BYTES.observe(collected)
+
+    def candidateBatches(self, candidates, used):
+        # A batch ends early once it holds enough to get under the threshold,
+        # assuming that everything before it was deleted. This avoids deleting
+        # up to a whole batch more than necessary.
+        batch = []
+        expected = 0
+        for c in candidates:
+            batch.append(c)
+            expected = expected + self.fileSize(c)
+            if len(batch) >= self.DELETE_BATCH_SIZE or self.shouldStopCollecting(
+                used, expected
+            ):
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def getSortedCandidates(self):
+        """
+        Returns the collection candidates in the order in which they should be
+        collected. If the sorting scheme can be expressed as a database sort, the
+        candidates are streamed from an indexed cursor, so that only as many items
+        are read as are needed to get under the threshold.
+        """
+        sort = self.collectionStrategy.sortSpec()
+        if sort is None:
+            candidates = self.getCollectionCandidates()
+            self.collectionStrategy.startCollection(
+                candidates, self.psInfo.totalSize(), time.time()
+            )
+            self.sortCandidates(candidates)
+            return candidates
+        return self.lockModel.getCollectionCandidates(
+            sort=sort, fields=self.collectionStrategy.fields()
         )
 
+    def reconcileUsedSpace(self):
+        interval = Setting().get(constants.PluginSettings.GC_RECONCILE_INTERVAL)
+        if self.psInfo.needsReconcile(interval):
+            logger.info("Reconciled DM used space: %s bytes", self.psInfo.reconcile())
+
+    def shouldCollect(self, used=None):
+        if used is None:
+            used = self.psInfo.sizeUsed()
+        return self.collectionStrategy.shouldCollect(self.psInfo.totalSize(), used)
+
     def fileSize(self, item):
         return item["size"]
 
     def sortCandidates(self, list):
-        list.sort(key=lambda x: self.collectionStrategy.itemSortKey(x))
+        self.collectionStrategy.sortCandidates(list)
 
     def shouldStopCollecting(self, initialUsed, collected):
         return self.collectionStrategy.shouldStopCollecting(
@@ -153,17 +273,33 @@ class PeriodicFileGC(FileGC):
         self.psInfo.updateInfo(used)
 
     def pause(self):
+        # a pass in progress stops after its current batch
+        self.interrupted = True
         with self.collectLock:
             self.paused = True
+            self.interrupted = False
 
     def resume(self):
         self.paused = False
 
 
 class CollectionStrategy:
-    def __init__(self, collectionThresholds, sortingScheme):
+    def __init__(self, collectionThresholds, sortingScheme=None):
+        # Without a sortingScheme, the one named by the dm.gc_sorting_scheme
+        # setting is used, so that it can be changed without a restart
         self.collectionThresholds = collectionThresholds
         self.sortingScheme = sortingScheme
+        self.configurable = sortingScheme is None
+        self.schemes = {}
+        self.selectSortingScheme()
+
+    def selectSortingScheme(self):
+        if not self.configurable:
+            return
+        name = Setting().get(constants.PluginSettings.GC_SORTING_SCHEME)
+        if name not in self.schemes:
+            self.schemes[name] = SORTING_SCHEMES[name]()
+        self.sortingScheme = self.schemes[name]
 
     def shouldCollect(self, totalSize, usedSize):
         return self.collectionThresholds.shouldCollect(totalSize, usedSize)
@@ -176,6 +312,24 @@ class CollectionStrategy:
     def itemSortKey(self, item):
         return self.sortingScheme.itemSortKey(item)
 
+    def sortSpec(self):
+        return self.sortingScheme.sortSpec()
+
+    def fields(self):
+        return self.sortingScheme.fields()
+
+    def startCollection(self, candidates, totalSize, now):
+        self.sortingScheme.startCollection(candidates, totalSize, now)
+
+    def sortCandidates(self, candidates):
+        self.sortingScheme.sortCandidates(candidates)
+
+    def itemCollected(self, item):
+        self.sortingScheme.itemCollected(item)
+
+    def finishCollection(self):
+        self.sortingScheme.finishCollection()
+
 
 class CollectionThresholds:
     def shouldCollect(self, totalSize, usedSize):
@@ -197,25 +351,3 @@ class FractionalCollectionThresholds(CollectionThresholds):
 
     def getCollectEndFraction(self):
         return Setting().get(constants.PluginSettings.GC_COLLECT_END_FRACTION)
-
-
-class CollectionSortingScheme:
-    def __init__(self):
-        pass
-
-    def itemSortKey(self, item):
-        raise NotImplementedError()
-
-
-class LRUSortingScheme(CollectionSortingScheme):
-    def __init__(self):
-        CollectionSortingScheme.__init__(self)
-
-    def itemSortKey(self, item):
-        if Lock.FIELD_LAST_UNLOCKED in item:
-            return item[Lock.FIELD_LAST_UNLOCKED]
-        else:
-            logger.warning(
-                "Item %s does not have a dm.lastUnlocked field." % item["_id"]
-            )
-            return BEGINNING_OF_TIME
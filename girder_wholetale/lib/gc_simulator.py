@@ -0,0 +1,239 @@
+"""
+Replays a trace of DM cache events against the file GC sorting schemes, to
+compare their hit ratios offline.
+
+Traces are the JSON lines written by the girder_wholetale.dm.trace logger
+(see models/lock.py), e.g.:
+
+    {"time": 1700000000.0, "event": "lock", "itemId": "..."}
+    {"time": 1700000042.5, "event": "downloaded", "itemId": "...", "size": 1024,
+     "transferTime": 0.3}
+    {"time": 1700000100.0, "event": "unlock", "itemId": "..."}
+
+Sizes and transfer times are taken from the "downloaded" events. Items that are
+never downloaded in the trace are ignored.
+
+Usage:
+
+    python -m girder_wholetale.lib.gc_simulator trace.jsonl --capacity 100G
+"""
+
+import argparse
+import json
+import sys
+
+from bson.timestamp import Timestamp
+
+from .gc_sorting import SORTING_SCHEMES
+
+
+class MemoryStateStore:
+    def __init__(self):
+        self.states = {}
+
+    def getState(self, name):
+        return self.states.get(name, {})
+
+    def setState(self, name, state):
+        self.states[name] = state
+
+
+class CacheSimulator:
+    """
+    A cache of the given capacity, collected like PeriodicFileGC does: every
+    runInterval seconds of trace time, if more than startFraction of the capacity
+    is used, unlocked items are collected in the order given by the sorting scheme
+    until no more than endFraction of the capacity is used.
+    """
+
+    def __init__(
+        self,
+        sortingScheme,
+        capacity,
+        startFraction=0.5,
+        endFraction=0.5,
+        runInterval=10 * 60,
+    ):
+        self.sortingScheme = sortingScheme
+        self.capacity = capacity
+        self.startFraction = startFraction
+        self.endFraction = endFraction
+        self.runInterval = runInterval
+        self.items = {}
+        self.used = 0
+        self.nextRun = None
+        self.stats = {
+            "requests": 0,
+            "hits": 0,
+            "requestedBytes": 0,
+            "hitBytes": 0,
+            "fetchTime": 0.0,
+            "evictions": 0,
+        }
+
+    def replay(self, events, files):
+        """
+        :param events: The lock and unlock events, in chronological order
+        :param files: A map from item id to a dict with the size and transferTime
+        """
+        for event in events:
+            info = files.get(event["itemId"])
+            if info is None:
+                continue
+            t = event["time"]
+            if self.nextRun is None:
+                self.nextRun = t + self.runInterval
+            while t >= self.nextRun:
+                self.collect(self.nextRun)
+                self.nextRun += self.runInterval
+            if event["event"] == "lock":
+                self.lock(event["itemId"], info)
+            elif event["event"] == "unlock":
+                self.unlock(event["itemId"], t)
+        return self.getStats()
+
+    def lock(self, itemId, info):
+        item = self.items.get(itemId)
+        if item is None:
+            item = {
+                "_id": itemId,
+                "size": info["size"],
+                "dm": {"cached": False, "lockCount": 0, "accessCount": 0},
+            }
+            self.items[itemId] = item
+        dm = item["dm"]
+        dm["lockCount"] += 1
+        dm["accessCount"] += 1
+        self.stats["requests"] += 1
+        self.stats["requestedBytes"] += item["size"]
+        if dm["cached"]:
+            self.stats["hits"] += 1
+            self.stats["hitBytes"] += item["size"]
+        else:
+            dm["cached"] = True
+            dm["transferTime"] = info.get("transferTime")
+            self.stats["fetchTime"] += info.get("transferTime") or 0.0
+            self.used += item["size"]
+
+    def unlock(self, itemId, t):
+        item = self.items.get(itemId)
+        if item is None or item["dm"]["lockCount"] == 0:
+            return
+        item["dm"]["lockCount"] -= 1
+        item["dm"]["lastUnlocked"] = Timestamp(int(t), 0)
+
+    def collect(self, now):
+        if self.used <= self.capacity * self.startFraction:
+            return
+        candidates = [
+            item
+            for item in self.items.values()
+            if item["dm"]["cached"] and item["dm"]["lockCount"] == 0
+        ]
+        self.sortingScheme.startCollection(candidates, self.capacity, now)
+        self.sortingScheme.sortCandidates(candidates)
+        for item in candidates:
+            if self.used <= self.capacity * self.endFraction:
+                break
+            item["dm"]["cached"] = False
+            self.used -= item["size"]
+            self.stats["evictions"] += 1
+            self.sortingScheme.itemCollected(item)
+        self.sortingScheme.finishCollection()
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats["hitRatio"] = stats["hits"] / max(stats["requests"], 1)
+        stats["byteHitRatio"] = stats["hitBytes"] / max(stats["requestedBytes"], 1)
+        return stats
+
+
+def readTrace(lines):
+    """
+    Splits a trace into the lock/unlock events and the known files.
+    """
+    events = []
+    files = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        event = json.loads(line)
+        if event["event"] == "downloaded":
+            files[event["itemId"]] = {
+                "size": event["size"],
+                "transferTime": event.get("transferTime"),
+            }
+        else:
+            events.append(event)
+    events.sort(key=lambda e: e["time"])
+    return events, files
+
+
+def compareSchemes(events, files, capacity, schemes=None, **kwargs):
+    """
+    Replays the trace once for every sorting scheme.
+
+    :return: A dict mapping scheme names to the statistics of the replay
+    """
+    results = {}
+    for name in schemes or sorted(SORTING_SCHEMES):
+        scheme = SORTING_SCHEMES[name](stateStore=MemoryStateStore())
+        simulator = CacheSimulator(scheme, capacity, **kwargs)
+        results[name] = simulator.replay(events, files)
+    return results
+
+
+def parseSize(value):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("trace", help="A trace file, or - for stdin")
+    parser.add_argument("--capacity", type=parseSize, required=True)
+    parser.add_argument("--start-fraction", type=float, default=0.5)
+    parser.add_argument("--end-fraction", type=float, default=0.5)
+    parser.add_argument("--run-interval", type=float, default=10 * 60)
+    parser.add_argument(
+        "--scheme", action="append", choices=sorted(SORTING_SCHEMES), dest="schemes"
+    )
+    args = parser.parse_args(argv)
+
+    if args.trace == "-":
+        events, files = readTrace(sys.stdin)
+    else:
+        with open(args.trace) as f:
+            events, files = readTrace(f)
+    results = compareSchemes(
+        events,
+        files,
+        args.capacity,
+        schemes=args.schemes,
+        startFraction=args.start_fraction,
+        endFraction=args.end_fraction,
+        runInterval=args.run_interval,
+    )
+    print(
+        "%-6s %10s %10s %10s %12s %10s"
+        % ("scheme", "requests", "hitRatio", "byteHit", "fetchTime", "evictions")
+    )
+    for name, stats in results.items():
+        print(
+            "%-6s %10d %10.4f %10.4f %12.1f %10d"
+            % (
+                name,
+                stats["requests"],
+                stats["hitRatio"],
+                stats["byteHitRatio"],
+                stats["fetchTime"],
+                stats["evictions"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import bisect
+import datetime
+import logging
+import time
+
+from bson.timestamp import Timestamp
+from girder.constants import SortDir
+
+from ..models.lock import Lock
+from ..models.psinfo import PSInfo
+
+BEGINNING_OF_TIME = datetime.datetime.fromtimestamp(0)
+logger = logging.getLogger(__name__)
+
+
+class CollectionSortingScheme:
+    """
+    Decides the order in which unlocked cached items are collected. Schemes that
+    need to remember something between collections (e.g., what was evicted) keep
+    it in a stateStore, which defaults to the psinfo document.
+    """
+
+    name = None
+
+    def __init__(self, stateStore=None):
+        self.stateStore = stateStore
+
+    def itemSortKey(self, item):
+        raise NotImplementedError()
+
+    def startCollection(self, candidates, totalSize, now):
+        # called with all the candidates before sortCandidates
+        pass
+
+    def sortCandidates(self, candidates):
+        candidates.sort(key=self.itemSortKey)
+
+    def itemCollected(self, item):
+        pass
+
+    def finishCollection(self):
+        pass
+
+    def loadState(self):
+        if self.stateStore is None:
+            self.stateStore = PSInfo()
+        return self.stateStore.getState(self.name)
+
+    def saveState(self, state):
+        self.stateStore.setState(self.name, state)
+
+    def sortSpec(self):
+        """
+        The database sort equivalent to itemSortKey, or None if the candidates
+        must be sorted in memory.
+        """
+        return None
+
+    def fields(self):
+        # the item fields needed to collect a candidate and compute its sort key
+        return ["_id", "size", "dm"]
+
+
+class LRUSortingScheme(CollectionSortingScheme):
+    name = "lru"
+
+    def __init__(self, stateStore=None):
+        CollectionSortingScheme.__init__(self, stateStore)
+
+    def sortSpec(self):
+        # items that were never unlocked sort first, as in itemSortKey
+        return [(Lock.FIELD_LAST_UNLOCKED, SortDir.ASCENDING)]
+
+    def itemSortKey(self, item):
+        if "lastUnlocked" in item.get("dm", {}):
+            return _lastUnlocked(item)
+        else:
+            logger.warning(
+                "Item %s does not have a dm.lastUnlocked field." % item["_id"]
+            )
+            return _seconds(BEGINNING_OF_TIME)
+
+
+def _seconds(value):
+    # dm.lastUnlocked is a BSON timestamp, but may be a date in older items
+    if value is None:
+        return 0
+    if isinstance(value, Timestamp):
+        return value.time
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
+
+
+def _lastUnlocked(item):
+    return _seconds(item.get("dm", {}).get("lastUnlocked"))
+
+
+def _accessCount(item):
+    return max(item.get("dm", {}).get("accessCount", 1), 1)
+
+
+class LFUSortingScheme(CollectionSortingScheme):
+    """
+    Least frequently used first. The access count of an item is halved for every
+    HALF_LIFE seconds since it was last unlocked, so that items that used to be
+    popular eventually make way for new ones.
+    """
+
+    name = "lfu"
+    HALF_LIFE = 7 * 24 * 60 * 60
+
+    def __init__(self, stateStore=None):
+        CollectionSortingScheme.__init__(self, stateStore)
+        self.now = time.time()
+
+    def startCollection(self, candidates, totalSize, now):
+        self.now = now
+
+    def itemSortKey(self, item):
+        lastUnlocked = _lastUnlocked(item)
+        age = max(self.now - lastUnlocked, 0)
+        return (_accessCount(item) * 0.5 ** (age / self.HALF_LIFE), lastUnlocked)
+
+
+class GDSFSortingScheme(CollectionSortingScheme):
+    """
+    GreedyDual-Size-Frequency. Items with the lowest
+
+        H = L + accessCount * cost / size
+
+    are collected first, where cost is the time it took to fetch the item plus a
+    fixed overhead, and L is the largest H collected so far at the time the item
+    was last unlocked. L ages items that are no longer used. Since items are only
+    looked at when collecting, L is recorded once per collection and looked up
+    by the time at which items were unlocked.
+    """
+
+    name = "gdsf"
+    # seconds; the cost of fetching any file, on top of the transfer itself
+    FETCH_OVERHEAD = 1.0
+    # bytes/s; used for items cached before transfer times were recorded
+    DEFAULT_BANDWIDTH = 10 * 1024 * 1024
+    MAX_HISTORY = 1000
+
+    def __init__(self, stateStore=None):
+        CollectionSortingScheme.__init__(self, stateStore)
+        self.history = []
+        self.inflation = 0.0
+        self.now = time.time()
+
+    def startCollection(self, candidates, totalSize, now):
+        self.history = self.loadState().get("history", [])
+        self.inflation = self.history[-1][1] if self.history else 0.0
+        self.now = now
+
+    def inflationAt(self, t):
+        i = bisect.bisect_right(self.history, [t, float("inf")])
+        return self.history[i - 1][1] if i > 0 else 0.0
+
+    def cost(self, item):
+        transferTime = item.get("dm", {}).get("transferTime")
+        if transferTime is None:
+            transferTime = item.get("size", 0) / self.DEFAULT_BANDWIDTH
+        return self.FETCH_OVERHEAD + transferTime
+
+    def itemSortKey(self, item):
+        size = max(item.get("size", 0), 1)
+        return (
+            self.inflationAt(_lastUnlocked(item))
+            + _accessCount(item) * self.cost(item) / size
+        )
+
+    def itemCollected(self, item):
+        self.inflation = max(self.inflation, self.itemSortKey(item))
+
+    def finishCollection(self):
+        if not self.history or self.inflation > self.history[-1][1]:
+            self.history.append([self.now, self.inflation])
+            self.saveState({"history": self.history[-self.MAX_HISTORY :]})
+
+
+class ARCSortingScheme(CollectionSortingScheme):
+    """
+    An adaptation of the Adaptive Replacement Cache to a periodic collector.
+    Items accessed once (T1) and items accessed more than once (T2) are kept in
+    separate LRU lists. T1 items are collected first while they occupy more
+    than a target number of bytes, p. Evicted items are remembered (B1 and B2,
+    depending on the list they came from); finding one of them cached again means
+    it should not have been evicted, and moves p in favour of its list.
+    """
+
+    name = "arc"
+    MAX_GHOSTS = 10000
+
+    def __init__(self, stateStore=None):
+        CollectionSortingScheme.__init__(self, stateStore)
+        self.target = 0
+        self.ghosts = {}
+
+    def isFrequent(self, item):
+        return _accessCount(item) > 1
+
+    def startCollection(self, candidates, totalSize, now):
+        state = self.loadState()
+        self.target = state.get("target", 0)
+        self.ghosts = state.get("ghosts", {})
+        recent = sum(1 for ghost in self.ghosts.values() if ghost == "b1")
+        frequent = len(self.ghosts) - recent
+        for item in candidates:
+            ghost = self.ghosts.pop(str(item["_id"]), None)
+            size = item.get("size", 0)
+            if ghost == "b1":
+                step = max(frequent / max(recent, 1), 1) * size
+                self.target = min(self.target + step, totalSize)
+                recent -= 1
+            elif ghost == "b2":
+                step = max(recent / max(frequent, 1), 1) * size
+                self.target = max(self.target - step, 0)
+                frequent -= 1
+
+    def sortCandidates(self, candidates):
+        recent = sorted(
+            (c for c in candidates if not self.isFrequent(c)), key=_lastUnlocked
+        )
+        frequent = sorted(
+            (c for c in candidates if self.isFrequent(c)), key=_lastUnlocked
+        )
+        recentSize = sum(c.get("size", 0) for c in recent)
+        ordered = []
+        i = j = 0
+        while i < len(recent) or j < len(frequent):
+            if i < len(recent) and (recentSize > self.target or j == len(frequent)):
+                recentSize -= recent[i].get("size", 0)
+                ordered.append(recent[i])
+                i += 1
+            else:
+                ordered.append(frequent[j])
+                j += 1
+        candidates[:] = ordered
+
+    def itemSortKey(self, item):
+        return (self.isFrequent(item), _lastUnlocked(item))
+
+    def itemCollected(self, item):
+        self.ghosts[str(item["_id"])] = "b2" if self.isFrequent(item) else "b1"
+
+    def finishCollection(self):
+        ghosts = list(self.ghosts.items())[-self.MAX_GHOSTS :]
+        self.saveState({"target": self.target, "ghosts": dict(ghosts)})
+
+
+SORTING_SCHEMES = {
+    scheme.name: scheme
+    for scheme in (
+        LRUSortingScheme,
+        LFUSortingScheme,
+        GDSFSortingScheme,
+        ARCSortingScheme,
+    )
+}
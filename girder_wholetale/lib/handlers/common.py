@@ -1,12 +1,23 @@
 import hashlib
+import logging
 import os
 
-from girder.constants import AccessType
-from girder.models.item import Item
-
-from .. import Verificators
+from .. import Verificators, dm_metrics
 from ..tm_utils import TransferException, TransferHandler
 
+logger = logging.getLogger(__name__)
+
+
+def hashName(alg):
+    """
+    Maps a checksum algorithm as recorded by providers (e.g., "MD5", "SHA-256")
+    to a hashlib name, or None if hashlib does not support it (e.g., "UNF").
+    """
+    name = alg.lower().replace("-", "")
+    if name in hashlib.algorithms_available:
+        return name
+    return None
+
 
 class UrlTransferHandler(TransferHandler):
     _headers = None
@@ -36,50 +47,98 @@ class UrlTransferHandler(TransferHandler):
         except OSError:
             pass
 
-    def verify_checksum(self):
-        item = Item().load(self.itemId, user=self.user, level=AccessType.READ)
-        if checksums := item.get("meta", {}).get("checksum"):
-            alg, value = list(checksums.items())[0]  # Get just one
-            h = hashlib.new(alg.lower())
-
-            with open(self.psPath, "rb") as fp:
-                while True:
-                    data = fp.read(2**22)  # 4MB chunks
-                    if not data:
-                        break
+    def createHashers(self):
+        """
+        Returns a hasher for every supported algorithm in the item's checksums.
+        """
+        hashers = {}
+        for alg in self.item.get("meta", {}).get("checksum") or {}:
+            name = hashName(alg)
+            if name is None:
+                logger.info("Cannot verify %s checksum for item %s", alg, self.itemId)
+            else:
+                hashers[alg] = hashlib.new(name)
+        return hashers
+
+    def hashPartFile(self, hashers, size=None):
+        # Feeds the first size bytes (or all) of the partial file to hashers
+        remaining = size
+        with open(self.partPath, "rb") as fp:
+            while remaining is None or remaining > 0:
+                n = 2**22 if remaining is None else min(2**22, remaining)
+                data = fp.read(n)  # 4MB chunks
+                if not data:
+                    break
+                for h in hashers.values():
                     h.update(data)
-            if h.hexdigest() != value:
-                os.remove(self.psPath)
+                if remaining is not None:
+                    remaining -= len(data)
+
+    def verify_checksum(self, hashers=None):
+        """
+        Compares the item's checksums with hashers fed during the transfer. If no
+        hashers are given, the downloaded file is read back to compute them.
+        """
+        if hashers is None:
+            hashers = self.createHashers()
+            if hashers:
+                self.hashPartFile(hashers)
+        checksums = self.item.get("meta", {}).get("checksum") or {}
+        for alg, h in hashers.items():
+            if h.hexdigest() != checksums[alg].lower():
+                dm_metrics.CHECKSUM_FAILURES.inc()
+                self.discardPartFile()
                 raise TransferException(
                     message=f"Checksum verification failed for item:{self.itemId}",
                     fatal=True,
                 )
+            self.verifiedChecksums[hashName(alg)] = h.hexdigest()
 
 
 class FileLikeUrlTransferHandler(UrlTransferHandler):
     BUFSZ = 32768
+    offset = 0
 
     def __init__(self, url, transferId, itemId, psPath, user, transferManager):
         UrlTransferHandler.__init__(
             self, url, transferId, itemId, psPath, user, transferManager
         )
+        self.hashers = {}
 
     def transfer(self):
-        self.transferManager.transferProgress(self.transferId, self.flen, 0)
-        self.mkdirs()
-        with open(self.psPath, "wb") as outf, self.openInputStream() as inf:
-            self.transferBytes(outf, inf)
-        self.verify_checksum()
+        self.offset = self.getResumeOffset()
+        # openInputStream() resets self.offset if the source cannot be resumed
+        with self.openInputStream() as inf:
+            self.transferManager.transferProgress(
+                self.transferId, self.flen, self.offset, offset=self.offset
+            )
+            self.hashers = self.createHashers()
+            if self.offset and self.hashers:
+                # only the already transferred prefix needs to be read back
+                self.hashPartFile(self.hashers, self.offset)
+            with self.openPartFile(self.offset) as outf:
+                self.transferBytes(outf, inf)
+        self.verify_checksum(self.hashers)
+        self.commitPartFile()
 
     def openInputStream(self):
+        """
+        Returns a file-like object positioned at self.offset. Implementations that
+        cannot start reading at an arbitrary position must set self.offset to 0.
+        """
         raise NotImplementedError()
 
     def transferBytes(self, outf, inf):
-        crt = 0
+        crt = self.offset
+        hashers = list(self.hashers.values())
         while True:
             buf = inf.read(FileLikeUrlTransferHandler.BUFSZ)
             if not buf:
                 break
             outf.write(buf)
+            for h in hashers:
+                h.update(buf)
             crt = crt + len(buf)
-            self.updateTransferProgress(self.flen, crt)
+            outf.flush()
+            self.rangeWritten(crt - len(buf), crt)
+            self.updateTransferProgress(self.flen, crt, offset=crt)
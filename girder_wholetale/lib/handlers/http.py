@@ -1,17 +1,147 @@
 import functools
+import threading
 import urllib
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import httpio
 import requests
+from girder.models.setting import Setting
 
+from ...constants import PluginSettings
+from .. import http_session
+from ..tm_utils import TransferException
 from .common import FileLikeUrlTransferHandler
 
 
 class Http(FileLikeUrlTransferHandler):
+    # files smaller than this are always fetched over a single connection
+    SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+
+    def transfer(self):
+        # interrupted transfers are resumed over a single stream
+        segments = self.getSegmentCount() if self.getResumeOffset() == 0 else 1
+        if segments > 1:
+            self.transferSegmented(segments)
+        else:
+            FileLikeUrlTransferHandler.transfer(self)
+
+    def isZipMember(self):
+        parsed = urllib.parse.urlparse(self.url)
+        return bool(parsed.path and parsed.path.endswith(".zip") and parsed.query)
+
+    def getSegmentCount(self):
+        """
+        Returns the number of byte ranges the file should be fetched in. Anything
+        other than a plain, uncompressed resource served with "Accept-Ranges: bytes"
+        and a matching length is fetched over a single stream.
+        """
+        segments = Setting().get(PluginSettings.TRANSFER_SEGMENTS) or 1
+        if segments <= 1 or self.flen < Http.SEGMENT_MIN_SIZE or self.isZipMember():
+            return 1
+        try:
+            resp = http_session.head(self.url, headers=self.headers, allow_redirects=True)
+            resp.raise_for_status()
+        except requests.RequestException:
+            return 1
+        if resp.headers.get("Accept-Ranges", "").lower() != "bytes":
+            return 1
+        if resp.headers.get("Content-Encoding") not in (None, "identity"):
+            return 1
+        if int(resp.headers.get("Content-Length", -1)) != self.flen:
+            return 1
+        return min(segments, -(-self.flen // Http.SEGMENT_MIN_SIZE))
+
+    def splitRanges(self, segments):
+        step = -(-self.flen // segments)
+        return [
+            (start, min(start + step, self.flen) - 1)
+            for start in range(0, self.flen, step)
+        ]
+
+    def transferSegmented(self, segments):
+        # ranges complete out of order, so no resume offset is ever recorded
+        self.transferManager.transferProgress(self.transferId, self.flen, 0, offset=0)
+        with self.openPartFile(0) as outf:
+            outf.truncate(self.flen)
+
+        self._transferred = 0
+        self._progressLock = threading.Lock()
+        self._abort = threading.Event()
+        ranges = self.splitRanges(segments)
+        with ThreadPoolExecutor(
+            max_workers=len(ranges), thread_name_prefix="TransferSegment"
+        ) as pool:
+            futures = [pool.submit(self.transferRange, *r) for r in ranges]
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                self._abort.set()
+                raise
+        self.verify_checksum()
+        self.commitPartFile()
+
+    def transferRange(self, start, end):
+        headers = dict(self.headers)
+        headers["Range"] = "bytes=%s-%s" % (start, end)
+        with http_session.get(self.url, stream=True, headers=headers) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise TransferException(
+                    message="Server ignored range request for %s" % self.url,
+                    fatal=False,
+                )
+            with open(self.partPath, "r+b") as outf:
+                outf.seek(start)
+                remaining = end - start + 1
+                while remaining > 0 and not self._abort.is_set():
+                    buf = resp.raw.read(min(FileLikeUrlTransferHandler.BUFSZ, remaining))
+                    if not buf:
+                        break
+                    outf.write(buf)
+                    outf.flush()
+                    self.rangeWritten(end + 1 - remaining, end + 1 - remaining + len(buf))
+                    remaining -= len(buf)
+                    with self._progressLock:
+                        self._transferred += len(buf)
+                        self.updateTransferProgress(self.flen, self._transferred)
+        if remaining > 0 and not self._abort.is_set():
+            raise TransferException(
+                message="Short read for bytes %s-%s of %s" % (start, end, self.url),
+                fatal=False,
+            )
+
+    def fetchRange(self, start, end):
+        if self.isZipMember():
+            return False
+        headers = dict(self.headers)
+        headers["Range"] = "bytes=%s-%s" % (start, end - 1)
+        with http_session.get(self.url, stream=True, headers=headers) as resp:
+            if resp.status_code != 206 or resp.headers.get("Content-Encoding") not in (
+                None,
+                "identity",
+            ):
+                return False
+            try:
+                outf = open(self.partPath, "r+b")
+            except FileNotFoundError:
+                return False
+            with outf:
+                outf.seek(start)
+                while start < end:
+                    buf = resp.raw.read(min(FileLikeUrlTransferHandler.BUFSZ, end - start))
+                    if not buf:
+                        return False
+                    outf.write(buf)
+                    outf.flush()
+                    self.rangeWritten(start, start + len(buf))
+                    start += len(buf)
+        return True
+
     def openInputStream(self):
         parsed = urllib.parse.urlparse(self.url)
-        if parsed.path and parsed.path.endswith(".zip") and parsed.query:
+        if self.isZipMember():
             qs = urllib.parse.parse_qs(parsed.query)
             path = qs["path"][0]
             fp = httpio.open(
@@ -22,11 +152,24 @@ class Http(FileLikeUrlTransferHandler):
             )
             zf = zipfile.ZipFile(fp)
             try:
-                return zipfile.Path(zf, path).open(mode="rb")
+                inf = zipfile.Path(zf, path).open(mode="rb")
             except ValueError:
-                return zipfile.Path(zf, path).open()
+                inf = zipfile.Path(zf, path).open()
+            inf.seek(self.offset)
+            return inf
         else:
-            resp = requests.get(self.url, stream=True, headers=self.headers)
+            headers = dict(self.headers)
+            if self.offset:
+                headers["Range"] = "bytes=%s-" % self.offset
+            resp = http_session.get(self.url, stream=True, headers=headers)
+            if self.offset and (
+                resp.status_code != 206
+                or resp.headers.get("Content-Encoding") not in (None, "identity")
+            ):
+                # range ignored, or applied to the encoded stream; start over
+                resp.close()
+                self.offset = 0
+                return self.openInputStream()
             if resp.headers.get("Content-Encoding") in ("gzip",):
                 resp.raw.read = functools.partial(resp.raw.read, decode_content=True)
             resp.raise_for_status()  # Throw an exception in case transfer failed
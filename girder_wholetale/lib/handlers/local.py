@@ -11,4 +11,6 @@ class Local(FileLikeUrlTransferHandler):
 
     def openInputStream(self):
         parsedUrl = urlparse(self.url)
-        return open(parsedUrl.path, "rb")
+        inf = open(parsedUrl.path, "rb")
+        inf.seek(self.offset)
+        return inf
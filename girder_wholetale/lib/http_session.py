@@ -0,0 +1,103 @@
+"""
+A requests session shared by the import providers and the transfer handlers.
+
+Connections are kept alive in a pool per host, so registering or transferring
+many files from the same repository reuses them instead of doing a TCP and TLS
+handshake for each request. Idempotent requests are retried with exponential
+backoff on connection errors and on 429/5xx responses. Requests get a default
+(connect, read) timeout, which can be overridden per call.
+
+The pool size, retries and timeouts come from the wholetale.http_* settings.
+The session is created on first use and rebuilt when one of them changes.
+"""
+
+import http.cookiejar
+import threading
+
+import requests
+from girder.models.setting import Setting
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..constants import PluginSettings
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+SETTINGS = (
+    PluginSettings.HTTP_POOL_CONNECTIONS,
+    PluginSettings.HTTP_POOL_MAXSIZE,
+    PluginSettings.HTTP_RETRIES,
+    PluginSettings.HTTP_BACKOFF_FACTOR,
+    PluginSettings.HTTP_CONNECT_TIMEOUT,
+    PluginSettings.HTTP_READ_TIMEOUT,
+)
+
+
+class PooledSession(requests.Session):
+    def __init__(self, poolConnections, poolMaxsize, retries, backoffFactor, timeout):
+        super().__init__()
+        self.timeout = timeout
+        # the session is shared by all users, so it must not keep cookies
+        self.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoffFactor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(("HEAD", "GET", "OPTIONS")),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=poolConnections, pool_maxsize=poolMaxsize, max_retries=retry
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+_session = None
+_lock = threading.Lock()
+
+
+def getSession():
+    global _session
+    with _lock:
+        if _session is None:
+            values = [Setting().get(key) for key in SETTINGS]
+            poolConnections, poolMaxsize, retries, backoffFactor = values[:4]
+            _session = PooledSession(
+                poolConnections, poolMaxsize, retries, backoffFactor, tuple(values[4:])
+            )
+        return _session
+
+
+def resetSession():
+    """
+    Drops the shared session, closing its pooled connections once the requests
+    using them are done. The next request creates a new one.
+    """
+    global _session
+    with _lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+
+def settingChanged(event):
+    if event.info.get("key") in SETTINGS:
+        resetSession()
+
+
+def request(method, url, **kwargs):
+    return getSession().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return getSession().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    return getSession().head(url, **kwargs)
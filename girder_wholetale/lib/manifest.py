@@ -1,8 +1,15 @@
+import collections
+import copy
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 from urllib.parse import quote
 
+from bson import ObjectId
+from bson.errors import InvalidId
 from girder import events
 from girder.models.folder import Folder
 from girder.models.item import Item
@@ -25,6 +32,87 @@ from ..models.image import Image
 
 logger = logging.getLogger(__name__)
 
+
+class SectionCache:
+    """A small LRU cache for the parts of manifests that are costly to compute."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+# root -> {relative dir path: (st_ino, st_mtime_ns, file names, subdir names)}
+_trees = SectionCache(64)
+# fingerprint of the dataSet -> (external objects, dataset identifiers)
+_datasets = SectionCache(256)
+# fingerprint of the build files and environment -> "schema:hasPart" section
+_images = SectionCache(256)
+
+# Directories modified this recently (ns) when they are listed are listed again
+# next time: a later change could happen within the mtime granularity.
+RACY_MTIME = 2 * 10**9
+
+
+def list_tree(root):
+    """
+    Lists the paths of the files under root, relative to it and in os.walk order.
+    The listings of the directories are cached, and only the directories whose
+    inode or mtime changed since the previous call are listed again, since
+    adding, removing or renaming an entry changes the mtime of its directory.
+    """
+    root = root.rstrip("/") or "/"
+    old = _trees.get(root) or {}
+    new = {}
+    files = []
+    now = time.time_ns()
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        path = os.path.join(root, rel) if rel else root
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entry = old.get(rel)
+        if entry is None or entry[:2] != (st.st_ino, st.st_mtime_ns):
+            names, subdirs = [], []
+            try:
+                with os.scandir(path) as it:
+                    for dir_entry in it:
+                        try:
+                            is_dir = dir_entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if not is_dir:
+                            names.append(dir_entry.name)
+                        elif not dir_entry.is_symlink():
+                            # like os.walk, symlinks to directories are skipped
+                            subdirs.append(dir_entry.name)
+            except OSError:
+                continue
+            entry = (st.st_ino, st.st_mtime_ns, names, subdirs)
+        if now - st.st_mtime_ns > RACY_MTIME:
+            new[rel] = entry
+        files.extend(os.path.join(rel, name) for name in entry[2])
+        stack.extend(os.path.join(rel, name) for name in reversed(entry[3]))
+    _trees.put(root, new)
+    return files
+
+
 class Manifest:
     """
     Class that represents the manifest file.
@@ -153,6 +241,46 @@ class Manifest:
         }
 
     def create_image_info(self):
+        key = self._image_fingerprint()
+        info = _images.get(key)
+        if info is None:
+            info = self._create_image_info()
+            _images.put(key, info)
+        return copy.deepcopy(info)
+
+    def _image_fingerprint(self):
+        """
+        The image tag depends on the environment of the Tale and on the build
+        files in its workspace: the files at its root and the extra_build_files.
+        """
+        workspace_rootpath = self._workspace_rootpath()
+        config = self.tale.get("config") or {}
+        extra = [path.strip("/") for path in config.get("extra_build_files", [])]
+        build_files = []
+        for path in list_tree(workspace_rootpath):
+            if "**" in extra or "/" not in path or any(
+                path == e or path.startswith(e + "/") for e in extra
+            ):
+                try:
+                    st = os.stat(os.path.join(workspace_rootpath, path))
+                except OSError:
+                    continue
+                build_files.append((path, st.st_ino, st.st_size, st.st_mtime_ns))
+        fingerprint = json.dumps(
+            [
+                str(self.tale.get("_id")),
+                str(self.tale.get("imageId")),
+                str(self.tale.get("updated")),
+                config,
+                workspace_rootpath,
+                build_files,
+            ],
+            cls=JsonEncoder,
+            sort_keys=True,
+        )
+        return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+    def _create_image_info(self):
         # TODO: We shouldn't be publishing a Tale that was never built...
         token = Token().createToken(user=self.user, days=0.25)
         girder_client = GirderClient(
@@ -273,35 +401,30 @@ class Manifest:
                     if alg in checksum:
                         return f"{alg}:{checksum[alg]}"
 
+    def _workspace_rootpath(self):
+        if str(self.tale["workspaceId"]).startswith("wtlocal:"):
+            workspace_rootpath, _ = VirtualObject.path_from_id(self.tale["workspaceId"])
+            return workspace_rootpath.as_posix()
+        workspace = Folder().load(
+            self.tale["workspaceId"], user=self.user, level=AccessType.READ, exc=True
+        )
+        return workspace["fsPath"]
+
     def add_tale_records(self):
         """
         Creates and adds file records to the internal manifest object for an entire Tale.
         """
 
         # Handle the files in the workspace
-        if str(self.tale["workspaceId"]).startswith("wtlocal:"):
-            workspace_rootpath, _ = VirtualObject.path_from_id(self.tale["workspaceId"])
-            workspace_rootpath = workspace_rootpath.as_posix()
-        else:
-            workspace = Folder().load(
-                self.tale["workspaceId"], user=self.user, level=AccessType.READ, exc=True
-            )
-            workspace_rootpath = workspace["fsPath"]
-
-        if not workspace_rootpath.endswith("/"):
-            workspace_rootpath += "/"
-
-        for curdir, _, files in os.walk(workspace_rootpath):
-            for fname in files:
-                wfile = os.path.join(curdir, fname).replace(workspace_rootpath, "")
-                self.manifest['aggregates'].append({'uri': './workspace/' + wfile})
+        for wfile in list_tree(self._workspace_rootpath()):
+            self.manifest['aggregates'].append({'uri': './workspace/' + wfile})
 
         """
         Handle objects that are in the dataSet, ie files that point to external sources.
         Some of these sources may be datasets from publishers. We need to save information
         about the source so that they can added to the wt:usesDataset section.
         """
-        external_objects, dataset_top_identifiers = self._parse_dataSet()
+        external_objects, dataset_top_identifiers = self._parse_tale_dataSet()
 
         # Add records of all top-level dataset identifiers that were used in the Tale:
         # "wt:usesDataset"
@@ -328,22 +451,16 @@ class Manifest:
         # Add records for files in each recorded_run
         for run in Folder().find({'parentId': self.tale['runsRootId'], 'parentCollection': 'folder',
                                   'runVersionId': self.version['_id']}):
-            run_rootpath = run["fsPath"]
-            if not run_rootpath.endswith("/"):
-                run_rootpath += "/"
-            run_rootpath += "/workspace/"
-
-            for curdir, _, files in os.walk(run_rootpath):
-                for fname in files:
-                    rfile = os.path.join(curdir, fname).replace(run_rootpath, run['name'] + "/")
-                    rinfo = {
-                        'uri': './runs/' + rfile,
-                        'wt:isPartOfRun': (
-                            "https://data.wholetale.org/api/v1/"
-                            f"folder/{run['_id']}"
-                        )
-                    }
-                    self.manifest['aggregates'].append(rinfo)
+            run_rootpath = os.path.join(run["fsPath"], "workspace")
+            for rfile in list_tree(run_rootpath):
+                rinfo = {
+                    'uri': './runs/' + run['name'] + "/" + rfile,
+                    'wt:isPartOfRun': (
+                        "https://data.wholetale.org/api/v1/"
+                        f"folder/{run['_id']}"
+                    )
+                }
+                self.manifest['aggregates'].append(rinfo)
 
     def _expand_folder_into_items(self, folder, user, relpath=''):
         """
@@ -380,6 +497,77 @@ class Manifest:
         except NotImplementedError:
             pass
 
+    def _dataSet_fingerprint(self):
+        """
+        Identifies the dataSet of the Tale as seen by the user: its entries and
+        the contents of its folders, when the items and folders were last updated,
+        their sizes and their checksums. Checksums are stored by the exporters
+        without updating the items.
+        """
+        dataSet = self.tale['dataSet']
+        ids = collections.defaultdict(list)
+        try:
+            for obj in dataSet:
+                ids[obj['_modelType']].append(ObjectId(obj['itemId']))
+        except (KeyError, TypeError, InvalidId):
+            return None  # not cached, _parse_dataSet reports what is wrong
+        fields = ['updated', 'size', 'meta.checksum']
+        updated = []
+
+        def describe(docs):
+            updated.extend(
+                (
+                    str(doc['_id']),
+                    str(doc.get('updated')),
+                    doc.get('size'),
+                    doc.get('meta', {}).get('checksum'),
+                )
+                for doc in docs
+            )
+
+        for model_type, object_ids in sorted(ids.items()):
+            describe(
+                ModelImporter.model(model_type).find(
+                    {'_id': {'$in': object_ids}}, fields=fields
+                )
+            )
+        # folders are listed or expanded, so what they contain matters too
+        parents = ids.get('folder', [])
+        while parents:
+            describe(Item().find({'folderId': {'$in': parents}}, fields=fields))
+            folders = list(
+                Folder().find(
+                    {'parentId': {'$in': parents}, 'parentCollection': 'folder'},
+                    fields=fields,
+                )
+            )
+            describe(folders)
+            parents = [folder['_id'] for folder in folders]
+        fingerprint = json.dumps(
+            [
+                str(self.user and self.user['_id']),
+                self.expand_folders,
+                dataSet,
+                sorted(updated),
+            ],
+            cls=JsonEncoder,
+            sort_keys=True,
+        )
+        return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+    def _parse_tale_dataSet(self):
+        """
+        _parse_dataSet for the dataSet of the Tale, reusing the result computed
+        for an earlier manifest if the dataSet did not change.
+        """
+        key = self._dataSet_fingerprint()
+        parsed = None if key is None else _datasets.get(key)
+        if parsed is None:
+            parsed = self._parse_dataSet()
+            if key is not None:
+                _datasets.put(key, parsed)
+        return parsed
+
     def _parse_dataSet(self, dataSet=None, relpath=''):
         """
         Get the basic info about the contents of `dataSet`
@@ -3,7 +3,6 @@ import functools
 import os
 import pathlib
 import re
-import requests
 import tempfile
 from typing import Generator
 from urllib.parse import urlparse, urlunparse, parse_qs
@@ -12,6 +11,7 @@ import zipfile
 from girder.models.assetstore import Assetstore
 from girder.utility import assetstore_utilities
 
+from .. import http_session
 from ..import_providers import ImportProvider
 from ..bdbag.bdbag_provider import _FileTree
 from ..data_map import DataMap
@@ -36,7 +36,7 @@ class OpenICPSRImportProvider(ImportProvider):
         return False
 
     def _get_landing_page(self, url):
-        r = requests.get(url)
+        r = http_session.get(url)
         soup = BeautifulSoup(r.text, "html.parser")
         # metadata = json.loads(soup.find("script", {"type": "application/ld+json"}).text.strip())
         doi = (
@@ -132,7 +132,7 @@ class OpenICPSRImportProvider(ImportProvider):
         adapter = assetstore_utilities.getAssetstoreAdapter(assetstore)
         tempDir = adapter.tempDir
 
-        resp = requests.get(
+        resp = http_session.get(
             data_url, cookies={"JSESSIONID": self._get_user_pass(user)}, stream=True
         )
         if resp.headers.get("Content-Encoding") in ("gzip",):
@@ -1,9 +1,188 @@
+import errno
+import hashlib
+import os
+import shutil
+import urllib.parse
+
 from girder.models.setting import Setting
 from .. import constants
 
 
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21}
+
+
+def normalizeUrl(url):
+    """
+    Normalizes the spellings of a URL that fetch the same data: the scheme and
+    host are lowercased, and default ports, empty paths and fragments dropped.
+    """
+    parsed = urllib.parse.urlsplit(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or "").lower()
+    if ":" in netloc:
+        netloc = "[%s]" % netloc
+    if parsed.username is not None:
+        userinfo = parsed.username
+        if parsed.password is not None:
+            userinfo += ":" + parsed.password
+        netloc = userinfo + "@" + netloc
+    try:
+        port = parsed.port
+    except ValueError:
+        port = None
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc += ":%d" % port
+    return urllib.parse.urlunsplit((scheme, netloc, parsed.path or "/", parsed.query, ""))
+
+
 class PathMapper:
     def getPSPath(self, itemId):
         root = Setting().get(constants.PluginSettings.PRIVATE_STORAGE_PATH)
         sItemId = str(itemId)
         return root + "/" + sItemId[0] + "/" + sItemId[1] + "/" + sItemId
+
+    def getContentKey(self, item, url=None):
+        # None means that the item is stored on its own
+        return None
+
+    def linkContent(self, itemId, key):
+        return False
+
+    def publishContent(self, itemId, key):
+        return False
+
+    def isVerified(self, key, checksums):
+        return False
+
+    def linkFile(self, path, itemId):
+        """
+        Gives an item the data of a file stored at path, as a hard link when
+        possible and as a copy otherwise.
+
+        :return: True if the item shares the space of the file
+        """
+        dst = self.getPSPath(itemId)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = dst + ".link"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(path, tmp)
+            shared = True
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+            shutil.copyfile(path, tmp)
+            shared = False
+        os.replace(tmp, dst)
+        return shared
+
+    def removeFile(self, item):
+        """
+        Removes the cached file of an item.
+
+        :return: True if the space used by the file was freed
+        """
+        path = self.getPSPath(item["_id"])
+        # hard links made by linkFile hold the space until the last one goes
+        links = os.stat(path).st_nlink
+        os.remove(path)
+        return links <= 1
+
+
+class ContentAddressedPathMapper(PathMapper):
+    """
+    When the dm.content_addressed_storage setting is on, each distinct content
+    is stored once under <root>/content, keyed by the item checksum, or by the
+    URL it is fetched from. Item paths are hard links to it, so the link count
+    of a content file is its reference count: the content file is removed along
+    with the last item path that links to it.
+    """
+
+    # strongest first
+    CHECKSUM_ALGORITHMS = ("sha512", "sha256", "sha1", "md5")
+
+    def isEnabled(self):
+        return Setting().get(constants.PluginSettings.CONTENT_ADDRESSED_STORAGE)
+
+    def getContentKey(self, item, url=None):
+        if not self.isEnabled():
+            return None
+        checksums = {
+            alg.lower().replace("-", ""): value
+            for alg, value in item.get("meta", {}).get("checksum", {}).items()
+        }
+        for alg in ContentAddressedPathMapper.CHECKSUM_ALGORITHMS:
+            if checksums.get(alg):
+                return "%s/%s" % (alg, checksums[alg].lower())
+        if url:
+            url = normalizeUrl(url)
+            return "url/%s" % hashlib.sha256(url.encode("utf8")).hexdigest()
+        return None
+
+    def isVerified(self, key, checksums):
+        """
+        Tells whether data with the given verified checksums (hashlib name -> hex
+        digest) can be published under key. Checksum keys come from item metadata,
+        which users can set, so they need the data to have been checked against them.
+        """
+        kind, digest = key.split("/")
+        return kind == "url" or checksums.get(kind) == digest
+
+    def getContentPath(self, key):
+        root = Setting().get(constants.PluginSettings.PRIVATE_STORAGE_PATH)
+        kind, digest = key.split("/")
+        return "/".join((root, "content", kind, digest[:2], digest))
+
+    def _link(self, src, dst):
+        # atomically replaces dst, if it exists
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = dst + ".link"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(src, tmp)
+        os.replace(tmp, dst)
+
+    def linkContent(self, itemId, key):
+        """
+        Makes the path of an item a link to existing content.
+
+        :return: False if there is no such content
+        """
+        try:
+            self._link(self.getContentPath(key), self.getPSPath(itemId))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def publishContent(self, itemId, key):
+        """
+        Adds a freshly downloaded item file to the store. If the content was
+        already there, the item path is replaced by a link to it.
+
+        :return: True if the item shares content stored earlier
+        """
+        path = self.getPSPath(itemId)
+        contentPath = self.getContentPath(key)
+        os.makedirs(os.path.dirname(contentPath), exist_ok=True)
+        try:
+            os.link(path, contentPath)
+            return False
+        except FileExistsError:
+            self._link(contentPath, path)
+            return True
+
+    def removeFile(self, item):
+        key = item.get("dm", {}).get("contentKey")
+        if key is None:
+            return PathMapper.removeFile(self, item)
+        os.remove(self.getPSPath(item["_id"]))
+        contentPath = self.getContentPath(key)
+        try:
+            if os.stat(contentPath).st_nlink > 1:
+                # other items still link to it
+                return False
+            os.remove(contentPath)
+        except FileNotFoundError:
+            pass
+        return True
@@ -0,0 +1,96 @@
+from bson import objectid
+from girder.models.setting import Setting
+from girder.utility.model_importer import ModelImporter
+
+from .. import constants
+from ..models.lock import Lock
+from ..models.psinfo import PSInfo
+from .tm_utils import Models
+
+
+class PrefetchPolicy:
+    """
+    Picks the items of a new session that should be transferred before anyone
+    opens them. Prefetching is off unless dm.prefetch_budget is set.
+    """
+
+    def getBudget(self):
+        """
+        Returns the number of bytes that can be prefetched. Prefetched files are
+        not locked, so the budget never takes the used space past the point at
+        which the GC starts collecting. Transfers that have not completed yet,
+        including earlier prefetches, count as used.
+        """
+        budget = Setting().get(constants.PluginSettings.PREFETCH_BUDGET) or 0
+        if budget <= 0:
+            return 0
+        psInfo = PSInfo()
+        start = Setting().get(constants.PluginSettings.GC_COLLECT_START_FRACTION)
+        used = psInfo.sizeUsed() + Lock().getDownloadingSize()
+        free = psInfo.totalSize() * start - used
+        return max(0, min(budget, int(free)))
+
+    def selectItems(self, session, budget):
+        return []
+
+
+class DataSetPrefetchPolicy(PrefetchPolicy):
+    """
+    Prefetches the items in the dataSet of a session, including the contents of
+    folders, the most frequently locked first. Access counts are kept across
+    sessions, so the data of Tales that are run by many users comes first.
+    """
+
+    # bounds the work done for sessions with very large folders
+    MAX_CANDIDATES = 10000
+
+    def __init__(self):
+        self.folderModel = ModelImporter.model("folder")
+
+    def selectItems(self, session, budget):
+        candidates = [
+            item
+            for item in self.listItems(session.get("dataSet") or [])
+            if not item.get("dm", {}).get("cached")
+            and not item.get("dm", {}).get("transferInProgress")
+        ]
+        candidates.sort(
+            key=lambda item: (-item.get("dm", {}).get("accessCount", 0), item.get("size", 0))
+        )
+        selected = []
+        for item in candidates:
+            size = item.get("size") or 0
+            if size <= budget:
+                selected.append(item)
+                budget -= size
+        return selected
+
+    def listItems(self, dataSet):
+        seen = set()
+        folders = []
+        for entry in dataSet:
+            objId = objectid.ObjectId(entry["itemId"])
+            if entry.get("_modelType") == "folder":
+                folders.append(objId)
+            else:
+                seen.add(objId)
+        items = list(
+            Models.itemModel.find({"_id": {"$in": list(seen)}}, fields=["_id", "size", "dm"])
+        )
+        while folders and len(items) < self.MAX_CANDIDATES:
+            folderId = folders.pop()
+            for item in Models.itemModel.find(
+                {"folderId": folderId},
+                fields=["_id", "size", "dm"],
+                limit=self.MAX_CANDIDATES - len(items),
+            ):
+                if item["_id"] not in seen:
+                    seen.add(item["_id"])
+                    items.append(item)
+            folders.extend(
+                folder["_id"]
+                for folder in self.folderModel.find(
+                    {"parentId": folderId, "parentCollection": "folder"}, fields=["_id"]
+                )
+            )
+        return items
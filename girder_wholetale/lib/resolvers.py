@@ -1,7 +1,7 @@
 import re
+from . import http_session
 from .entity import Entity
 from typing import Optional
-import requests
 
 """Regex that matches:
 
@@ -84,7 +84,7 @@ class DOIResolver(Resolver):
         # Expect a redirect. Basically, don't do anything fancy because I don't know
         # if I can correctly resolve a DOI using the structured record
         url = 'https://doi.org/%s' % doi
-        resolved_url = requests.head(url, allow_redirects=True).url
+        resolved_url = http_session.head(url, allow_redirects=True).url
         if url == resolved_url:
             raise ResolutionException('Could not resolve DOI %s' % (doi,))
 
@@ -96,7 +96,7 @@ class MinidResolver(Resolver):
     def resolve(self, entity: Entity) -> Optional[Entity]:
         value = entity.getValue()
         if value.startswith("https://identifiers.fair-research.org/"):
-            response = requests.get(value, headers={"Accept": "application/json"})
+            response = http_session.get(value, headers={"Accept": "application/json"})
             response.raise_for_status()
             data = response.json()
             entity.setValue(data["location"][0])
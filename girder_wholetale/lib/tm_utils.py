@@ -1,3 +1,8 @@
+import bisect
+import os
+import threading
+import time
+
 from girder.utility.model_importer import ModelImporter
 
 
@@ -9,9 +14,80 @@ class Models:
     lockModel = ModelImporter.model("lock", "wholetale")
 
 
+class RangeSet:
+    """
+    The byte ranges of a partial file that have been written, as sorted and
+    disjoint [start, end) pairs. Readers can wait for a range to arrive.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def add(self, start, end):
+        if start >= end:
+            return
+        with self.condition:
+            # merge with every range that overlaps or touches [start, end)
+            i = bisect.bisect_left(self.ends, start)
+            j = bisect.bisect_right(self.starts, end)
+            if i < j:
+                start = min(start, self.starts[i])
+                end = max(end, self.ends[j - 1])
+            self.starts[i:j] = [start]
+            self.ends[i:j] = [end]
+            self.condition.notify_all()
+
+    def clear(self):
+        with self.condition:
+            self.starts = []
+            self.ends = []
+
+    def contains(self, start, end):
+        with self.condition:
+            i = bisect.bisect_right(self.starts, start) - 1
+            return start >= end or (i >= 0 and self.ends[i] >= end)
+
+    def missing(self, start, end):
+        """
+        Returns the [start, end) pairs within [start, end) that are not present.
+        """
+        gaps = []
+        with self.condition:
+            i = bisect.bisect_right(self.ends, start)
+            while start < end:
+                if i == len(self.starts) or self.starts[i] >= end:
+                    gaps.append((start, end))
+                    break
+                if self.starts[i] > start:
+                    gaps.append((start, self.starts[i]))
+                start = self.ends[i]
+                i += 1
+        return gaps
+
+    def close(self):
+        # no more ranges will be added
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def waitFor(self, start, end, timeout=None):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.closed or self.contains(start, end), timeout
+            )
+            return self.contains(start, end)
+
+
 class TransferHandler:
     TRANSFER_UPDATE_MIN_CHUNK_SIZE = 1024 * 1024
     TRANSFER_UPDATE_MIN_FRACTIONAL_CHUNK_SIZE = 0.001
+    # set by the transfer manager when the content can be shared with other items
+    contentKey = None
+    # transfers with the same key fetch the same data, and only one of them runs
+    flightKey = None
 
     def __init__(self, transferId, itemId, psPath, user, transferManager):
         self.transferId = transferId
@@ -22,6 +98,10 @@ class TransferHandler:
         self.flen = 0
         self.item = Models.itemModel.load(self.itemId, force=True)
         self.lastTransferred = 0
+        # the ranges of the partial file that can already be read
+        self.present = RangeSet()
+        # hashlib name -> hex digest of the checksums the data was verified against
+        self.verifiedChecksums = {}
 
     def _getFileFromItem(self):
         files = list(Models.itemModel.childFiles(item=self.item))
@@ -35,7 +115,16 @@ class TransferHandler:
         return Models.fileModel.load(files[0]["_id"], force=True)
 
     def run(self):
+        self.startTime = time.monotonic()
         self.transfer()
+        self.transferTime = time.monotonic() - self.startTime
+
+    def getTransferTime(self):
+        return getattr(self, "transferTime", None)
+
+    def getFirstByteTime(self):
+        # seconds from the start of the transfer to the first byte written
+        return getattr(self, "firstByteTime", None)
 
     def getTransferredByteCount(self):
         return self.flen
@@ -46,11 +135,73 @@ class TransferHandler:
     def getPhysicalPath(self):
         return self.psPath
 
+    @property
+    def partPath(self):
+        # data is written here and only moved to psPath once complete, so
+        # that a partially transferred file is never mistaken for a cached one
+        return self.psPath + ".part"
+
+    def getResumeOffset(self):
+        """
+        Returns the offset from which an interrupted transfer can be resumed. That
+        is the last offset confirmed in the transfer document, as long as the
+        partial file actually holds that many bytes.
+        """
+        try:
+            partSize = os.path.getsize(self.partPath)
+        except OSError:
+            return 0
+        transfer = Models.transferModel.load(self.transferId, force=True)
+        if transfer is None:
+            return 0
+        return min(partSize, transfer.get("offset", 0))
+
+    def openPartFile(self, offset):
+        try:
+            os.makedirs(os.path.dirname(self.psPath))
+        except OSError:
+            pass
+        self.present.clear()
+        if offset > 0:
+            outf = open(self.partPath, "r+b")
+            outf.seek(offset)
+            outf.truncate()
+            self.present.add(0, offset)
+        else:
+            outf = open(self.partPath, "wb")
+        self.transferManager.partialFileOpened(self)
+        return outf
+
+    def rangeWritten(self, start, end):
+        # called once [start, end) of the partial file is flushed
+        if getattr(self, "firstByteTime", None) is None and hasattr(self, "startTime"):
+            self.firstByteTime = time.monotonic() - self.startTime
+        self.present.add(start, end)
+
+    def fetchRange(self, start, end):
+        """
+        Fetches [start, end) into the partial file ahead of the transfer, for
+        readers blocked on it. Handlers that cannot fetch arbitrary ranges
+        return False and readers wait for the transfer to get there.
+        """
+        return False
+
+    def commitPartFile(self):
+        os.replace(self.partPath, self.psPath)
+
+    def discardPartFile(self):
+        try:
+            os.remove(self.partPath)
+        except FileNotFoundError:
+            pass
+
     def transfer(self):
         pass
 
-    def updateTransferProgress(self, size, transferred):
-        # to avoid too many db requests, update only on:
+    def updateTransferProgress(self, size, transferred, offset=None):
+        # offset, if given, is the number of bytes from the beginning of the
+        # file that have been written and from which the transfer can be resumed.
+        # To avoid too many db requests, update only on:
         # - TRANSFER_UPDATE_MIN_CHUNK_SIZE AND
         # - TRANSFER_UPDATE_MIN_FRACTIONAL_CHUNK_SIZE transferred
         #   (less would not be visible on a progress bar shorted than 1000px)
@@ -61,7 +212,7 @@ class TransferHandler:
             >= size * TransferHandler.TRANSFER_UPDATE_MIN_FRACTIONAL_CHUNK_SIZE
         ):
             self.transferManager.transferProgress(
-                self.transferId, total=size, current=transferred
+                self.transferId, total=size, current=transferred, offset=offset
             )
             self.lastTransferred = transferred
 
@@ -1,41 +1,185 @@
+import itertools
 import logging
-import os
+import queue
 import threading
+import time
 import traceback
 
 from girder import events
 from girder.models.model_base import ValidationException
+from girder.models.setting import Setting
 from girder.utility import assetstore_utilities
 from girder.utility.model_importer import ModelImporter
 
-from ..constants import TransferStatus
+from ..constants import PluginSettings, TransferPriority, TransferStatus
+from . import dm_metrics
 from .handler_factory import HandlerFactory
+from .path_mapper import normalizeUrl
 from .tm_utils import Models, TransferException, TransferHandler
 
 
 logger = logging.getLogger(__name__)
 
+PRIORITY_NAMES = {
+    value: name.lower() for name, value in vars(TransferPriority).items() if name.isupper()
+}
 
-class TransferThread(threading.Thread):
+
+def handlerName(transferHandler):
+    # e.g., "Http" or "GirderDownload"
+    name = type(transferHandler).__name__
+    return name[: -len("TransferHandler")] if name.endswith("TransferHandler") else name
+
+
+class TransferTask:
     def __init__(self, itemId, transferId, transferHandler, transferManager):
-        threading.Thread.__init__(self, name="TransferThread[" + str(itemId) + "]")
-        self.daemon = True
         self.itemId = itemId
         self.transferId = transferId
         self.transferHandler = transferHandler
         self.transferManager = transferManager
+        # set by the scheduler
+        self.priority = None
+        self.queuedAt = None
 
     def run(self):
+        handler = handlerName(self.transferHandler)
+        if self.queuedAt is not None:
+            dm_metrics.TRANSFER_QUEUE_WAIT.observe(
+                time.monotonic() - self.queuedAt,
+                priority=PRIORITY_NAMES.get(self.priority, self.priority),
+            )
         try:
+            Models.transferModel.setStatus(
+                self.transferId, TransferStatus.INITIALIZING
+            )
             self.transferHandler.run()
             self.transferManager.transferCompleted(
                 self.transferId, self.transferHandler
             )
         except Exception as ex:  # noqa
             traceback.print_exc()
+            dm_metrics.TRANSFERS.inc(handler=handler, status="failed")
             self.transferManager.transferFailed(
                 self.transferId, self.transferHandler, ex
             )
+        else:
+            dm_metrics.TRANSFERS.inc(handler=handler, status="done")
+            dm_metrics.TRANSFER_BYTES.inc(
+                self.transferHandler.getTransferredByteCount(), handler=handler
+            )
+            transferTime = self.transferHandler.getTransferTime()
+            if transferTime is not None:
+                dm_metrics.TRANSFER_DURATION.observe(transferTime, handler=handler)
+        firstByteTime = self.transferHandler.getFirstByteTime()
+        if firstByteTime is not None:
+            dm_metrics.TRANSFER_FIRST_BYTE.observe(firstByteTime, handler=handler)
+
+
+class TransferWorker(threading.Thread):
+    def __init__(self, scheduler, index):
+        threading.Thread.__init__(self, name="TransferWorker[%s]" % index)
+        self.daemon = True
+        self.scheduler = scheduler
+
+    def run(self):
+        while True:
+            task = self.scheduler.nextTask()
+            try:
+                task.run()
+            except Exception:  # noqa
+                # e.g., the database failing while a failure is recorded; the
+                # worker must survive it or the pool would shrink for good
+                logger.error("Transfer task failed", exc_info=1)
+            finally:
+                self.scheduler.taskDone()
+
+
+class TransferScheduler:
+    """
+    A fixed pool of worker threads fed by a priority queue. Tasks with a lower
+    priority value are started first; tasks with equal priority are started in
+    submission order.
+    """
+
+    def __init__(self, workerCount):
+        self.workerCount = max(1, int(workerCount))
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.workers = [TransferWorker(self, i) for i in range(self.workerCount)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, task, priority=TransferPriority.INTERACTIVE):
+        task.priority = priority
+        task.queuedAt = time.monotonic()
+        self.queue.put((priority, next(self.seq), task))
+
+    def nextTask(self):
+        _, _, task = self.queue.get()
+        with self.lock:
+            self.busy += 1
+        return task
+
+    def taskDone(self):
+        with self.lock:
+            self.busy -= 1
+        self.queue.task_done()
+
+    def getStats(self):
+        with self.lock:
+            busy = self.busy
+        return {
+            "workers": self.workerCount,
+            "busy": busy,
+            "queued": self.queue.qsize(),
+            "utilization": busy / self.workerCount,
+        }
+
+
+class TransferProgressAggregator:
+    """
+    Coalesces progress updates so that only the latest update for each transfer is
+    written, with all transfers written in one bulk operation every FLUSH_INTERVAL
+    seconds. This bounds the write load on the transfer collection regardless of
+    how many transfers are running.
+    """
+
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, start=True):
+        # with start=False, updates are only written by explicit flush() calls
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.thread = None
+        if start:
+            self.thread = threading.Thread(
+                target=self.run, name="TransferProgressFlusher", daemon=True
+            )
+            self.thread.start()
+
+    def update(self, transferId, size, transferred, offset=None):
+        with self.lock:
+            self.pending[transferId] = (size, transferred, offset)
+
+    def discard(self, transferId):
+        # Returns the pending (size, transferred, offset), if any
+        with self.lock:
+            return self.pending.pop(transferId, None)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        Models.transferModel.setProgress(pending)
+
+    def run(self):
+        while True:
+            time.sleep(TransferProgressAggregator.FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:  # noqa
+                logger.error("Failed to record transfer progress", exc_info=1)
 
 
 class GirderDownloadTransferHandler(TransferHandler):
@@ -46,38 +190,48 @@ class GirderDownloadTransferHandler(TransferHandler):
 
     def transfer(self):
         file = self._getFileFromItem()
+        self.flen = file["size"]
+        offset = self.getResumeOffset()
         Models.transferModel.setStatus(
             self.transferId,
             TransferStatus.TRANSFERRING,
             size=self.flen,
-            transferred=0,
+            transferred=offset,
+            offset=offset,
             setTransferStartTime=True,
         )
-        stream = Models.fileModel.download(file, headers=False)
+        stream = Models.fileModel.download(file, offset=offset, headers=False)
 
-        try:
-            os.makedirs(os.path.dirname(self.psPath))
-        except OSError:
-            # Right. So checking if the directory exists and then creating it is
-            # prone to failure in concurrent environments. There should be a
-            # function that ensures that the directory exists without failing if
-            # it does. Good job, python!
-            pass
-        with open(self.psPath, "wb") as outf:
-            self.transferBytes(outf, stream)
+        with self.openPartFile(offset) as outf:
+            self.transferBytes(outf, stream, offset)
+        self.commitPartFile()
 
-    def transferBytes(self, outf, stream):
-        crt = 0
+    def transferBytes(self, outf, stream, offset=0):
+        crt = offset
         for chunk in stream():
             outf.write(chunk)
             crt = crt + len(chunk)
-            self.updateTransferProgress(self.flen, crt)
+            outf.flush()
+            self.rangeWritten(crt - len(chunk), crt)
+            self.updateTransferProgress(self.flen, crt, offset=crt)
 
 
 class TransferManager:
+    # seconds a reader of a partial file waits for the range it needs
+    PARTIAL_READ_TIMEOUT = 60
+
     def __init__(self, pathMapper):
         self.pathMapper = pathMapper
         self.handlerFactory = HandlerFactory()
+        self.scheduler = TransferScheduler(
+            Setting().get(PluginSettings.TRANSFER_WORKERS)
+        )
+        self.progress = TransferProgressAggregator()
+        # flight key -> (transferId, transfers waiting for it to complete)
+        self.inFlight = {}
+        self.inFlightLock = threading.Lock()
+        # item id -> handler of a running transfer with a partial file
+        self.partial = {}
 
     def restartInterruptedTransfers(self):
         # transfers and item.dm.transferInProgress are not atomically
@@ -102,10 +256,15 @@ class TransferManager:
                 data.append(transfer)
 
         for item in data:
-            print("Restarting transfer for item " + str(item))
+            logger.info("Restarting transfer for item " + str(item))
             try:
                 user = self.getUser(item["ownerId"])
-                self.startTransfer(user, item["itemId"], item["sessionId"])
+                self.startTransfer(
+                    user,
+                    item["itemId"],
+                    item["sessionId"],
+                    priority=TransferPriority.RESTART,
+                )
             except Exception as ex:  # noqa
                 logger.warning(
                     "Failed to strart transfer for itemId %s. Reason: %s"
@@ -115,14 +274,152 @@ class TransferManager:
     def getUser(self, userId):
         return Models.userModel.load(userId, force=True)
 
-    def startTransfer(self, user, itemId, sessionId):
+    def startTransfer(
+        self, user, itemId, sessionId, priority=TransferPriority.INTERACTIVE
+    ):
         pass
 
-    def _startTransferThread(self, itemId, transferId, transferHandler):
-        transferThread = TransferThread(itemId, transferId, transferHandler, self)
-        transferThread.start()
+    def startTransfers(
+        self, user, itemIds, sessionId, priority=TransferPriority.INTERACTIVE
+    ):
+        # A failure to start one transfer must not prevent the others
+        for itemId in itemIds:
+            try:
+                self.startTransfer(user, itemId, sessionId, priority=priority)
+            except Exception as ex:  # noqa
+                logger.warning(
+                    "Failed to start transfer for itemId %s. Reason: %s"
+                    % (itemId, str(ex))
+                )
+                Models.lockModel.fileDownloadFailed(itemId, str(ex))
+
+    def _scheduleTransfer(self, itemId, transferId, transferHandler, priority):
+        key = transferHandler.flightKey
+        if key is not None:
+            # Only one transfer per key. The others attach to it, or link to the
+            # content if it is already stored
+            with self.inFlightLock:
+                if key in self.inFlight:
+                    self.inFlight[key][1].append((transferId, transferHandler, priority))
+                    return
+                linked = (
+                    transferHandler.contentKey is not None
+                    and self.pathMapper.linkContent(itemId, transferHandler.contentKey)
+                )
+                if not linked:
+                    self.inFlight[key] = (transferId, [])
+            if linked:
+                self.linkedTransferCompleted(transferId, transferHandler)
+                return
+        self.submitTransfer(itemId, transferId, transferHandler, priority)
+
+    def submitTransfer(self, itemId, transferId, transferHandler, priority):
+        # runs the transfer in this process
+        task = TransferTask(itemId, transferId, transferHandler, self)
+        self.scheduler.submit(task, priority)
+
+    def linkedTransferCompleted(self, transferId, transferHandler, shared=True):
+        transferHandler.flen = transferHandler.item.get("size", 0)
+        self.transferCompleted(
+            transferId, transferHandler, linked=True, shared=shared
+        )
+
+    def _releaseFollowers(self, transferId, transferHandler, completed):
+        key = transferHandler.flightKey
+        if key is None:
+            return
+        with self.inFlightLock:
+            if self.inFlight.get(key, (None,))[0] != transferId:
+                return
+            followers = self.inFlight.pop(key)[1]
+        for followerId, handler, priority in followers:
+            try:
+                if not (completed and self._materialize(transferHandler, followerId, handler)):
+                    # the first follower downloads for the others
+                    self._scheduleTransfer(handler.getItemId(), followerId, handler, priority)
+            except Exception as ex:  # noqa
+                self.transferFailed(followerId, handler, ex)
+
+    def _materialize(self, leader, transferId, transferHandler):
+        # gives a follower the data fetched by the leader
+        if transferHandler.contentKey is not None:
+            if not self.pathMapper.linkContent(
+                transferHandler.getItemId(), transferHandler.contentKey
+            ):
+                return False
+            self.linkedTransferCompleted(transferId, transferHandler)
+            return True
+        try:
+            shared = self.pathMapper.linkFile(
+                leader.getPhysicalPath(), transferHandler.getItemId()
+            )
+        except FileNotFoundError:
+            # collected in the meantime
+            return False
+        self.linkedTransferCompleted(transferId, transferHandler, shared=shared)
+        return True
+
+    def getStats(self):
+        return self.scheduler.getStats()
 
-    def transferCompleted(self, transferId, transferHandler):
+    def partialFileOpened(self, transferHandler):
+        self.partial[transferHandler.getItemId()] = transferHandler
+
+    def _partialFileClosed(self, transferHandler):
+        itemId = transferHandler.getItemId()
+        if self.partial.get(itemId) is transferHandler:
+            del self.partial[itemId]
+        # wakes up readers still waiting for a range
+        transferHandler.present.close()
+
+    def openPartial(self, itemId, start, end, timeout=None):
+        """
+        Opens the file of an item that is being transferred once [start, end)
+        is in it. Ranges the transfer has not reached yet are fetched ahead of
+        it, if the handler can do that.
+
+        :return: A file object, or None if the item is not being transferred
+            or the range did not arrive in time
+        """
+        transferHandler = self.partial.get(itemId)
+        if transferHandler is None:
+            return None
+        for gapStart, gapEnd in transferHandler.present.missing(start, end):
+            try:
+                if not transferHandler.fetchRange(gapStart, gapEnd):
+                    break
+            except Exception:  # noqa
+                logger.warning("Failed to fetch range of %s", itemId, exc_info=1)
+                break
+        if timeout is None:
+            timeout = TransferManager.PARTIAL_READ_TIMEOUT
+        if not transferHandler.present.waitFor(start, end, timeout):
+            return None
+        try:
+            return open(transferHandler.partPath, "rb")
+        except FileNotFoundError:
+            pass
+        try:
+            # completed in the meantime
+            return open(transferHandler.getPhysicalPath(), "rb")
+        except FileNotFoundError:
+            # or discarded, e.g., after a failed checksum verification
+            return None
+
+    def transferCompleted(self, transferId, transferHandler, linked=False, shared=False):
+        # Linked transfers did not download anything but got their data from
+        # another transfer. Unless copied, it is shared with that transfer.
+        self.progress.discard(transferId)
+        transferHandler.present.add(0, transferHandler.getTransferredByteCount())
+        self._partialFileClosed(transferHandler)
+        key = transferHandler.contentKey
+        if key is not None and not linked:
+            if self.pathMapper.isVerified(key, transferHandler.verifiedChecksums):
+                shared = self.pathMapper.publishContent(transferHandler.getItemId(), key)
+            else:
+                # the checksum in the key is only claimed by the item's metadata,
+                # so the data stays private to the item
+                key = transferHandler.contentKey = None
         flen = transferHandler.getTransferredByteCount()
         Models.transferModel.setStatus(
             transferId,
@@ -133,7 +430,19 @@ class TransferManager:
         )
         itemId = transferHandler.getItemId()
         psPath = transferHandler.getPhysicalPath()
-        events.trigger("dm.fileDownloaded", info={"itemId": itemId, "psPath": psPath})
+        events.trigger(
+            "dm.fileDownloaded",
+            info={
+                "itemId": itemId,
+                "psPath": psPath,
+                "transferTime": transferHandler.getTransferTime(),
+                "contentKey": key,
+                # shared content was accounted for when first downloaded
+                "shared": shared,
+            },
+        )
+        if not linked:
+            self._releaseFollowers(transferId, transferHandler, completed=True)
 
     def transferFailed(self, transferId, transferHandler, exception):
         if isinstance(exception, TransferException):
@@ -143,11 +452,17 @@ class TransferManager:
             temporaryFailure = False
             message = str(exception)
 
+        self._partialFileClosed(transferHandler)
+        # keep the last known resume point of the transfer
+        pending = self.progress.discard(transferId)
+        offset = pending[2] if pending else None
+
         if temporaryFailure:
             Models.transferModel.setStatus(
                 transferId,
                 TransferStatus.FAILED_TEMPORARILY,
                 error=message,
+                offset=offset,
                 setTransferEndTime=False,
             )
         else:
@@ -155,15 +470,15 @@ class TransferManager:
                 transferId,
                 TransferStatus.FAILED,
                 error=message,
+                offset=offset,
                 setTransferEndTime=True,
             )
         itemId = transferHandler.getItemId()
         Models.lockModel.fileDownloadFailed(itemId, message)
+        self._releaseFollowers(transferId, transferHandler, completed=False)
 
-    def transferProgress(self, transferId, total, current):
-        Models.transferModel.setStatus(
-            transferId, TransferStatus.TRANSFERRING, size=total, transferred=current
-        )
+    def transferProgress(self, transferId, total, current, offset=None):
+        self.progress.update(transferId, total, current, offset)
 
 
 class SimpleTransferManager(TransferManager):
@@ -171,15 +486,19 @@ class SimpleTransferManager(TransferManager):
         TransferManager.__init__(self, pathMapper)
         self.restartInterruptedTransfers()
 
-    def startTransfer(self, user, itemId, sessionId):
-        # add transfer to transfer DB and initiate actual transfer
+    def startTransfer(
+        self, user, itemId, sessionId, priority=TransferPriority.INTERACTIVE
+    ):
+        # add transfer to transfer DB and queue the actual transfer
         transfer = Models.transferModel.createTransfer(user, itemId, sessionId)
-        self.actualStartTransfer(user, transfer["_id"], itemId)
+        self.actualStartTransfer(user, transfer["_id"], itemId, priority)
 
-    def actualStartTransfer(self, user, transferId, itemId):
-        Models.transferModel.setStatus(transferId, TransferStatus.INITIALIZING)
+    def actualStartTransfer(
+        self, user, transferId, itemId, priority=TransferPriority.INTERACTIVE
+    ):
+        # the transfer stays QUEUED until a worker picks it up
         transferHandler = self.getTransferHandler(transferId, itemId, user)
-        self._startTransferThread(itemId, transferId, transferHandler)
+        self._scheduleTransfer(itemId, transferId, transferHandler, priority)
 
     def getTransferHandler(self, transferId, itemId, user):
         item = Models.itemModel.load(itemId, force=True)
@@ -213,8 +532,21 @@ class SimpleTransferManager(TransferManager):
                 raise ValueError(
                     "File {} must have a size attribute.".format(str(file["_id"]))
                 )
-            return self.handlerFactory.getURLTransferHandler(
+            handler = self.handlerFactory.getURLTransferHandler(
                 url, transferId, itemId, psPath, user, self
             )
         else:
-            return GirderDownloadTransferHandler(transferId, itemId, psPath, user, self)
+            handler = GirderDownloadTransferHandler(
+                transferId, itemId, psPath, user, self
+            )
+        # data fetched with the user's credentials is not shared with others
+        authenticated = bool(getattr(handler, "headers", None))
+        if not authenticated:
+            handler.contentKey = self.pathMapper.getContentKey(item, file.get("linkUrl"))
+        if handler.contentKey is not None:
+            handler.flightKey = handler.contentKey
+        elif file.get("linkUrl"):
+            handler.flightKey = "url/" + normalizeUrl(file["linkUrl"])
+            if authenticated:
+                handler.flightKey += "#user/" + str(user["_id"])
+        return handler
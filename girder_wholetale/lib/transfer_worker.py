@@ -0,0 +1,54 @@
+"""
+The celery side of the "celery" DM transfer backend (see celery_transfer.py).
+Workers load it through the "wholetale_dm" girder_worker plugin entry point.
+It must not import the transfer code at module level, since that resolves the
+plugin models, which are only registered here outside of Girder.
+"""
+
+from bson import objectid
+from girder.utility.model_importer import ModelImporter
+from girder_worker import GirderWorkerPluginABC
+from girder_worker.app import app
+
+TASK_NAME = "girder_wholetale.dm.transfer"
+
+
+def registerModels():
+    from ..models.lock import Lock
+    from ..models.transfer import Transfer
+
+    ModelImporter.registerModel("transfer", Transfer, "wholetale")
+    ModelImporter.registerModel("lock", Lock, "wholetale")
+
+
+class DMTransferPlugin(GirderWorkerPluginABC):
+    def __init__(self, app, *args, **kwargs):
+        self.app = app
+        registerModels()
+
+    def task_imports(self):
+        return ["girder_wholetale.lib.transfer_worker"]
+
+
+@app.task(name=TASK_NAME, bind=True, acks_late=True)
+def transferItem(self, transferId, itemId, userId):
+    """
+    Runs a transfer created by CeleryTransferManager. Progress and the outcome
+    are recorded in the transfer collection; completion is handled by Girder
+    once the job of this task ends.
+    """
+    from .celery_transfer import WorkerTransferManager
+    from .tm_utils import Models
+
+    manager = WorkerTransferManager()
+    transferId = objectid.ObjectId(transferId)
+    user = Models.userModel.load(objectid.ObjectId(userId), force=True)
+    try:
+        transferHandler = manager.getTransferHandler(
+            transferId, objectid.ObjectId(itemId), user
+        )
+        transferHandler.run()
+    except Exception as ex:
+        manager.recordFailure(transferId, ex)
+        raise
+    return manager.recordSuccess(transferId, transferHandler)
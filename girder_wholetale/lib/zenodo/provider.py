@@ -1,7 +1,6 @@
 import os
 import pathlib
 import re
-import requests
 from urllib.parse import urlparse, urlunparse
 from urllib.request import urlopen
 
@@ -9,6 +8,7 @@ from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.models.setting import Setting
 
+from .. import http_session
 from ..import_providers import ImportProvider
 from ..data_map import DataMap
 from ..file_map import FileMap
@@ -55,7 +55,7 @@ class ZenodoImportProvider(ImportProvider):
     def _get_record(self, raw_url):
         url = urlparse(raw_url)
         record_id = url.path.rsplit("/", maxsplit=1)[1]
-        req = requests.get(
+        req = http_session.get(
             urlunparse(url._replace(path="/api/records/" + record_id)),
             headers={
                 "accept": "application/vnd.zenodo.v1+json",
@@ -2,15 +2,93 @@
 # -*- coding: utf-8 -*-
 
 
+import json
+import logging
+import threading
 import time
 
 from bson import objectid
 from girder import events
-from girder.constants import AccessType
+from girder.constants import AccessType, SortDir
 from girder.models.model_base import AccessControlledModel
 from girder.utility.model_importer import ModelImporter
+from pymongo import UpdateOne
 from pymongo.collection import ReturnDocument
 
+from ..lib import dm_metrics
+from .psinfo import PSInfo
+
+logger = logging.getLogger(__name__)
+
+
+class DeletionNotifier:
+    """
+    Wakes up threads waiting for the pending deletion of an item to finish.
+    Deletions done by this process notify waiters immediately. Deletions done by
+    other processes cannot be observed, so waiters also re-check the item with
+    an exponential backoff.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # itemId -> [event, number of waiters watching it]
+        self.events = {}
+        self.stats = {
+            "waits": 0,
+            "timeouts": 0,
+            "totalWaitTime": 0.0,
+            "maxWaitTime": 0.0,
+        }
+
+    def watch(self, itemId):
+        # Must be called before checking the item, so that a deletion finishing
+        # between the check and the wait is not missed. Every call must be
+        # followed by unwatch().
+        with self.lock:
+            entry = self.events.setdefault(itemId, [threading.Event(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def unwatch(self, itemId, event):
+        with self.lock:
+            entry = self.events.get(itemId)
+            # the event is gone if a deletion was notified since watch()
+            if entry is not None and entry[0] is event:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.events[itemId]
+
+    def notify(self, itemId):
+        with self.lock:
+            entry = self.events.pop(itemId, None)
+        if entry is not None:
+            entry[0].set()
+
+    def record(self, waitTime, timedOut=False):
+        with self.lock:
+            self.stats["waits"] += 1
+            self.stats["timeouts"] += int(timedOut)
+            self.stats["totalWaitTime"] += waitTime
+            self.stats["maxWaitTime"] = max(self.stats["maxWaitTime"], waitTime)
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+deletionNotifier = DeletionNotifier()
+
+# Cache events, as JSON lines, for replaying with lib/gc_simulator.py. Silent
+# unless this logger is configured to emit DEBUG records.
+traceLogger = logging.getLogger("girder_wholetale.dm.trace")
+
+
+def traceEvent(event, itemId, **kwargs):
+    if traceLogger.isEnabledFor(logging.DEBUG):
+        record = {"time": time.time(), "event": event, "itemId": str(itemId)}
+        record.update(kwargs)
+        traceLogger.debug(json.dumps(record))
+
 
 # This is the long-term item lock model. Locking in this context means
 # 'don't delete'
@@ -21,12 +99,20 @@ class Lock(AccessControlledModel):
     FIELD_CACHED = "dm.cached"
     FIELD_LAST_UNLOCKED = "dm.lastUnlocked"
     FIELD_DOWNLOAD_COUNT = "dm.downloadCount"
+    FIELD_ACCESS_COUNT = "dm.accessCount"
+    FIELD_TRANSFER_TIME = "dm.transferTime"
+    FIELD_DELETE_TOKEN = "dm.deleteToken"
+    FIELD_CONTENT_KEY = "dm.contentKey"
     FIELD_ERROR_COUNT = "dm.errorCount"
     FIELD_PS_PATH = "dm.psPath"
     FIELD_TRANSFER_ERROR = "dm.transferError"
     FIELD_TRANSFER_ERROR_MESSAGE = "dm.transferErrorMessage"
 
     DOWNLOAD_BUF_SIZE = 65536
+    # seconds
+    PENDING_DELETE_TIMEOUT = 60
+    PENDING_DELETE_MIN_RECHECK = 0.05
+    PENDING_DELETE_MAX_RECHECK = 1.0
 
     def initialize(self):
         self.name = "lock"
@@ -35,6 +121,20 @@ class Lock(AccessControlledModel):
             fields={"_id", "userId", "sessionId", "itemId", "ownerId"},
         )
         self.itemModel = ModelImporter.model("item")
+        self.psInfo = PSInfo()
+        # lets the GC walk the unlocked cached items in LRU order
+        collectionIndex = (
+            (Lock.FIELD_CACHED, SortDir.ASCENDING),
+            (Lock.FIELD_LOCK_COUNT, SortDir.ASCENDING),
+            (Lock.FIELD_LAST_UNLOCKED, SortDir.ASCENDING),
+        )
+        # lets getDownloadingSize() find the few items being transferred; only
+        # those are indexed
+        transferIndex = (
+            Lock.FIELD_TRANSFER_IN_PROGRESS,
+            {"partialFilterExpression": {Lock.FIELD_TRANSFER_IN_PROGRESS: True}},
+        )
+        self.itemModel.ensureIndices([(collectionIndex, {}), transferIndex])
 
     def validate(self, lock):
         return lock
@@ -42,6 +142,9 @@ class Lock(AccessControlledModel):
     def listLocks(self, user, sessionId=None, itemId=None, ownerId=None):
         query = {"userId": user["_id"]}
         if sessionId is not None:
+            if not isinstance(sessionId, dict) and objectid.ObjectId.is_valid(sessionId):
+                # older locks store the session id as a string
+                sessionId = {"$in": [objectid.ObjectId(sessionId), str(sessionId)]}
             query["sessionId"] = sessionId
         if itemId is not None:
             query["itemId"] = itemId
@@ -63,6 +166,7 @@ class Lock(AccessControlledModel):
         :type ownerId: string or ObjectId
         """
 
+        sessionId = objectid.ObjectId(sessionId)
         if ownerId is None:
             ownerId = sessionId
 
@@ -79,35 +183,173 @@ class Lock(AccessControlledModel):
         self.setUserAccess(lock, user=user, level=AccessType.ADMIN)
         lock = self.save(lock)
 
-        self.waitForPendingDelete(itemId)
+        try:
+            self.waitForPendingDelete(itemId)
+        except TimeoutError:
+            self.remove(lock)
+            raise
+        traceEvent("lock", itemId)
 
         if self.tryLock(user, sessionId, itemId, ownerId):
+            dm_metrics.LOCKS.inc(result="miss")
             # we own the transfer
             events.trigger(
                 "dm.itemLocked",
                 info={"itemId": itemId, "user": user, "sessionId": sessionId},
             )
+        else:
+            dm_metrics.LOCKS.inc(result="hit")
         return lock
 
-    def waitForPendingDelete(self, itemId):
+    def acquireLocks(self, user, sessionId, itemIds, ownerId=None):
+        """
+        Adds a new lock to each of a list of items using a constant number of
+        database round trips, except for items that are being deleted from the
+        cache. See acquireLock.
+
+        :param user: The user initiating the request.
+        :type user: dict or None
+        :param sessionId: The ID of a session associated with the request.
+        :type sessionId: ObjectId
+        :param itemIds: The (Girder) items being locked
+        :type itemIds: list of string or ObjectId
+        :param ownerId: The entity requesting the locks. If not specified, the session
+         id is used
+        :type ownerId: string or ObjectId
+        :return: The list of locks, in the order of itemIds
+        """
+        sessionId = objectid.ObjectId(sessionId)
+        if ownerId is None:
+            ownerId = sessionId
+        itemIds = [objectid.ObjectId(itemId) for itemId in itemIds]
+        if not itemIds:
+            return []
+
+        locks = []
+        for itemId in itemIds:
+            lock = {
+                "_id": objectid.ObjectId(),
+                "userId": user["_id"],
+                "sessionId": sessionId,
+                "itemId": itemId,
+                "ownerId": ownerId,
+            }
+            self.setUserAccess(lock, user=user, level=AccessType.ADMIN)
+            locks.append(lock)
+        self.collection.insert_many(locks)
+
+        # Unlike waitForPendingDelete, the count is raised unconditionally. An item
+        # whose lock count is not zero cannot be claimed for deletion, so the only
+        # items that may still be deleted are the ones claimed before this update.
+        self.itemModel.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": itemId},
+                    {"$inc": {Lock.FIELD_LOCK_COUNT: 1, Lock.FIELD_ACCESS_COUNT: 1}},
+                )
+                for itemId in itemIds
+            ],
+            ordered=False,
+        )
+        uniqueIds = list(dict.fromkeys(itemIds))
+        deleting = self.itemModel.find(
+            {"_id": {"$in": uniqueIds}, Lock.FIELD_DELETE_IN_PROGRESS: True},
+            fields=["_id"],
+        )
+        try:
+            for item in deleting:
+                self._waitForDeletion(item["_id"], self._deletionFinished(item["_id"]))
+        except TimeoutError:
+            # like acquireLock, do not leave the items locked
+            self.collection.delete_many({"_id": {"$in": [lock["_id"] for lock in locks]}})
+            self.itemModel.collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"_id": itemId},
+                        {"$inc": {Lock.FIELD_LOCK_COUNT: -1, Lock.FIELD_ACCESS_COUNT: -1}},
+                    )
+                    for itemId in itemIds
+                ],
+                ordered=False,
+            )
+            raise
+
+        for itemId in itemIds:
+            traceEvent("lock", itemId)
+
+        transferIds = self.tryLockMany(user, sessionId, uniqueIds)
+        dm_metrics.LOCKS.inc(len(transferIds), result="miss")
+        dm_metrics.LOCKS.inc(len(uniqueIds) - len(transferIds), result="hit")
+        if transferIds:
+            # we own these transfers
+            events.trigger(
+                "dm.itemsLocked",
+                info={"itemIds": transferIds, "user": user, "sessionId": sessionId},
+            )
+        return locks
+
+    def _deletionFinished(self, itemId):
+        def attempt():
+            return (
+                self.itemModel.findOne(
+                    {"_id": itemId, Lock.FIELD_DELETE_IN_PROGRESS: {"$ne": True}},
+                    fields=["_id"],
+                )
+                is not None
+            )
+
+        return attempt
+
+    def waitForPendingDelete(self, itemId, timeout=None):
         # In principle, writing ops should happen in a critical section.
         # However, entering a critical section may require an arbitrary
-        # amount of time (while downloads happen). This could be implemented
-        # using a queue and asynchronous events, but that's too much engineering.
-        # Instead, we wait for deletion operations, since they are quick, and
-        # implement downloads using a two step: lock the file to prevent its deletion,
-        # then poll for transfer status
-        done = False
-        while not done:
+        # amount of time (while downloads happen). Instead, we wait for deletion
+        # operations, since they are quick, and implement downloads using a two
+        # step: lock the file to prevent its deletion, then poll for transfer status
+        def attempt():
             result = self.itemModel.update(
                 query={"_id": itemId, Lock.FIELD_DELETE_IN_PROGRESS: {"$ne": True}},
                 # make sure no deletes can creep in
-                update={"$inc": {Lock.FIELD_LOCK_COUNT: 1}},
+                update={"$inc": {Lock.FIELD_LOCK_COUNT: 1, Lock.FIELD_ACCESS_COUNT: 1}},
                 multi=False,
             )
-            done = result.matched_count > 0
-            if not done:
-                time.sleep(0.05)
+            return result.matched_count > 0
+
+        self._waitForDeletion(itemId, attempt, timeout)
+
+    def _waitForDeletion(self, itemId, attempt, timeout=None):
+        # Calls attempt() until it succeeds, waiting for deletions of itemId to
+        # finish in between
+        if timeout is None:
+            timeout = Lock.PENDING_DELETE_TIMEOUT
+        if attempt():
+            # the usual case, no deletion was pending
+            return
+        start = time.monotonic()
+        delay = Lock.PENDING_DELETE_MIN_RECHECK
+        waited = False
+        while True:
+            event = deletionNotifier.watch(itemId)
+            try:
+                if attempt():
+                    break
+                elapsed = time.monotonic() - start
+                if elapsed >= timeout:
+                    deletionNotifier.record(elapsed, timedOut=True)
+                    raise TimeoutError(
+                        "Timed out waiting for item %s to be deleted from the cache"
+                        % itemId
+                    )
+                waited = True
+                event.wait(min(delay, timeout - elapsed))
+            finally:
+                deletionNotifier.unwatch(itemId, event)
+            delay = min(2 * delay, Lock.PENDING_DELETE_MAX_RECHECK)
+        if waited:
+            deletionNotifier.record(time.monotonic() - start)
+
+    def getPendingDeleteStats(self):
+        return deletionNotifier.getStats()
 
     def tryLockForDeletion(self, itemId):
         result = self.itemModel.update(
@@ -121,12 +363,57 @@ class Lock(AccessControlledModel):
         )
         return result.matched_count > 0
 
+    def tryLockManyForDeletion(self, itemIds):
+        """
+        Bulk version of tryLockForDeletion.
+
+        :return: The set of ids from itemIds that were claimed for deletion
+        """
+        if not itemIds:
+            return set()
+        itemIds = list(itemIds)
+        # like tryLockMany, mark the claimed items to find out which they are
+        token = objectid.ObjectId()
+        self.itemModel.update(
+            query={
+                "_id": {"$in": itemIds},
+                Lock.FIELD_DELETE_IN_PROGRESS: {"$ne": True},
+                Lock.FIELD_LOCK_COUNT: 0,
+            },
+            update={
+                "$set": {
+                    Lock.FIELD_DELETE_IN_PROGRESS: True,
+                    Lock.FIELD_DELETE_TOKEN: token,
+                }
+            },
+        )
+        return {
+            item["_id"]
+            for item in self.itemModel.find(
+                {"_id": {"$in": itemIds}, Lock.FIELD_DELETE_TOKEN: token}, fields=["_id"]
+            )
+        }
+
+    def unlockManyForDeletion(self, itemIds):
+        if not itemIds:
+            return
+        self.itemModel.update(
+            query={"_id": {"$in": list(itemIds)}},
+            update={
+                "$set": {Lock.FIELD_DELETE_IN_PROGRESS: False},
+                "$unset": {Lock.FIELD_DELETE_TOKEN: True},
+            },
+        )
+        for itemId in itemIds:
+            deletionNotifier.notify(itemId)
+
     def unlockForDeletion(self, itemId):
         self.itemModel.update(
             query={"_id": itemId},
             update={"$set": {Lock.FIELD_DELETE_IN_PROGRESS: False}},
             multi=False,
         )
+        deletionNotifier.notify(itemId)
 
     def evict(self, itemId):
         result = self.itemModel.update(
@@ -140,7 +427,7 @@ class Lock(AccessControlledModel):
             },
             multi=False,
         )
-        print("Evicting %s. Matched: %s." % (itemId, result.matched_count))
+        logger.info("Evicting %s. Matched: %s." % (itemId, result.matched_count))
 
     def tryLock(self, user, sessionId, itemId, ownerId):
         # Luckily, Mongo updates are atomic
@@ -164,9 +451,101 @@ class Lock(AccessControlledModel):
         )
         return result.matched_count > 0
 
+    def tryLockMany(self, user, sessionId, itemIds):
+        """
+        Bulk version of tryLock. Returns the ids of the items whose transfer
+        should be started by the caller.
+        """
+        # Each caller marks the items it claims with a unique token, so that they
+        # can be told apart from the ones claimed concurrently by someone else
+        token = objectid.ObjectId()
+        self.itemModel.update(
+            query={
+                "_id": {"$in": itemIds},
+                Lock.FIELD_TRANSFER_IN_PROGRESS: {"$ne": True},
+                Lock.FIELD_CACHED: {"$ne": True},
+            },
+            update={
+                "$set": {
+                    Lock.FIELD_TRANSFER_IN_PROGRESS: True,
+                    "dm.transfer.userId": user["_id"],
+                    "dm.transfer.sessionId": sessionId,
+                    "dm.transfer.token": token,
+                },
+                "$unset": {Lock.FIELD_TRANSFER_ERROR: True},
+            },
+        )
+        return [
+            item["_id"]
+            for item in self.itemModel.find(
+                {"_id": {"$in": itemIds}, "dm.transfer.token": token}, fields=["_id"]
+            )
+        ]
+
+    def tryLockForPrefetch(self, user, sessionId, itemIds):
+        """
+        Claims the transfer of items that nobody locked, like tryLockMany. The
+        items are collectable as soon as they are cached, and having never been
+        unlocked, they come first in LRU order.
+        """
+        itemIds = self.tryLockMany(user, sessionId, itemIds)
+        if itemIds:
+            self.itemModel.update(
+                query={"_id": {"$in": itemIds}},
+                update={"$max": {Lock.FIELD_LOCK_COUNT: 0}},
+            )
+        return itemIds
+
+    def releaseLocks(self, user, sessionId, itemIds, ownerId=None):
+        """
+        Removes one lock held by user in sessionId for each of a list of items.
+        Items that are not locked are ignored.
+
+        :return: The number of locks removed
+        """
+        itemIds = [objectid.ObjectId(itemId) for itemId in itemIds]
+        available = {}
+        for lock in self.listLocks(
+            user, sessionId=sessionId, itemId={"$in": itemIds}, ownerId=ownerId
+        ):
+            available.setdefault(lock["itemId"], []).append(lock["_id"])
+        lockIds = []
+        unlockedIds = []
+        for itemId in itemIds:
+            if available.get(itemId):
+                lockIds.append(available[itemId].pop())
+                unlockedIds.append(itemId)
+        if not lockIds:
+            return 0
+
+        self.collection.delete_many({"_id": {"$in": lockIds}})
+        self.itemModel.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": itemId},
+                    {
+                        "$inc": {Lock.FIELD_LOCK_COUNT: -1},
+                        "$currentDate": {
+                            Lock.FIELD_LAST_UNLOCKED: {"$type": "timestamp"}
+                        },
+                    },
+                )
+                for itemId in unlockedIds
+            ],
+            ordered=False,
+        )
+        for itemId in unlockedIds:
+            traceEvent("unlock", itemId)
+        for item in self.itemModel.find(
+            {"_id": {"$in": unlockedIds}, Lock.FIELD_LOCK_COUNT: 0}, fields=["_id"]
+        ):
+            events.trigger("dm.itemUnlocked", info=item["_id"])
+        return len(lockIds)
+
     def releaseLock(self, user, lock):
         itemId = lock["itemId"]
         self.removeLock(lock)
+        traceEvent("unlock", itemId)
 
         if self.unlock(itemId):
             events.trigger("dm.itemUnlocked", info=itemId)
@@ -192,40 +571,101 @@ class Lock(AccessControlledModel):
     def unlockAll(self, user, session):
         raise Exception("Not yet here")
 
-    def fileDeleted(self, itemId):
+    def fileDeleted(self, itemId, freed=True):
+        # the previous state tells whether the file was accounted for
+        item = self.itemModel.collection.find_one_and_update(
+            filter={"_id": itemId},
+            update={
+                "$set": {
+                    Lock.FIELD_CACHED: False,
+                    Lock.FIELD_DELETE_IN_PROGRESS: False,
+                },
+                "$unset": {Lock.FIELD_PS_PATH: True, Lock.FIELD_CONTENT_KEY: True},
+            },
+            projection=["size", Lock.FIELD_CACHED],
+            return_document=ReturnDocument.BEFORE,
+        )
+        if freed and item is not None and item.get("dm", {}).get("cached"):
+            self.psInfo.addUsed(-item.get("size", 0))
+        deletionNotifier.notify(itemId)
+
+    def filesDeleted(self, itemIds, sharedIds=()):
+        """
+        Bulk version of fileDeleted, for items claimed with tryLockManyForDeletion.
+        Those cannot change until released, so their sizes can be read first.
+        Items in sharedIds linked to content that is still used by other items,
+        so deleting them freed no space.
+        """
+        if not itemIds:
+            return
+        query = {"_id": {"$in": list(itemIds)}}
+        freed = sum(
+            item.get("size", 0)
+            for item in self.itemModel.find(
+                {"_id": {"$in": list(set(itemIds) - set(sharedIds))}, Lock.FIELD_CACHED: True},
+                fields=["size"],
+            )
+        )
         self.itemModel.update(
-            query={"_id": itemId},
+            query=query,
             update={
                 "$set": {
                     Lock.FIELD_CACHED: False,
                     Lock.FIELD_DELETE_IN_PROGRESS: False,
                 },
-                "$unset": {Lock.FIELD_PS_PATH: True},
+                "$unset": {
+                    Lock.FIELD_PS_PATH: True,
+                    Lock.FIELD_DELETE_TOKEN: True,
+                    Lock.FIELD_CONTENT_KEY: True,
+                },
             },
-            multi=False,
         )
+        self.psInfo.addUsed(-freed)
+        for itemId in itemIds:
+            deletionNotifier.notify(itemId)
 
     def fileDownloaded(self, info):
         itemId = info["itemId"]
         psPath = info["psPath"]
-        self.itemModel.update(
-            query={"_id": itemId},
+        fields = {
+            Lock.FIELD_CACHED: True,
+            Lock.FIELD_TRANSFER_IN_PROGRESS: False,
+            Lock.FIELD_PS_PATH: psPath,
+        }
+        if info.get("transferTime") is not None:
+            # what it would cost to fetch the file again, for the GC
+            fields[Lock.FIELD_TRANSFER_TIME] = info["transferTime"]
+        if info.get("contentKey") is not None:
+            fields[Lock.FIELD_CONTENT_KEY] = info["contentKey"]
+        item = self.itemModel.collection.find_one_and_update(
+            filter={"_id": itemId},
             update={
-                "$set": {
-                    Lock.FIELD_CACHED: True,
-                    Lock.FIELD_TRANSFER_IN_PROGRESS: False,
-                    Lock.FIELD_PS_PATH: psPath,
-                },
+                "$set": fields,
                 "$unset": {
                     "dm.transfer.userId": True,
                     "dm.transfer.sessionId": True,
+                    "dm.transfer.token": True,
                     Lock.FIELD_TRANSFER_ERROR: True,
                     Lock.FIELD_TRANSFER_ERROR_MESSAGE: True,
                 },
                 "$inc": {Lock.FIELD_DOWNLOAD_COUNT: 1},
             },
-            multi=False,
+            projection=["size", Lock.FIELD_CACHED],
+            return_document=ReturnDocument.BEFORE,
         )
+        if (
+            item is not None
+            and not item.get("dm", {}).get("cached")
+            and not info.get("shared")
+        ):
+            self.psInfo.addUsed(item.get("size", 0))
+        if item is not None:
+            traceEvent(
+                "downloaded",
+                itemId,
+                size=item.get("size", 0),
+                transferTime=info.get("transferTime"),
+            )
 
     def fileDownloadFailed(self, itemId, errorMessage):
         self.itemModel.update(
@@ -237,7 +677,11 @@ class Lock(AccessControlledModel):
                     Lock.FIELD_TRANSFER_ERROR: True,
                     Lock.FIELD_TRANSFER_ERROR_MESSAGE: errorMessage,
                 },
-                "$unset": {"dm.transfer.userId": True, "dm.transfer.sessionId": True},
+                "$unset": {
+                    "dm.transfer.userId": True,
+                    "dm.transfer.sessionId": True,
+                    "dm.transfer.token": True,
+                },
                 "$inc": {Lock.FIELD_ERROR_COUNT: 1},
             },
             multi=False,
@@ -246,9 +690,26 @@ class Lock(AccessControlledModel):
     def listDownloadingItems(self):
         return self.itemModel.find(query={Lock.FIELD_TRANSFER_IN_PROGRESS: True})
 
-    def getCollectionCandidates(self):
+    def getDownloadingSize(self):
+        """
+        Returns the total size of the items being transferred or waiting to be,
+        i.e., the space they will take in the cache once they are done.
+        """
+        result = list(
+            self.itemModel.collection.aggregate(
+                [
+                    {"$match": {Lock.FIELD_TRANSFER_IN_PROGRESS: True}},
+                    {"$group": {"_id": None, "size": {"$sum": "$size"}}},
+                ]
+            )
+        )
+        return result[0]["size"] if result else 0
+
+    def getCollectionCandidates(self, sort=None, fields=None):
         return self.itemModel.find(
-            query={Lock.FIELD_CACHED: True, Lock.FIELD_LOCK_COUNT: 0}
+            query={Lock.FIELD_CACHED: True, Lock.FIELD_LOCK_COUNT: 0},
+            sort=sort,
+            fields=fields,
         )
 
     def _getAllCachedItems(self):
@@ -262,18 +723,35 @@ class Lock(AccessControlledModel):
             query={"_id": item["_id"]}, update={"$set": {Lock.FIELD_LOCK_COUNT: 0}}
         )
 
-    def downloadItem(self, lock):
+    def getLockedItem(self, lock):
         item = self.itemModel.findOne({"_id": lock["itemId"]})
         if item is None:
             raise ValueError("Internal error: unable to find item for lock")
-        if not item["dm"]["cached"]:
+        return item
+
+    def getCachedItem(self, lock):
+        item = self.getLockedItem(lock)
+        if not item["dm"].get("cached"):
             raise ValueError("Item is not available yet")
-        psPath = item["dm"]["psPath"]
+        return item
+
+    def downloadItem(self, lock, offset=0, endByte=None):
+        """
+        Returns a generator function streaming the cached file of the locked
+        item, from offset up to endByte (non-inclusive).
+        """
+        psPath = self.getCachedItem(lock)["dm"]["psPath"]
 
         def stream():
             with open(psPath, "rb") as f:
-                while True:
-                    data = f.read(Lock.DOWNLOAD_BUF_SIZE)
+                f.seek(offset)
+                remaining = None if endByte is None else endByte - offset
+                while remaining is None or remaining > 0:
+                    size = Lock.DOWNLOAD_BUF_SIZE
+                    if remaining is not None:
+                        size = min(size, remaining)
+                        remaining -= size
+                    data = f.read(size)
                     if not data:
                         break
                     yield data
@@ -1,3 +1,6 @@
+import datetime
+import os
+
 from girder.constants import AccessType
 from girder.models.model_base import Model
 from girder.models.setting import Setting
@@ -15,7 +18,15 @@ class PSInfo(Model):
         return psinfo
 
     def updateInfo(self, used=0):
-        self.update({}, {'$set': {'used': used}})
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.collection.update_one(
+            {}, {'$set': {'used': used, 'updated': now}}, upsert=True)
+
+    def addUsed(self, delta):
+        # kept up to date as files enter and leave the cache, so that deciding
+        # whether to collect is a single read
+        if delta:
+            self.collection.update_one({}, {'$inc': {'used': delta}}, upsert=True)
 
     def getInfo(self):
         obj = self.findOne()
@@ -29,4 +40,50 @@ class PSInfo(Model):
         return Setting().get(constants.PluginSettings.PRIVATE_STORAGE_CAPACITY)
 
     def sizeUsed(self):
-        return self.getInfo()['capacity']
+        return self.getInfo()['used']
+
+    def needsReconcile(self, interval):
+        obj = self.findOne(fields=['updated'])
+        if obj is None or 'updated' not in obj:
+            return True
+        updated = obj['updated']
+        if updated.tzinfo is None:
+            # the client is not tz aware, dates are loaded as naive UTC
+            updated = updated.replace(tzinfo=datetime.timezone.utc)
+        age = datetime.datetime.now(datetime.timezone.utc) - updated
+        return age.total_seconds() >= interval
+
+    def reconcile(self):
+        """
+        Resets the used space to what the files in the private storage actually
+        occupy, correcting any drift in the incremental accounting.
+        """
+        root = Setting().get(constants.PluginSettings.PRIVATE_STORAGE_PATH)
+        used = 0
+        # shared content is linked from several paths
+        seen = set()
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if name.endswith('.part'):
+                    # transfers in progress are accounted for when they complete
+                    continue
+                try:
+                    st = os.lstat(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    used += st.st_size
+        self.updateInfo(used)
+        return used
+
+    def getState(self, name):
+        # persistent state of the GC sorting schemes
+        obj = self.findOne(fields=['schemes.' + name])
+        if obj is None:
+            return {}
+        return obj.get('schemes', {}).get(name, {})
+
+    def setState(self, name, state):
+        self.collection.update_one(
+            {}, {'$set': {'schemes.' + name: state}}, upsert=True)
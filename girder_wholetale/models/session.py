@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import threading
 
 from bson import objectid
 from girder import events
@@ -11,7 +12,87 @@ from girder.models.user import User
 from girder.utility.model_importer import ModelImporter
 
 
+class AncestorIndex:
+    """
+    Memoizes the containment checks done when items are locked in a session. For
+    each session, the ids of the dataSet roots and the answers already computed are
+    kept until the session changes; the parent of every visited folder or item is
+    kept until that object is moved. The index is shared by the request threads
+    and the event handlers, so its dicts are only touched while holding its lock.
+    """
+
+    # the caches are dropped wholesale when they grow past this many entries
+    MAX_ENTRIES = 100000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # objectId -> parentId (None for top level objects)
+        self.parents = {}
+        # sessionId -> (seq, roots, {objectId: contained})
+        self.sessions = {}
+        # bumped on saves that may be moves, so that racing lookups are not kept
+        self.moves = 0
+
+    def getSession(self, session):
+        with self.lock:
+            entry = self.sessions.get(session["_id"])
+            if entry is None or entry[0] != session.get("seq"):
+                roots = frozenset(
+                    objectid.ObjectId(e["itemId"]) for e in session["dataSet"]
+                )
+                if len(self.sessions) >= AncestorIndex.MAX_ENTRIES:
+                    self.sessions.clear()
+                entry = (session.get("seq"), roots, {})
+                self.sessions[session["_id"]] = entry
+            return entry[1], entry[2]
+
+    def getAnswer(self, known, objectId):
+        # Returns whether objectId is in the session of known, or None if unknown
+        with self.lock:
+            return known.get(objectId)
+
+    def setAnswer(self, known, objectId, contained):
+        with self.lock:
+            known[objectId] = contained
+
+    def getParentId(self, objectId, lookup):
+        with self.lock:
+            if objectId in self.parents:
+                return self.parents[objectId]
+            moves = self.moves
+        # not holding the lock during the database lookup
+        parentId = lookup(objectId)
+        with self.lock:
+            if moves != self.moves:
+                return parentId
+            if len(self.parents) >= AncestorIndex.MAX_ENTRIES:
+                # cached answers rely on the parents to notice moves
+                self.parents.clear()
+                self.sessions.clear()
+            self.parents[objectId] = parentId
+        return parentId
+
+    def invalidateSession(self, sessionId):
+        with self.lock:
+            self.sessions.pop(sessionId, None)
+
+    def objectSaved(self, objectId, parentId):
+        with self.lock:
+            if objectId not in self.parents:
+                # its parent may be looked up right now
+                self.moves += 1
+                return
+            if self.parents[objectId] == parentId:
+                return
+            # moved; anything below it may now be inside or outside any session
+            self.parents.pop(objectId, None)
+            self.sessions.clear()
+            self.moves += 1
+
+
 class Session(AccessControlledModel):
+    ancestorIndex = AncestorIndex()
+
     def initialize(self):
         self.name = "session"
         self.exposeFields(
@@ -23,10 +104,23 @@ class Session(AccessControlledModel):
         self.lockModel = ModelImporter.model("lock", "wholetale")
 
         events.bind("model.tale.save.after", "wholetale", self.updateTaleSession)
+        events.bind("dm.sessionModified", "wholetale.session", self.invalidateIndex)
+        events.bind("dm.sessionDeleted", "wholetale.session", self.invalidateIndex)
+        events.bind("model.folder.save.after", "wholetale.session", self.folderSaved)
+        events.bind("model.item.save.after", "wholetale.session", self.itemSaved)
 
     def validate(self, session):
         return session
 
+    def invalidateIndex(self, event):
+        self.ancestorIndex.invalidateSession(event.info["_id"])
+
+    def folderSaved(self, event):
+        self.ancestorIndex.objectSaved(event.info["_id"], event.info.get("parentId"))
+
+    def itemSaved(self, event):
+        self.ancestorIndex.objectSaved(event.info["_id"], event.info.get("folderId"))
+
     def list(self, user=None, limit=0, offset=0, sort=None):
         """
         List a page of containers for a given user.
@@ -144,18 +238,40 @@ class Session(AccessControlledModel):
         session = self.load(sessionId, level=AccessType.READ, user=user)
         if session is None:
             raise KeyError(sessionId)
-        idSet = set()
-        for entry in session["dataSet"]:
-            idSet.add(objectid.ObjectId(entry["itemId"]))
-
-        return self._containsItemOrAncestor(idSet, objectId)
+        idSet, known = self.ancestorIndex.getSession(session)
+        return self._containsItemOrAncestor(idSet, objectId, known)
 
-    def _containsItemOrAncestor(self, idSet, objectId):
+    def containsItems(self, session, objectIds):
+        """
+        Bulk version of containsItem.
+        :param session: The session in which to check the presence of the items
+        :param objectIds: The items to find
+        :return: The set of ids from objectIds that are not accessible in the session
+        """
+        idSet, known = self.ancestorIndex.getSession(session)
+        return {
+            objectId
+            for objectId in objectIds
+            if not self._containsItemOrAncestor(
+                idSet, objectid.ObjectId(objectId), known
+            )
+        }
+
+    def _containsItemOrAncestor(self, idSet, objectId, known=None):
+        # known, if given, memoizes the answer for ids already visited
         if objectId is None:
             return False
         if objectId in idSet:
             return True
-        return self._containsItemOrAncestor(idSet, self._getParentId(objectId))
+        if known is not None:
+            result = self.ancestorIndex.getAnswer(known, objectId)
+            if result is not None:
+                return result
+        parentId = self.ancestorIndex.getParentId(objectId, self._getParentId)
+        result = self._containsItemOrAncestor(idSet, parentId, known)
+        if known is not None:
+            self.ancestorIndex.setAnswer(known, objectId, result)
+        return result
 
     def _getParentId(self, objectId):
         """
@@ -5,12 +5,18 @@ from girder.constants import AccessType
 from girder.models.model_base import AccessControlledModel
 from girder.utility import path as path_util
 from girder.utility.model_importer import ModelImporter
+from pymongo import UpdateOne
 
 from ..constants import TransferStatus
 
 
 class Transfer(AccessControlledModel):
     OLD_TRANSFER_LIMIT = datetime.timedelta(minutes=1)
+    FINAL_STATUSES = (
+        TransferStatus.DONE,
+        TransferStatus.FAILED,
+        TransferStatus.FAILED_TEMPORARILY,
+    )
 
     def initialize(self):
         self.name = "transfer"
@@ -42,8 +48,11 @@ class Transfer(AccessControlledModel):
 
         if existing is not None:
             transferId = existing["_id"]
+            # keep the resume point of an interrupted transfer
+            offset = existing.get("offset", 0)
         else:
             transferId = objectid.ObjectId()
+            offset = 0
 
         try:
             pathFromRoot = self.getPathFromRoot(user, itemId)
@@ -61,6 +70,7 @@ class Transfer(AccessControlledModel):
             "error": None,
             "size": 0,
             "transferred": 0,
+            "offset": offset,
             "path": pathFromRoot,
         }
 
@@ -80,6 +90,7 @@ class Transfer(AccessControlledModel):
         error=None,
         size=0,
         transferred=0,
+        offset=None,
         setTransferStartTime=False,
         setTransferEndTime=False,
     ):
@@ -92,6 +103,9 @@ class Transfer(AccessControlledModel):
             }
         }
 
+        if offset is not None:
+            update["$set"]["offset"] = offset
+
         if setTransferStartTime or setTransferEndTime:
             update["$currentDate"] = {}
 
@@ -103,6 +117,47 @@ class Transfer(AccessControlledModel):
 
         self.update(query={"_id": transferId}, update=update)
 
+    def setWorkerResult(self, transferId, result):
+        """
+        Records the outcome of a transfer run by a celery worker, for Girder to
+        read when the job of the transfer ends. See lib/celery_transfer.py.
+
+        :param result: {"transferTime": seconds, "verifiedChecksums": {alg: digest}}
+         if the transfer succeeded, or
+         {"error": message, "fatal": bool} if it failed.
+        :type result: dict
+        """
+        self.update(query={"_id": transferId}, update={"$set": {"workerResult": result}})
+
+    def setProgress(self, progress):
+        """
+        Records the progress of several transfers in a single bulk write. Transfers
+        that have already completed or failed are left untouched, so a late
+        progress update cannot overwrite a final status.
+
+        :param progress: A dictionary mapping transfer ids to (size, transferred,
+         offset) tuples. The offset is not updated if it is None.
+        :type progress: dict
+        """
+        ops = []
+        for transferId, (size, transferred, offset) in progress.items():
+            fields = {
+                "status": TransferStatus.TRANSFERRING,
+                "error": None,
+                "size": size,
+                "transferred": transferred,
+            }
+            if offset is not None:
+                fields["offset"] = offset
+            ops.append(
+                UpdateOne(
+                    {"_id": transferId, "status": {"$nin": self.FINAL_STATUSES}},
+                    {"$set": fields},
+                )
+            )
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+
     def list(self, user=None, sessionId=None, discardOld=True):
         if sessionId is None:
             return self.listAllForUser(user, discardOld=discardOld)
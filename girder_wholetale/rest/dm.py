@@ -3,8 +3,11 @@
 
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
-from girder.api.rest import Resource
+from girder.api.rest import Resource, rawResponse, setResponseHeader
 
+from ..lib import dm_metrics
+from ..models.lock import Lock as LockModel
+from ..models.psinfo import PSInfo
 from ..models.session import Session as SessionModel
 
 
@@ -50,3 +53,44 @@ class DM(Resource):
     )
     def clearCache(self, force):
         self.cacheManager.clearCache(force)
+
+    @access.admin
+    @autoDescribeRoute(
+        Description(
+            "Get the state of the transfer queue: the number of transfer workers, "
+            "how many of them are busy, and how many transfers are waiting."
+        ).errorResponse("Admin access required.", 403)
+    )
+    def getTransferQueue(self):
+        return self.cacheManager.transferManager.getStats()
+
+    @access.admin
+    @autoDescribeRoute(
+        Description(
+            "Get the state of the data manager: the transfer queue, pending deletions, "
+            "the private storage usage, the lock hit ratio and all the counters and "
+            "histograms exported by /dm/metrics."
+        ).errorResponse("Admin access required.", 403)
+    )
+    def getStats(self):
+        psInfo = PSInfo()
+        hits = dm_metrics.LOCKS.get(result="hit")
+        misses = dm_metrics.LOCKS.get(result="miss")
+        return {
+            "transferQueue": self.cacheManager.transferManager.getStats(),
+            "pendingDeletes": LockModel().getPendingDeleteStats(),
+            "privateStorage": {"used": psInfo.sizeUsed(), "capacity": psInfo.totalSize()},
+            "lockHitRatio": hits / (hits + misses) if hits + misses else None,
+            "metrics": dm_metrics.REGISTRY.snapshot(),
+        }
+
+    @access.admin
+    @rawResponse
+    @autoDescribeRoute(
+        Description(
+            "Get the data manager metrics in the Prometheus text format."
+        ).errorResponse("Admin access required.", 403)
+    )
+    def getMetrics(self):
+        setResponseHeader("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        return dm_metrics.REGISTRY.render()
@@ -1,18 +1,30 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 
-
+import cherrypy
 from girder.api import access
-from girder.api.describe import Description, describeRoute
-from girder.api.rest import Resource, filtermodel, loadmodel
+from girder.api.describe import Description, autoDescribeRoute, describeRoute
+from girder.api.rest import (
+    Resource,
+    filtermodel,
+    loadmodel,
+    setContentDisposition,
+    setResponseHeader,
+)
 from girder.constants import AccessType
 from girder.exceptions import RestException
+from girder.models.setting import Setting
 
+from ..constants import PluginSettings
 from ..models.session import Session
 from ..models.lock import Lock as LockModel
 
 
 class Lock(Resource):
+    # set by the plugin; used to read files that are still being transferred
+    transferManager = None
+
     def initialize(self):
         self.name = "lock"
         self.exposeFields(
@@ -110,6 +122,7 @@ class Lock(Resource):
         .param("itemId", "The item to lock", paramType="query")
         .param("ownerId", "The lock owner.", paramType="query", required=False)
         .errorResponse("Item not in session.", 404)
+        .errorResponse("Timed out waiting for the item to leave the cache.", 503)
     )
     def acquireLock(self, params):
         user = self.getCurrentUser()
@@ -120,20 +133,167 @@ class Lock(Resource):
             ownerId = params["ownerId"]
         if not Session().containsItem(sessionId, itemId, user):
             raise RestException("Item not in the session", 404)
-        return LockModel().acquireLock(
-            user, sessionId, itemId, ownerId
+        try:
+            return LockModel().acquireLock(user, sessionId, itemId, ownerId)
+        except TimeoutError as exc:
+            raise RestException(str(exc), 503)
+
+    @access.user
+    @filtermodel(model="lock", plugin="wholetale")
+    @autoDescribeRoute(
+        Description("Acquires locks on several items at once.")
+        .modelParam(
+            "sessionId",
+            "A Data Manager session.",
+            model=Session,
+            level=AccessType.READ,
+            paramType="query",
         )
+        .jsonParam(
+            "itemIds",
+            "A JSON list of the ids of the items to lock.",
+            paramType="query",
+            requireArray=True,
+        )
+        .param("ownerId", "The lock owner.", required=False)
+        .errorResponse("Some items are not in the session.", 404)
+        .errorResponse("Timed out waiting for an item to leave the cache.", 503)
+    )
+    def acquireLocks(self, session, itemIds, ownerId):
+        user = self.getCurrentUser()
+        missing = Session().containsItems(session, itemIds)
+        if missing:
+            raise RestException(
+                "Items not in the session: %s" % ", ".join(str(_) for _ in missing),
+                404,
+            )
+        try:
+            return LockModel().acquireLocks(user, session["_id"], itemIds, ownerId)
+        except TimeoutError as exc:
+            raise RestException(str(exc), 503)
+
+    @access.user
+    @autoDescribeRoute(
+        Description(
+            "Releases locks on several items at once. For each item in the list, "
+            "one lock held in the session is removed. Returns the number of locks "
+            "that were removed."
+        )
+        .modelParam(
+            "sessionId",
+            "A Data Manager session.",
+            model=Session,
+            level=AccessType.READ,
+            paramType="query",
+        )
+        .jsonParam(
+            "itemIds",
+            "A JSON list of the ids of the items to unlock.",
+            paramType="query",
+            requireArray=True,
+        )
+        .param("ownerId", "Only remove locks with this owner.", required=False)
+    )
+    def releaseLocks(self, session, itemIds, ownerId):
+        user = self.getCurrentUser()
+        return LockModel().releaseLocks(user, session["_id"], itemIds, ownerId)
 
     @access.user
     @loadmodel(model="lock", plugin="wholetale", level=AccessType.READ)
     @describeRoute(
         Description("Download the item locked by a lock.")
+        .notes(
+            'This endpoint accepts the HTTP "Range" and "If-Range" headers for '
+            "partial downloads. A single range is supported. Ranges of an item "
+            "that is still being transferred are served as soon as they arrive."
+        )
         .param("id", "The ID of the lock.", paramType="path")
         .errorResponse("ID was invalid.")
         .errorResponse("Access was denied for the lock.", 403)
+        .errorResponse("The requested range cannot be satisfied.", 416)
     )
     def downloadItem(self, lock, params):
-        return LockModel().downloadItem(lock)
+        item = LockModel().getLockedItem(lock)
+        if not item["dm"].get("cached") and cherrypy.request.headers.get("Range"):
+            return self._downloadPartialItem(item)
+        item = LockModel().getCachedItem(lock)
+        psPath = item["dm"]["psPath"]
+        stat = os.stat(psPath)
+        etag = '"%x-%x-%x"' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        lastModified = cherrypy.lib.httputil.HTTPDate(stat.st_mtime)
+        setResponseHeader("ETag", etag)
+        setResponseHeader("Last-Modified", lastModified)
+        setResponseHeader("Accept-Ranges", "bytes")
+        setResponseHeader("Content-Type", "application/octet-stream")
+        setContentDisposition(item["name"])
+
+        headers = cherrypy.request.headers
+        ifNoneMatch = [tag.strip() for tag in headers.get("If-None-Match", "").split(",")]
+        if etag in ifNoneMatch or "*" in ifNoneMatch:
+            cherrypy.response.status = 304
+            return lambda: iter(())
+
+        offload = Setting().get(PluginSettings.DOWNLOAD_OFFLOAD)
+        if offload:
+            # the front end server reads the file and answers Range requests
+            if offload == "x-accel-redirect":
+                root = Setting().get(PluginSettings.PRIVATE_STORAGE_PATH)
+                prefix = Setting().get(PluginSettings.DOWNLOAD_ACCEL_PREFIX)
+                path = os.path.relpath(psPath, root)
+                setResponseHeader("X-Accel-Redirect", prefix.rstrip("/") + "/" + path)
+            else:
+                setResponseHeader("X-Sendfile", psPath)
+            return lambda: iter(())
+
+        size = stat.st_size
+        offset, endByte = 0, size
+        rangeRequest = headers.get("Range")
+        ifRange = headers.get("If-Range")
+        if rangeRequest and ifRange and ifRange not in (etag, lastModified):
+            # the file changed since the client got the rest of it
+            rangeRequest = None
+        ranges = cherrypy.lib.httputil.get_ranges(rangeRequest, size)
+        if ranges == []:
+            setResponseHeader("Content-Range", "bytes */%d" % size)
+            raise RestException("Requested range not satisfiable.", code=416)
+        if ranges:
+            offset, endByte = ranges[0]
+            setResponseHeader("Content-Range", "bytes %d-%d/%d" % (offset, endByte - 1, size))
+        setResponseHeader("Content-Length", endByte - offset)
+        return LockModel().downloadItem(lock, offset, endByte)
+
+    def _downloadPartialItem(self, item):
+        size = item["size"]
+        ranges = cherrypy.lib.httputil.get_ranges(cherrypy.request.headers["Range"], size)
+        if ranges == []:
+            setResponseHeader("Content-Range", "bytes */%d" % size)
+            raise RestException("Requested range not satisfiable.", code=416)
+        if not ranges:
+            raise ValueError("Item is not available yet")
+        offset, endByte = ranges[0]
+        f = None
+        if self.transferManager is not None:
+            f = self.transferManager.openPartial(item["_id"], offset, endByte)
+        if f is None:
+            raise ValueError("Item is not available yet")
+        setResponseHeader("Accept-Ranges", "bytes")
+        setResponseHeader("Content-Type", "application/octet-stream")
+        setContentDisposition(item["name"])
+        setResponseHeader("Content-Range", "bytes %d-%d/%d" % (offset, endByte - 1, size))
+        setResponseHeader("Content-Length", endByte - offset)
+
+        def stream():
+            with f:
+                f.seek(offset)
+                remaining = endByte - offset
+                while remaining > 0:
+                    data = f.read(min(LockModel.DOWNLOAD_BUF_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    yield data
+
+        return stream
 
     @access.user
     @describeRoute(
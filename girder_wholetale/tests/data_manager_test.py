@@ -1,13 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import hashlib
 import json
 import os
+import threading
 import time
+import types
 
 import cherrypy
 import pytest
 from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.timestamp import Timestamp
+from girder import events
 from girder.models.assetstore import Assetstore
 from girder.models.collection import Collection
 from girder.models.folder import Folder
@@ -16,7 +22,8 @@ from girder.models.setting import Setting
 from pytest_girder.assertions import assertStatus, assertStatusOk
 from pytest_girder.utils import getResponseBody
 
-from girder_wholetale.models.lock import Lock
+from girder_wholetale.models.lock import Lock, deletionNotifier
+from girder_wholetale.models.psinfo import PSInfo
 from girder_wholetale.models.session import Session
 from girder_wholetale.models.tale import Tale
 from girder_wholetale.models.transfer import Transfer
@@ -59,12 +66,12 @@ def structure2(server, user, tmp_path_factory, fsAssetstore):
     yield createStructure(user, tmp_path_factory, "test2_")
 
 
-def createHttpFile(server, testServer, user, folder):
+def createHttpFile(server, testServer, user, folder, url=None):
     params = {
         "parentType": "folder",
         "parentId": folder["_id"],
         "name": "httpitem1",
-        "linkUrl": testServer.getUrl() + "/1M",
+        "linkUrl": url or testServer.getUrl() + "/1M",
         "size": MB,
     }
     resp = server.request(path="/file", method="POST", user=user, params=params)
@@ -454,6 +461,50 @@ def test06resources(server, user, structure, tfiles):
     assertStatusOk(resp)
     body = getResponseBody(resp)
     assert len(body) == item["size"]
+    with open(psPath, "rb") as f:
+        data = f.read()
+    etag = resp.headers["ETag"]
+    assert resp.headers["Last-Modified"]
+
+    download = "/dm/lock/%s/download" % lockId
+    resp = server.request(
+        download, user=user, isJson=False, additionalHeaders=[("Range", "bytes=1-4")]
+    )
+    assertStatus(resp, 206)
+    assert resp.headers["Content-Range"] == "bytes 1-4/%d" % len(data)
+    assert getResponseBody(resp, text=False) == data[1:5]
+
+    # stale If-Range gets the whole file
+    resp = server.request(
+        download,
+        user=user,
+        isJson=False,
+        additionalHeaders=[("Range", "bytes=1-4"), ("If-Range", '"stale"')],
+    )
+    assertStatusOk(resp)
+    assert getResponseBody(resp, text=False) == data
+
+    resp = server.request(
+        download, user=user, isJson=False, additionalHeaders=[("Range", "bytes=%d-" % MB)]
+    )
+    assertStatus(resp, 416)
+
+    resp = server.request(
+        download, user=user, isJson=False, additionalHeaders=[("If-None-Match", etag)]
+    )
+    assertStatus(resp, 304)
+
+    Setting().set("dm.download_offload", "x-accel-redirect")
+    try:
+        resp = server.request(download, user=user, isJson=False)
+        assertStatusOk(resp)
+        root = Setting().get("dm.private_storage_path")
+        assert resp.headers["X-Accel-Redirect"] == "/dm-private-storage/" + os.path.relpath(
+            psPath, root
+        )
+        assert getResponseBody(resp) == ""
+    finally:
+        Setting().set("dm.download_offload", "")
 
     resp = server.request("/dm/lock/%s" % lockId, method="DELETE", user=user)
     assertStatusOk(resp)
@@ -472,18 +523,21 @@ def reloadItemRest(server, user, item):
 
 
 @pytest.mark.plugin("wholetale")
-def test07FileGC(server, user, structure, tfiles):
+def test07FileGC(server, user, structure, tfiles, tmp_path, monkeypatch):
     def _getCachedItems():
         return list(Item().find({"dm.cached": True}, user=user))
 
     apiroot = cherrypy.tree.apps["/api"].root.v1
     gc = apiroot.dm.getFileGC()
     gc.pause()
+    # other tests leave files behind in the private storage
+    PSInfo().updateInfo(0)
 
     collection, folder, files, gfiles = structure
     dataSet = makeDataSet(gfiles)
     _testItem(server, dataSet, gfiles[0], user, tfiles)
     _testItem(server, dataSet, gfiles[1], user, tfiles)
+    assert PSInfo().sizeUsed() == 2 * MB
 
     cachedItems = _getCachedItems()
     assert len(cachedItems) == 2
@@ -502,6 +556,27 @@ def test07FileGC(server, user, structure, tfiles):
 
     assert remainingCount == 1
     assert len(_getCachedItems()) == 1
+    assert PSInfo().sizeUsed() == MB
+
+    psPath = Setting().get("dm.private_storage_path")
+    Setting().set("dm.private_storage_path", str(tmp_path))
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "f").write_bytes(b"x" * 100)
+    (tmp_path / "a" / "g.part").write_bytes(b"x" * 10)
+    try:
+        assert PSInfo().reconcile() == 100
+        assert PSInfo().sizeUsed() == 100
+        # the time of the reconcile is read back from the database, also by
+        # clients that are not tz aware and load naive datetimes
+        assert not PSInfo().needsReconcile(3600)
+        monkeypatch.setattr(
+            PSInfo(), "collection", PSInfo().collection.with_options(CodecOptions())
+        )
+        assert PSInfo().findOne()["updated"].tzinfo is None
+        assert not PSInfo().needsReconcile(3600)
+        assert PSInfo().needsReconcile(0)
+    finally:
+        Setting().set("dm.private_storage_path", psPath)
     gc.resume()
 
 
@@ -590,3 +665,879 @@ def test09TaleUpdateEventHandler(server, user, structure):
         path="/dm/session/{_id}".format(**session), method="DELETE", user=user
     )
     assertStatusOk(resp)
+
+
+@pytest.mark.plugin("wholetale")
+def test10TransferSchedulerPriority(server, admin):
+    from girder_wholetale.constants import TransferPriority
+    from girder_wholetale.lib.transfer_manager import TransferScheduler
+
+    class _Task:
+        def __init__(self, name, order, gate=None):
+            self.name = name
+            self.order = order
+            self.gate = gate
+
+        def run(self):
+            if self.gate is not None:
+                self.gate.wait(10)
+            self.order.append(self.name)
+
+    order = []
+    gate = threading.Event()
+    scheduler = TransferScheduler(1)
+    # occupy the only worker so that everything else queues up
+    scheduler.submit(_Task("blocker", order, gate))
+    while scheduler.getStats()["busy"] != 1:
+        time.sleep(0.01)
+    scheduler.submit(_Task("prefetch", order), TransferPriority.PREFETCH)
+    scheduler.submit(_Task("restart", order), TransferPriority.RESTART)
+    scheduler.submit(_Task("interactive1", order), TransferPriority.INTERACTIVE)
+    scheduler.submit(_Task("interactive2", order), TransferPriority.INTERACTIVE)
+
+    stats = scheduler.getStats()
+    assert stats == {"workers": 1, "busy": 1, "queued": 4, "utilization": 1.0}
+
+    gate.set()
+    scheduler.queue.join()
+    assert order == ["blocker", "interactive1", "interactive2", "restart", "prefetch"]
+
+    # a task that raises does not take its worker down
+    class _FailingTask:
+        def run(self):
+            raise RuntimeError("database unavailable")
+
+    scheduler.submit(_FailingTask())
+    scheduler.submit(_Task("after", order))
+    scheduler.queue.join()
+    assert order[-1] == "after"
+    assert scheduler.workers[0].is_alive()
+
+    resp = server.request("/dm/transfer/queue", method="GET", user=admin)
+    assertStatusOk(resp)
+    assert set(resp.json.keys()) == {"workers", "busy", "queued", "utilization"}
+
+
+@pytest.mark.plugin("wholetale")
+def test11SegmentedHttpTransfer(server, user, httpServer, structure, tfiles):
+    from .httpserver import pattern
+
+    collection, folder, files, gfiles = structure
+    size = 32 * MB
+    resp = server.request(
+        path="/file",
+        method="POST",
+        user=user,
+        params={
+            "parentType": "folder",
+            "parentId": folder["_id"],
+            "name": "segmented",
+            "linkUrl": httpServer.getUrl() + "/32M",
+            "size": size,
+        },
+    )
+    assertStatusOk(resp)
+    item = Item().load(resp.json["itemId"], user=user)
+    Item().setMetadata(
+        item, {"checksum": {"md5": hashlib.md5(pattern(0, size)).hexdigest()}}
+    )
+
+    Setting().set("dm.transfer_segments", 4)
+    _testItem(server, makeDataSet([item]), item, user, tfiles)
+    item = Item().load(item["_id"], user=user)
+    assert item["dm"]["cached"]
+    with open(item["dm"]["psPath"], "rb") as fp:
+        assert fp.read() == pattern(0, size)
+    Item().remove(item)
+
+
+@pytest.mark.plugin("wholetale")
+def test12ResumeInterruptedTransfer(server, user, httpServer, structure):
+    from .httpserver import pattern
+
+    collection, folder, files, gfiles = structure
+    size = 4 * MB
+    resp = server.request(
+        path="/file",
+        method="POST",
+        user=user,
+        params={
+            "parentType": "folder",
+            "parentId": folder["_id"],
+            "name": "resumed",
+            "linkUrl": httpServer.getUrl() + "/4M",
+            "size": size,
+        },
+    )
+    assertStatusOk(resp)
+    item = Item().load(resp.json["itemId"], user=user)
+    expected = b"\0" * (2 * MB) + pattern(2 * MB, size)
+    # checksums are computed while streaming, including the resumed prefix
+    Item().setMetadata(
+        item,
+        {
+            "checksum": {
+                "SHA-256": hashlib.sha256(expected).hexdigest(),
+                "md5": hashlib.md5(expected).hexdigest(),
+                "UNF": "UNF:6:unverifiable==",
+            }
+        },
+    )
+    session = Session().createSession(user, dataSet=makeDataSet([item]))
+
+    transferManager = cherrypy.tree.apps["/api"].root.v1.dm.cacheManager.transferManager
+    transfer = Transfer().createTransfer(user, item["_id"], session["_id"])
+    handler = transferManager.getTransferHandler(transfer["_id"], item["_id"], user)
+
+    # Pretend that the first half was written before a restart. The prefix is
+    # zeroed, so that a transfer started from scratch can be told apart.
+    os.makedirs(os.path.dirname(handler.partPath), exist_ok=True)
+    with open(handler.partPath, "wb") as fp:
+        fp.write(b"\0" * (3 * MB))
+    Transfer().setStatus(transfer["_id"], 2, size=size, transferred=2 * MB, offset=2 * MB)
+    transfer = Transfer().createTransfer(user, item["_id"], session["_id"])
+    assert transfer["offset"] == 2 * MB
+    assert handler.getResumeOffset() == 2 * MB
+
+    handler.transfer()
+    assert not os.path.exists(handler.partPath)
+    with open(handler.psPath, "rb") as fp:
+        assert fp.read() == expected
+
+    os.remove(handler.psPath)
+    Session().deleteSession(user, session)
+    Item().remove(item)
+
+
+@pytest.mark.plugin("wholetale")
+def test13CoalescedTransferProgress(server, user, structure, monkeypatch):
+    from girder_wholetale.constants import TransferStatus
+    from girder_wholetale.lib.transfer_manager import TransferProgressAggregator
+
+    collection, folder, files, gfiles = structure
+    transferManager = cherrypy.tree.apps["/api"].root.v1.dm.cacheManager.transferManager
+    # no flusher thread, so that pending updates stay until flushed below
+    aggregator = TransferProgressAggregator(start=False)
+    monkeypatch.setattr(transferManager, "progress", aggregator)
+    transfers = [
+        Transfer().createTransfer(user, item["_id"], ObjectId()) for item in gfiles[:2]
+    ]
+
+    for i in range(1, 101):
+        for transfer in transfers:
+            transferManager.transferProgress(transfer["_id"], 100, i, offset=i)
+    # only the latest update of each transfer is kept
+    assert set(aggregator.pending) == {t["_id"] for t in transfers}
+    aggregator.flush()
+    for transfer in transfers:
+        transfer = Transfer().load(transfer["_id"], force=True)
+        assert transfer["status"] == TransferStatus.TRANSFERRING
+        assert transfer["transferred"] == 100
+        assert transfer["offset"] == 100
+
+    # a progress update that arrives late does not undo a final status
+    Transfer().setStatus(transfers[0]["_id"], TransferStatus.DONE, size=100, transferred=100)
+    transferManager.transferProgress(transfers[0]["_id"], 100, 50)
+    aggregator.flush()
+    transfer = Transfer().load(transfers[0]["_id"], force=True)
+    assert transfer["status"] == TransferStatus.DONE
+    assert transfer["transferred"] == 100
+
+
+@pytest.mark.plugin("wholetale")
+def test14WaitForPendingDelete(server, user, structure):
+    collection, folder, files, gfiles = structure
+    itemId = gfiles[0]["_id"]
+    Item().update({"_id": itemId}, {"$set": {Lock.FIELD_DELETE_IN_PROGRESS: True}})
+
+    with pytest.raises(TimeoutError):
+        Lock().waitForPendingDelete(itemId, timeout=0.2)
+    assert Lock().getPendingDeleteStats()["timeouts"] >= 1
+    assert itemId not in deletionNotifier.events
+
+    # Waiters are woken up as soon as the deletion finishes. Without a
+    # notification the backoff would put the waiter to sleep for a while.
+    Lock.PENDING_DELETE_MIN_RECHECK = 5
+    try:
+        done = threading.Event()
+        waiter = threading.Thread(
+            target=lambda: (Lock().waitForPendingDelete(itemId), done.set())
+        )
+        waiter.start()
+        time.sleep(0.2)
+        assert not done.is_set()
+        Lock().unlockForDeletion(itemId)
+        assert done.wait(2)
+        waiter.join()
+    finally:
+        Lock.PENDING_DELETE_MIN_RECHECK = 0.05
+    item = Item().load(itemId, force=True)
+    assert item["dm"]["lockCount"] == 1
+    Lock().unlock(itemId)
+
+    # waiters that did not have to wait leave nothing behind
+    Lock().waitForPendingDelete(itemId)
+    Lock().unlock(itemId)
+    assert itemId not in deletionNotifier.events
+
+
+@pytest.mark.plugin("wholetale")
+def test15BulkLocks(server, user, structure, structure2, tfiles, monkeypatch):
+    collection, folder, files, gfiles = structure
+    _, _, _, gfiles2 = structure2
+    dataSet = makeDataSet([{"_id": folder["_id"], "name": "fldr"}], objectids=False)
+    session = Session().createSession(user, dataSet=dataSet)
+    itemIds = [str(item["_id"]) for item in gfiles]
+
+    resp = server.request(
+        "/dm/lock/bulk",
+        method="POST",
+        user=user,
+        params={
+            "sessionId": str(session["_id"]),
+            "itemIds": json.dumps(itemIds + [str(gfiles2[0]["_id"])]),
+        },
+    )
+    assertStatus(resp, 404)
+    assert str(gfiles2[0]["_id"]) in resp.json["message"]
+    assert len(list(Lock().listLocks(user, session["_id"]))) == 0
+
+    resp = server.request(
+        "/dm/lock/bulk",
+        method="POST",
+        user=user,
+        params={"sessionId": str(session["_id"]), "itemIds": json.dumps(itemIds)},
+    )
+    assertStatusOk(resp)
+    assert [lock["itemId"] for lock in resp.json] == itemIds
+    # session ids are stored as ObjectIds, as with POST /dm/lock
+    assert len(list(Lock().find({"sessionId": session["_id"]}))) == len(itemIds)
+    assert len(list(Lock().listLocks(user, str(session["_id"])))) == len(itemIds)
+
+    for item in gfiles:
+        item = Item().load(item["_id"], user=user)
+        assert item["dm"]["lockCount"] == 1
+        tfiles.add(waitForFile(server, user, item))
+        item = Item().load(item["_id"], user=user)
+        assert "token" not in item["dm"].get("transfer", {})
+
+    resp = server.request(
+        "/dm/lock/bulk",
+        method="DELETE",
+        user=user,
+        params={"sessionId": str(session["_id"]), "itemIds": json.dumps(itemIds)},
+    )
+    assertStatusOk(resp)
+    assert resp.json == len(itemIds)
+    assert len(list(Lock().listLocks(user, session["_id"]))) == 0
+    for item in gfiles:
+        item = Item().load(item["_id"], user=user)
+        assert item["dm"]["lockCount"] == 0
+        assert item["dm"]["cached"]
+
+    # nothing stays locked when waiting for a deletion times out
+    monkeypatch.setattr(Lock, "PENDING_DELETE_TIMEOUT", 0.2)
+    accessCounts = {
+        item["_id"]: Item().load(item["_id"], force=True)["dm"]["accessCount"]
+        for item in gfiles
+    }
+    Item().update({"_id": gfiles[0]["_id"]}, {"$set": {Lock.FIELD_DELETE_IN_PROGRESS: True}})
+    with pytest.raises(TimeoutError):
+        Lock().acquireLocks(user, session["_id"], itemIds)
+    Item().update({"_id": gfiles[0]["_id"]}, {"$set": {Lock.FIELD_DELETE_IN_PROGRESS: False}})
+    assert len(list(Lock().listLocks(user, session["_id"]))) == 0
+    for item in gfiles:
+        item = Item().load(item["_id"], force=True)
+        assert item["dm"]["lockCount"] == 0
+        assert item["dm"]["accessCount"] == accessCounts[item["_id"]]
+    Session().deleteSession(user, session)
+
+
+@pytest.mark.plugin("wholetale")
+def test16CachedContainment(server, user, structure, structure2):
+    collection, folder, files, gfiles = structure
+    _, folder2, _, gfiles2 = structure2
+    dataSet = makeDataSet([{"_id": folder["_id"], "name": "fldr"}])
+    session = Session().createSession(user, dataSet=dataSet)
+    item = gfiles[0]
+
+    assert Session().containsItem(session["_id"], item["_id"], user)
+    assert not Session().containsItem(session["_id"], gfiles2[0]["_id"], user)
+
+    lookups = []
+    getParentId = Session()._getParentId
+    Session()._getParentId = lambda objectId: lookups.append(objectId) or getParentId(
+        objectId
+    )
+    try:
+        assert Session().containsItem(session["_id"], item["_id"], user)
+        assert not Session().containsItem(session["_id"], gfiles2[0]["_id"], user)
+        assert lookups == []
+
+        # moving an item in or out of the dataSet is noticed
+        moved = Item().move(Item().load(gfiles2[1]["_id"], force=True), folder)
+        assert Session().containsItem(session["_id"], moved["_id"], user)
+        Item().move(moved, folder2)
+        assert not Session().containsItem(session["_id"], moved["_id"], user)
+
+        session = Session().modifySession(user, session, makeDataSet([folder2]))
+        assert not Session().containsItem(session["_id"], item["_id"], user)
+        assert Session().containsItem(session["_id"], gfiles2[0]["_id"], user)
+    finally:
+        del Session()._getParentId
+    Session().deleteSession(user, session)
+
+
+@pytest.mark.plugin("wholetale")
+def test17StreamedLRUCandidates(server, user, structure):
+    collection, folder, files, gfiles = structure
+    gc = cherrypy.tree.apps["/api"].root.v1.dm.getFileGC()
+    indices = Item().collection.index_information().values()
+    assert [("dm.cached", 1), ("dm.lockCount", 1), ("dm.lastUnlocked", 1)] in [
+        list(index["key"]) for index in indices
+    ]
+
+    now = int(time.time())
+    order = [gfiles[2], gfiles[0], gfiles[3]]
+    for i, item in enumerate(order):
+        Item().update(
+            {"_id": item["_id"]},
+            {
+                "$set": {
+                    "dm.cached": True,
+                    "dm.lockCount": 0,
+                    "dm.lastUnlocked": Timestamp(now + i, 0),
+                }
+            },
+        )
+    ids = {item["_id"] for item in order}
+    candidates = [c["_id"] for c in gc.getSortedCandidates() if c["_id"] in ids]
+    assert candidates == [item["_id"] for item in order]
+    Item().update({"_id": {"$in": list(ids)}}, {"$set": {"dm.cached": False}})
+
+
+@pytest.mark.plugin("wholetale")
+def test18SortingSchemes(server, user):
+    from girder.models.model_base import ValidationException
+
+    from girder_wholetale.lib import gc_simulator
+    from girder_wholetale.lib.file_gc import (
+        CollectionStrategy,
+        FractionalCollectionThresholds,
+    )
+    from girder_wholetale.lib.gc_sorting import GDSFSortingScheme, LRUSortingScheme
+
+    with pytest.raises(ValidationException):
+        Setting().set("dm.gc_sorting_scheme", "random")
+    strategy = CollectionStrategy(FractionalCollectionThresholds())
+    assert isinstance(strategy.sortingScheme, LRUSortingScheme)
+    Setting().set("dm.gc_sorting_scheme", "gdsf")
+    strategy.selectSortingScheme()
+    assert isinstance(strategy.sortingScheme, GDSFSortingScheme)
+    Setting().set("dm.gc_sorting_scheme", "lru")
+
+    # a large, slow to fetch file used daily, among small files used once
+    trace = [{"time": 0, "event": "downloaded", "itemId": "hot", "size": 60}]
+    trace[0]["transferTime"] = 60.0
+    for day in range(20):
+        t = day * 1000
+        trace.append({"time": t, "event": "lock", "itemId": "hot"})
+        trace.append({"time": t + 1, "event": "unlock", "itemId": "hot"})
+        for k in range(10):
+            itemId = "small%s_%s" % (day, k)
+            trace += [
+                {"time": 0, "event": "downloaded", "itemId": itemId, "size": 5},
+                {"time": t + 10 + k, "event": "lock", "itemId": itemId},
+                {"time": t + 20 + k, "event": "unlock", "itemId": itemId},
+            ]
+    traceEvents, files = gc_simulator.readTrace(json.dumps(e) for e in trace)
+    results = gc_simulator.compareSchemes(traceEvents, files, 200, runInterval=100)
+    assert set(results) == {"lru", "lfu", "gdsf", "arc"}
+    assert all(stats["requests"] == 220 for stats in results.values())
+    # LRU evicts the large file every day, the others keep it
+    assert results["lru"]["hits"] == 0
+    for name in ("lfu", "gdsf", "arc"):
+        assert results[name]["byteHitRatio"] > 0.4
+
+
+@pytest.mark.plugin("wholetale")
+def test19BatchedDeletion(server, user, structure, monkeypatch):
+    collection, folder, files, gfiles = structure
+    gc = cherrypy.tree.apps["/api"].root.v1.dm.getFileGC()
+    gc.pause()
+
+    def cache(items):
+        for item in items:
+            path = gc.pathMapper.getPSPath(item["_id"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"\0")
+            Item().update(
+                {"_id": item["_id"]},
+                {
+                    "$set": {
+                        "dm.cached": True,
+                        "dm.lockCount": 0,
+                        "dm.psPath": path,
+                        "dm.lastUnlocked": Timestamp(int(time.time()), 0),
+                    }
+                },
+            )
+
+    cache(gfiles)
+    Item().update({"_id": gfiles[0]["_id"]}, {"$set": {"dm.lockCount": 1}})
+    deleted = gc.deleteFiles(gfiles)
+    assert [item["_id"] for item in deleted] == [item["_id"] for item in gfiles[1:]]
+    for item in gfiles:
+        item = Item().load(item["_id"], force=True)
+        locked = item["_id"] == gfiles[0]["_id"]
+        assert item["dm"]["cached"] == locked
+        assert os.path.exists(gc.pathMapper.getPSPath(item["_id"])) == locked
+        assert not item["dm"].get("deleteInProgress")
+        assert "deleteToken" not in item["dm"]
+    Item().update({"_id": gfiles[0]["_id"]}, {"$set": {"dm.lockCount": 0}})
+
+    # a pass stops after the batch that exceeds its time budget
+    cache(gfiles)
+    monkeypatch.setattr(type(gc), "DELETE_BATCH_SIZE", 1)
+    Setting().set("dm.gc_time_budget", 1e-6)
+    Setting().set("dm.private_storage_capacity", MB)
+    PSInfo().updateInfo(len(gfiles) * MB)
+    try:
+        gc._collect()
+    finally:
+        Setting().set("dm.gc_time_budget", 5 * 60)
+        Setting().set("dm.private_storage_capacity", 100 * 1024 * MB)
+
+    def cachedCount():
+        query = {"_id": {"$in": [i["_id"] for i in gfiles]}, "dm.cached": True}
+        return len(list(Item().find(query)))
+
+    assert cachedCount() == len(gfiles) - 1
+    assert PSInfo().sizeUsed() == (len(gfiles) - 1) * MB
+
+    gc.clearCache(False)
+    assert cachedCount() == 0
+    gc.resume()
+
+
+@pytest.mark.plugin("wholetale")
+def test20ContentAddressedStorage(server, user, httpServer, structure, monkeypatch):
+    from girder_wholetale.lib.handlers.common import UrlTransferHandler
+    from .httpserver import pattern
+
+    collection, folder, files, gfiles = structure
+    gc = cherrypy.tree.apps["/api"].root.v1.dm.getFileGC()
+    gc.pause()
+    Setting().set("dm.content_addressed_storage", True)
+    try:
+        items = [createHttpFile(server, httpServer, user, folder) for _ in range(3)]
+        PSInfo().updateInfo(0)
+        dataSet = makeDataSet(items)
+        session = Session().createSession(user, dataSet=dataSet)
+        Lock().acquireLocks(user, session["_id"], [item["_id"] for item in items])
+        paths = []
+        for item in items:
+            paths.append(waitForFile(server, user, Item().load(item["_id"], force=True)))
+        items = [Item().load(item["_id"], force=True) for item in items]
+
+        # stored once, under the content path, and linked from every item
+        key = items[0]["dm"]["contentKey"]
+        assert key.startswith("url/")
+        assert all(item["dm"]["contentKey"] == key for item in items)
+        contentPath = gc.pathMapper.getContentPath(key)
+        inode = os.stat(contentPath).st_ino
+        assert all(os.stat(path).st_ino == inode for path in paths)
+        assert os.stat(contentPath).st_nlink == len(items) + 1
+        assert PSInfo().sizeUsed() == MB
+        with open(paths[1], "rb") as f:
+            assert f.read() == pattern(0, MB)
+
+        Lock().releaseLocks(user, session["_id"], [item["_id"] for item in items])
+        items = [Item().load(item["_id"], force=True) for item in items]
+        assert len(gc.deleteFiles(items[:2])) == 2
+        assert os.path.exists(contentPath)
+        assert PSInfo().sizeUsed() == MB
+        assert len(gc.deleteFiles(items[2:])) == 1
+        assert not os.path.exists(contentPath)
+        assert PSInfo().sizeUsed() == 0
+        Session().deleteSession(user, session)
+
+        # checksums in the metadata are only trusted once the data was checked
+        # against them, so unverified content is not published
+        digest = hashlib.sha256(pattern(0, MB)).hexdigest()
+        key = "sha256/" + digest
+        items = [createHttpFile(server, httpServer, user, folder) for _ in range(2)]
+        items = [Item().setMetadata(item, {"checksum": {"sha256": digest}}) for item in items]
+        session = Session().createSession(user, dataSet=makeDataSet(items))
+        with monkeypatch.context() as m:
+            m.setattr(UrlTransferHandler, "verify_checksum", lambda self, hashers=None: None)
+            Lock().acquireLock(user, session["_id"], items[0]["_id"])
+            waitForFile(server, user, Item().load(items[0]["_id"], force=True))
+        assert not os.path.exists(gc.pathMapper.getContentPath(key))
+        Lock().acquireLock(user, session["_id"], items[1]["_id"])
+        waitForFile(server, user, Item().load(items[1]["_id"], force=True))
+        items = [Item().load(item["_id"], force=True) for item in items]
+        assert items[0]["dm"].get("contentKey") is None
+        assert items[1]["dm"]["contentKey"] == key
+        with open(gc.pathMapper.getContentPath(key), "rb") as f:
+            assert f.read() == pattern(0, MB)
+
+        # nor is data fetched with a user's credentials
+        transferManager = cherrypy.tree.apps["/api"].root.v1.dm.cacheManager.transferManager
+        monkeypatch.setattr(
+            UrlTransferHandler, "headers", property(lambda self: {"Authorization": "token"})
+        )
+        handler = transferManager.getTransferHandler(ObjectId(), items[1]["_id"], user)
+        assert handler.contentKey is None
+        assert handler.flightKey.endswith(str(user["_id"]))
+
+        Lock().releaseLocks(user, session["_id"], [item["_id"] for item in items])
+        items = [Item().load(item["_id"], force=True) for item in items]
+        assert len(gc.deleteFiles(items)) == 2
+        Session().deleteSession(user, session)
+    finally:
+        Setting().set("dm.content_addressed_storage", False)
+        gc.resume()
+
+
+@pytest.mark.plugin("wholetale")
+def test21CoalescedTransfers(server, user, extra_user, httpServer, structure, monkeypatch):
+    from girder_wholetale.lib.handlers.common import UrlTransferHandler
+    from .httpserver import pattern
+
+    collection, folder, files, gfiles = structure
+    gc = cherrypy.tree.apps["/api"].root.v1.dm.getFileGC()
+    gc.pause()
+    url = httpServer.getUrl() + "/1M"
+    # different spellings of the same URL
+    urls = [url, url.replace("localhost", "LocalHost") + "#data"]
+    items = [createHttpFile(server, httpServer, user, folder, url=u) for u in urls]
+    PSInfo().updateInfo(0)
+    dataSet = makeDataSet(items)
+    session = Session().createSession(user, dataSet=dataSet)
+    Lock().acquireLocks(user, session["_id"], [item["_id"] for item in items])
+    paths = [
+        waitForFile(server, user, Item().load(item["_id"], force=True)) for item in items
+    ]
+
+    # fetched once and hard linked
+    assert os.stat(paths[0]).st_ino == os.stat(paths[1]).st_ino
+    assert PSInfo().sizeUsed() == MB
+    with open(paths[1], "rb") as f:
+        assert f.read() == pattern(0, MB)
+
+    Lock().releaseLocks(user, session["_id"], [item["_id"] for item in items])
+    items = [Item().load(item["_id"], force=True) for item in items]
+    assert len(gc.deleteFiles(items[:1])) == 1
+    assert os.path.exists(paths[1])
+    assert PSInfo().sizeUsed() == MB
+    assert len(gc.deleteFiles(items[1:])) == 1
+    assert PSInfo().sizeUsed() == 0
+    Session().deleteSession(user, session)
+    gc.resume()
+
+    # transfers made with per user credentials are only coalesced for that user
+    transferManager = cherrypy.tree.apps["/api"].root.v1.dm.cacheManager.transferManager
+
+    def flightKeys():
+        return [
+            transferManager.getTransferHandler(ObjectId(), items[0]["_id"], u).flightKey
+            for u in (user, extra_user)
+        ]
+
+    keys = flightKeys()
+    assert keys[0] == keys[1]
+    monkeypatch.setattr(
+        UrlTransferHandler, "headers", property(lambda self: {"Authorization": "token"})
+    )
+    keys = flightKeys()
+    assert keys[0] != keys[1]
+    assert keys[0].endswith(str(user["_id"]))
+
+
+@pytest.mark.plugin("wholetale")
+def test22PartialDownload(server, user, httpServer, structure, monkeypatch, tmp_path):
+    from girder_wholetale.lib.handlers.common import FileLikeUrlTransferHandler
+    from girder_wholetale.lib.tm_utils import RangeSet
+    from .httpserver import pattern
+
+    collection, folder, files, gfiles = structure
+    transferManager = cherrypy.tree.apps["/api"].root.v1.dm.cacheManager.transferManager
+    release = threading.Event()
+    transferBytes = FileLikeUrlTransferHandler.transferBytes
+
+    def stalledTransferBytes(self, outf, inf):
+        release.wait(30)
+        transferBytes(self, outf, inf)
+
+    monkeypatch.setattr(FileLikeUrlTransferHandler, "transferBytes", stalledTransferBytes)
+    item = createHttpFile(server, httpServer, user, folder)
+    session = Session().createSession(user, dataSet=makeDataSet([item]))
+    try:
+        resp = server.request(
+            "/dm/lock",
+            method="POST",
+            user=user,
+            params={"sessionId": str(session["_id"]), "itemId": str(item["_id"])},
+        )
+        assertStatusOk(resp)
+        lockId = resp.json["_id"]
+        for _ in range(300):
+            if item["_id"] in transferManager.partial:
+                break
+            time.sleep(0.1)
+
+        # the transfer is stuck at the start, so the range is fetched ahead of it
+        resp = server.request(
+            "/dm/lock/%s/download" % lockId,
+            user=user,
+            isJson=False,
+            additionalHeaders=[("Range", "bytes=500000-500999")],
+        )
+        assertStatus(resp, 206)
+        assert resp.headers["Content-Range"] == "bytes 500000-500999/%d" % MB
+        assert getResponseBody(resp, text=False) == pattern(500000, 501000)
+        assert not Item().load(item["_id"], force=True)["dm"].get("cached")
+    finally:
+        release.set()
+    psPath = waitForFile(server, user, Item().load(item["_id"], force=True))
+    with open(psPath, "rb") as f:
+        assert f.read() == pattern(0, MB)
+    assert item["_id"] not in transferManager.partial
+    server.request("/dm/lock/%s" % lockId, method="DELETE", user=user)
+    Session().deleteSession(user, session)
+
+    # the partial file is gone if it failed checksum verification
+    present = RangeSet()
+    present.add(0, MB)
+    discarded = types.SimpleNamespace(
+        present=present,
+        partPath=str(tmp_path / "item.part"),
+        getPhysicalPath=lambda: str(tmp_path / "item"),
+    )
+    monkeypatch.setitem(transferManager.partial, item["_id"], discarded)
+    assert transferManager.openPartial(item["_id"], 0, 1000) is None
+
+
+@pytest.mark.plugin("wholetale")
+def test23Prefetch(server, user, httpServer, structure):
+    collection, folder, files, gfiles = structure
+    gc = cherrypy.tree.apps["/api"].root.v1.dm.getFileGC()
+    gc.pause()
+    cacheManager = cherrypy.tree.apps["/api"].root.v1.dm.cacheManager
+    items = [createHttpFile(server, httpServer, user, folder) for _ in range(3)]
+    # the most frequently locked items come first
+    for item, count in zip(items, (3, 5, 0)):
+        Item().update({"_id": item["_id"]}, {"$set": {"dm.accessCount": count}})
+
+    session = Session().createSession(user, dataSet=makeDataSet(items))
+    cacheManager.prefetchPool.submit(lambda: None).result()
+    assert not any(
+        Item().load(item["_id"], force=True)["dm"].get("transferInProgress") for item in items
+    )
+    Session().deleteSession(user, session)
+
+    Setting().set("dm.prefetch_budget", 2 * MB)
+    try:
+        session = Session().createSession(user, dataSet=makeDataSet(items))
+        cacheManager.prefetchPool.submit(lambda: None).result()
+        for item in items[:2]:
+            waitForFile(server, user, Item().load(item["_id"], force=True))
+        item = Item().load(items[2]["_id"], force=True)
+        assert not item["dm"].get("cached")
+        assert not item["dm"].get("transferInProgress")
+        transfers = list(Transfer().find({"sessionId": session["_id"]}))
+        assert sorted(t["itemId"] for t in transfers) == sorted(i["_id"] for i in items[:2])
+
+        # cached items are not prefetched again, and are collectable
+        assert cacheManager.prefetch(session) == [items[2]["_id"]]
+        waitForFile(server, user, Item().load(items[2]["_id"], force=True))
+        candidates = {item["_id"] for item in Lock().getCollectionCandidates()}
+        assert {item["_id"] for item in items} <= candidates
+        Session().deleteSession(user, session)
+
+        # transfers that are not done yet take from the budget
+        used = PSInfo().sizeUsed()
+        start = Setting().get("dm.gc_collect_start_fraction")
+        PSInfo().updateInfo(int(PSInfo().totalSize() * start) - MB)
+        assert cacheManager.prefetchPolicy.getBudget() == MB
+        Item().update({"_id": items[0]["_id"]}, {"$set": {"dm.transferInProgress": True}})
+        assert Lock().getDownloadingSize() == MB
+        assert cacheManager.prefetchPolicy.getBudget() == 0
+        Item().update({"_id": items[0]["_id"]}, {"$set": {"dm.transferInProgress": False}})
+        PSInfo().updateInfo(used)
+    finally:
+        Setting().set("dm.prefetch_budget", 0)
+        gc.resume()
+
+
+@pytest.mark.plugin("wholetale")
+def test24Metrics(server, admin, user, httpServer, structure):
+    from girder_wholetale.lib import dm_metrics
+
+    collection, folder, files, gfiles = structure
+    hits = dm_metrics.LOCKS.get(result="hit")
+    misses = dm_metrics.LOCKS.get(result="miss")
+    done = dm_metrics.TRANSFERS.get(handler="Http", status="done")
+    transferred = dm_metrics.TRANSFER_BYTES.get(handler="Http")
+
+    item = createHttpFile(server, httpServer, user, folder)
+    session = Session().createSession(user, dataSet=makeDataSet([item]))
+    Lock().acquireLock(user, session["_id"], item["_id"])
+    waitForFile(server, user, Item().load(item["_id"], force=True))
+    Lock().acquireLock(user, session["_id"], item["_id"])
+    # the transfer is counted after the item is marked as cached
+    for _ in range(50):
+        if dm_metrics.TRANSFERS.get(handler="Http", status="done") > done:
+            break
+        time.sleep(0.1)
+    assert dm_metrics.LOCKS.get(result="miss") == misses + 1
+    assert dm_metrics.LOCKS.get(result="hit") == hits + 1
+    assert dm_metrics.TRANSFERS.get(handler="Http", status="done") == done + 1
+    assert dm_metrics.TRANSFER_BYTES.get(handler="Http") == transferred + MB
+
+    resp = server.request("/dm/stats", method="GET", user=user)
+    assertStatus(resp, 403)
+    resp = server.request("/dm/stats", method="GET", user=admin)
+    assertStatusOk(resp)
+    stats = resp.json
+    assert stats["transferQueue"]["workers"] >= 1
+    assert stats["privateStorage"]["used"] == PSInfo().sizeUsed()
+    assert 0 < stats["lockHitRatio"] < 1
+    assert isinstance(stats["pendingDeletes"], dict)
+    waits = stats["metrics"]["dm_transfer_queue_wait_seconds"]
+    assert any(sample["priority"] == "interactive" for sample in waits)
+
+    resp = server.request("/dm/metrics", method="GET", user=admin, isJson=False)
+    assertStatusOk(resp)
+    assert resp.headers["Content-Type"].startswith("text/plain")
+    body = getResponseBody(resp)
+    assert "# TYPE dm_transfer_duration_seconds histogram" in body
+    assert 'dm_transfer_duration_seconds_bucket{handler="Http",le="+Inf"}' in body
+    assert 'dm_locks_total{result="hit"} %d' % (hits + 1) in body
+
+    Lock().releaseLocks(user, session["_id"], [item["_id"], item["_id"]])
+    Session().deleteSession(user, session)
+
+
+@pytest.mark.plugin("wholetale")
+def test25CeleryTransferBackend(server, user, httpServer, structure, monkeypatch):
+    from girder_jobs.constants import JobStatus
+    from girder_wholetale.constants import TransferPriority, TransferStatus
+    from girder_wholetale.lib import transfer_worker
+    from girder_wholetale.lib.celery_transfer import CeleryTransferManager
+    from girder_wholetale.lib.tm_utils import TransferException, TransferHandler
+    from .httpserver import pattern
+
+    collection, folder, files, gfiles = structure
+    dm = cherrypy.tree.apps["/api"].root.v1.dm
+    threadCount = threading.active_count()
+    manager = CeleryTransferManager(dm.cacheManager.pathMapper)
+    # transfers are not run nor flushed locally
+    assert threading.active_count() == threadCount
+    tasks = []
+
+    class Signature:
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+
+        def apply_async(self):
+            tasks.append(self.kwargs)
+
+    monkeypatch.setattr(transfer_worker.transferItem, "signature", Signature)
+
+    # different URLs, so that the transfers are not coalesced
+    items = [
+        createHttpFile(server, httpServer, user, folder),
+        createHttpFile(server, httpServer, user, folder, url=httpServer.getUrl() + "/2M"),
+        createHttpFile(server, httpServer, user, folder, url=httpServer.getUrl() + "/3M"),
+    ]
+    session = Session().createSession(user, dataSet=makeDataSet(items))
+    for item in items:
+        assert Lock().tryLock(user, session["_id"], item["_id"], None)
+        manager.startTransfer(user, item["_id"], session["_id"])
+    assert [task["queue"].name for task in tasks] == ["celery"] * 3
+    assert tasks[0]["queue"].queue_arguments == {"x-max-priority": 2}
+    # brokers serve higher priorities first
+    assert tasks[0]["priority"] == 2
+    handler = types.SimpleNamespace(user=user)
+    manager.submitTransfer(items[0]["_id"], ObjectId(), handler, TransferPriority.PREFETCH)
+    assert tasks.pop()["priority"] == 0
+    assert manager.getStats()["queued"] == 3
+    transferIds = [task["girder_job_other_fields"]["dmTransferId"] for task in tasks]
+
+    # what the worker does
+    transfer_worker.transferItem.run(*tasks[0]["args"])
+    item = Item().load(items[0]["_id"], force=True)
+    assert not item["dm"].get("cached")
+    transfer = Transfer().load(ObjectId(transferIds[0]), force=True)
+    assert transfer["status"] != 3
+    transferTime = transfer["workerResult"]["transferTime"]
+    assert transferTime is not None
+
+    # and what its job brings back
+    job = {"_id": ObjectId(), "celeryTaskId": "1", "dmTransferId": transferIds[0]}
+    for status in (JobStatus.RUNNING, JobStatus.SUCCESS, JobStatus.SUCCESS):
+        event = events.Event("jobs.job.update.after", {"job": dict(job, status=status)})
+        manager.jobUpdated(event)
+    item = Item().load(items[0]["_id"], force=True)
+    assert item["dm"]["cached"]
+    assert item["dm"]["transferTime"] == transferTime
+    with open(item["dm"]["psPath"], "rb") as f:
+        assert f.read() == pattern(0, MB)
+    assert Transfer().load(ObjectId(transferIds[0]), force=True)["status"] == 3
+
+    # failures are permanent or temporary, as the worker found them to be
+    errors = [
+        ValueError("no space left"),
+        TransferException(cause="connection reset", fatal=False),
+    ]
+    expected = [
+        (TransferStatus.FAILED, "no space left"),
+        (TransferStatus.FAILED_TEMPORARILY, "connection reset"),
+    ]
+    for task, transferId, item, error, (status, message) in zip(
+        tasks[1:], transferIds[1:], items[1:], errors, expected
+    ):
+        def failingRun(self, error=error):
+            raise error
+
+        monkeypatch.setattr(TransferHandler, "run", failingRun)
+        with pytest.raises(type(error)):
+            transfer_worker.transferItem.run(*task["args"])
+        job = dict(job, dmTransferId=transferId, status=JobStatus.ERROR)
+        manager.jobUpdated(events.Event("jobs.job.update.after", {"job": job}))
+        assert Transfer().load(ObjectId(transferId), force=True)["status"] == status
+        item = Item().load(item["_id"], force=True)
+        assert item["dm"]["transferError"]
+        assert message in item["dm"]["transferErrorMessage"]
+    Session().deleteSession(user, session)
+
+
+@pytest.mark.plugin("wholetale")
+def test26HttpSession(server, httpServer):
+    from girder_wholetale.lib import http_session
+
+    session = http_session.getSession()
+    assert http_session.getSession() is session
+    assert session.timeout == (10, 60)
+    adapter = session.get_adapter(httpServer.getUrl())
+    assert adapter._pool_maxsize == 32
+    assert adapter.max_retries.total == 3
+    assert 503 in adapter.max_retries.status_forcelist
+
+    resp = http_session.get(httpServer.getUrl() + "/1K")
+    assert resp.status_code == 200
+    assert len(resp.content) == 1024
+
+    Setting().set("wholetale.http_retries", 1)
+    Setting().set("wholetale.http_read_timeout", 5)
+    try:
+        newSession = http_session.getSession()
+        assert newSession is not session
+        assert newSession.timeout == (10, 5)
+        assert newSession.get_adapter(httpServer.getUrl()).max_retries.total == 1
+    finally:
+        Setting().set("wholetale.http_retries", 3)
+        Setting().set("wholetale.http_read_timeout", 60)
@@ -1,10 +1,12 @@
 import json
+import os
 import mock
 import pytest
 
 from pytest_girder.assertions import assertStatusOk
 
 import httmock
+import responses
 
 
 @httmock.all_requests
@@ -101,3 +103,130 @@ def test_export_template(server, user, image):
             "token",
         )
         assert "jupyter-repo2docker" in tmpl
+
+
+@pytest.mark.plugin("wholetale")
+def test_export_checksums(server, tmp_path):
+    import hashlib
+
+    from girder_wholetale.lib.exporters import benchmark
+
+    manifest = benchmark.makeWorkspace(str(tmp_path), 3, 2500)
+    (tmp_path / "notes.txt").write_text("Some notes\n" * 1000)
+    manifest["aggregates"].append({"uri": "./workspace/notes.txt"})
+    exporter = benchmark.BenchmarkExporter(str(tmp_path), manifest, chunk_size=1000)
+    with mock.patch.object(exporter, "verify_aggregate_checksums"), mock.patch(
+        "builtins.open", side_effect=open
+    ) as opened, mock.patch.object(
+        exporter.magic_wrapper, "from_file"
+    ) as from_file, mock.patch(
+        "os.path.getsize", side_effect=os.path.getsize
+    ) as getsize:
+        for _ in exporter.stream():
+            pass
+    # every file is read once, while it is zipped
+    paths = [call.args[0] for call in opened.call_args_list]
+    workspace = sorted(str(path) for path in tmp_path.iterdir())
+    assert sorted(path for path in paths if path in workspace) == workspace
+    assert not from_file.called
+    assert not getsize.called
+    assert manifest["aggregates"][3]["wt:size"] == 11000
+    assert manifest["aggregates"][3]["wt:mimeType"] == "text/plain"
+    with open(tmp_path / "file00002.bin", "rb") as f:
+        data = f.read()
+    for alg in ("md5", "sha1", "sha256"):
+        checksums = dict(exporter.state[alg])
+        assert checksums["workspace/file00002.bin"] == hashlib.new(alg, data).hexdigest()
+    assert manifest["aggregates"][2]["wt:md5"] == hashlib.md5(data).hexdigest()
+    assert manifest["aggregates"][2]["wt:size"] == 2500
+    assert manifest["aggregates"][2]["wt:mimeType"] == "application/octet-stream"
+
+
+@pytest.mark.plugin("wholetale")
+def test_export_workspace_data_dir(server, tmp_path):
+    from girder_wholetale.lib.exporters import benchmark
+
+    # only the data/ prefix of bagged files is not part of the uri
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "x.csv").write_text("a,b\n1,2\n")
+    manifest = benchmark.makeWorkspace(str(tmp_path), 1, 100)
+    manifest["aggregates"].append({"uri": "./workspace/data/x.csv"})
+    exporter = benchmark.BenchmarkExporter(str(tmp_path), manifest)
+    with mock.patch.object(exporter, "verify_aggregate_checksums"):
+        for _ in exporter.stream():
+            pass
+    agg = manifest["aggregates"][1]
+    assert agg["wt:size"] == 8
+    assert agg["wt:mimeType"] == "text/plain"
+    assert agg["wt:md5"] == dict(exporter.state["md5"])["workspace/data/x.csv"]
+    assert exporter.aggregate_uri("data/workspace/data/x.csv") == "./workspace/data/x.csv"
+
+
+@pytest.mark.plugin("wholetale")
+def test_export_aggregate_index(server):
+    from girder_wholetale.lib.exporters.native import NativeTaleExporter
+
+    manifest = {
+        "dct:hasVersion": {"@id": "https://data.wholetale.org/api/v1/folder/abc"},
+        "aggregates": [{"uri": "./a"}, {"uri": "./b"}, {"uri": "./a"}],
+    }
+    exporter = NativeTaleExporter(None, manifest, {})
+    assert exporter._agg_index_by_uri("./a") == 0
+    assert exporter._agg_index_by_uri("./b") == 1
+    assert exporter._agg_index_by_uri("./c") is None
+    manifest["aggregates"].append({"uri": "./c"})
+    assert exporter._agg_index_by_uri("./c") == 3
+
+
+@responses.activate
+@pytest.mark.plugin("wholetale")
+def test_export_remote_checksums(server, user, tmp_path):
+    import hashlib
+
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+
+    from girder_wholetale.lib.exporters.native import NativeTaleExporter
+
+    folder = Folder().createFolder(user, "remote", parentType="user", creator=user)
+    remote = Item().createItem("remote.csv", user, folder)
+    cached = Item().createItem("cached.csv", user, folder)
+    psPath = tmp_path / "cached.csv"
+    psPath.write_bytes(b"cached data")
+    cached["dm"] = {"cached": True, "psPath": str(psPath)}
+    Item().save(cached)
+
+    url = "https://data.example.org/remote.csv"
+    responses.get(url, body=b"remote data", headers={"ETag": '"v1"'})
+    responses.get("https://data.example.org/missing.csv", status=404)
+
+    def export():
+        manifest = {
+            "dct:hasVersion": {"@id": "https://data.wholetale.org/api/v1/folder/abc"},
+            "aggregates": [
+                {"uri": url, "wt:identifier": str(remote["_id"])},
+                {"uri": "https://unused.example.org/", "wt:identifier": str(cached["_id"])},
+                {"uri": "https://data.example.org/missing.csv"},
+                {"uri": "globus://endpoint/file.csv"},
+                {"uri": "./workspace/file.txt", "wt:md5": "abc"},
+            ],
+        }
+        NativeTaleExporter(user, manifest, {}).verify_aggregate_checksums()
+        return manifest["aggregates"]
+
+    aggs = export()
+    assert aggs[0]["wt:md5"] == hashlib.md5(b"remote data").hexdigest()
+    assert aggs[1]["wt:md5"] == hashlib.md5(b"cached data").hexdigest()
+    assert "wt:md5" not in aggs[2]
+    assert "wt:md5" not in aggs[3]
+    assert aggs[4]["wt:md5"] == "abc"
+    remote = Item().load(remote["_id"], force=True)
+    assert remote["meta"]["checksum"]["md5"] == aggs[0]["wt:md5"]
+
+    # unchanged remote files are not hashed again
+    responses.replace(
+        responses.GET, url, body=b"not hashed again", headers={"ETag": '"v1"'}
+    )
+    assert export()[0]["wt:md5"] == hashlib.md5(b"remote data").hexdigest()
+    responses.replace(responses.GET, url, body=b"remote data v2", headers={"ETag": '"v2"'})
+    assert export()[0]["wt:md5"] == hashlib.md5(b"remote data v2").hexdigest()
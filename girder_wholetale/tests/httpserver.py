@@ -1,51 +1,82 @@
 import re
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 MULTIPLIERS = {"": 1, "K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
 
 BUFLEN = 256
 
 
-class Handler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        try:
-            szMatch = re.search("[0-9]+", self.path)
-            if not szMatch:
-                raise IOError("size pattern not found")
+PATTERN = bytes(range(251))
 
-            szStr = szMatch.group()
-            unit = self.path[len(szStr) + 1 :]
-            sz = int(szStr)
 
-            if unit not in MULTIPLIERS:
-                raise IOError("no such unit %s" % unit)
-            multiplier = MULTIPLIERS[unit]
+def pattern(start, end):
+    """Bytes [start, end) of a file whose n-th byte is n % 251."""
+    length = end - start
+    offset = start % len(PATTERN)
+    return (PATTERN * (length // len(PATTERN) + 2))[offset : offset + length]
 
-            szm = sz * multiplier
 
-            print("Got request for %s x %s (%s)" % (sz, unit, szm))
-            mimetype = "application/octet-stream"
+class Handler(BaseHTTPRequestHandler):
+    def getSize(self):
+        szMatch = re.search("[0-9]+", self.path)
+        if not szMatch:
+            raise IOError("size pattern not found")
+
+        szStr = szMatch.group()
+        unit = self.path[len(szStr) + 1 :]
+        sz = int(szStr)
 
+        if unit not in MULTIPLIERS:
+            raise IOError("no such unit %s" % unit)
+        multiplier = MULTIPLIERS[unit]
+        return sz * multiplier
+
+    def do_HEAD(self):
+        try:
+            szm = self.getSize()
             self.send_response(200)
-            self.send_header("Content-type", mimetype)
+            self.send_header("Content-type", "application/octet-stream")
+            self.send_header("Content-Length", str(szm))
+            self.send_header("Accept-Ranges", "bytes")
             self.end_headers()
+        except IOError as ex:
+            self.send_error(404, "File Not Found: %s (%s)" % (self.path, ex))
+
+    def do_GET(self):
+        try:
+            szm = self.getSize()
+            start, end = 0, szm
+            rangeMatch = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
 
-            buf = b""
-            for i in range(BUFLEN):
-                buf += b"\0"
+            print("Got request for %s bytes (%s)" % (szm, self.headers.get("Range")))
+            mimetype = "application/octet-stream"
 
-            while szm > BUFLEN:
-                self.wfile.write(buf)
-                szm -= BUFLEN
+            if rangeMatch:
+                start = int(rangeMatch.group(1))
+                if rangeMatch.group(2):
+                    end = min(int(rangeMatch.group(2)) + 1, szm)
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range", "bytes %s-%s/%s" % (start, end - 1, szm)
+                )
+            else:
+                self.send_response(200)
+            self.send_header("Content-type", mimetype)
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
 
-            if szm > 0:
-                self.wfile.write(buf[:szm])
+            offset = start
+            while offset < end:
+                chunk = min(BUFLEN * 256, end - offset)
+                self.wfile.write(pattern(offset, offset + chunk))
+                offset += chunk
 
             return
 
         except IOError as ex:
-            self.send_error(404, "File Not Found: %s (%s)" % (self.path, ex.message))
+            self.send_error(404, "File Not Found: %s (%s)" % (self.path, ex))
 
 
 class Server(threading.Thread):
@@ -54,7 +85,7 @@ class Server(threading.Thread):
         self.daemon = True
 
     def start(self):
-        self.server = HTTPServer(("", 0), Handler)
+        self.server = ThreadingHTTPServer(("", 0), Handler)
         print("Started httpserver on port %s" % self.server.server_port)
         threading.Thread.start(self)
 
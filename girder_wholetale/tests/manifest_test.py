@@ -1,9 +1,11 @@
 import copy
 import json
 import os
+import time
 from operator import itemgetter
 
 import pytest
+from bson import ObjectId
 from girder.constants import AccessType
 from girder.exceptions import AccessException, ValidationException
 from girder.models.folder import Folder
@@ -296,3 +298,120 @@ def test_dataset_roundtrip(server, user, fancy_tale, mock_builder):
     assert [_["itemId"] for _ in dataset] == [
         str(_["itemId"]) for _ in fancy_tale["dataSet"]
     ]
+
+
+@pytest.mark.plugin("wholetale")
+def test_list_tree(server, tmp_path, mocker):
+    from girder_wholetale.lib import manifest
+
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "b").mkdir()
+    (tmp_path / "a" / "b" / "file2").write_text("2")
+    (tmp_path / "file1").write_text("1")
+    (tmp_path / "c").mkdir()
+    os.symlink(tmp_path / "a", tmp_path / "link")
+
+    def walk():
+        return [
+            os.path.relpath(os.path.join(curdir, fname), tmp_path)
+            for curdir, _, files in os.walk(tmp_path)
+            for fname in files
+        ]
+
+    # directories modified just now are listed every time
+    for path in (tmp_path / "a" / "b", tmp_path / "a", tmp_path / "c", tmp_path):
+        os.utime(path, (time.time() - 100, time.time() - 100))
+    assert manifest.list_tree(str(tmp_path)) == walk()
+
+    expected = walk()
+    scandir = mocker.spy(manifest.os, "scandir")
+    assert manifest.list_tree(str(tmp_path)) == expected
+    assert scandir.call_count == 0
+    # only the modified directory is listed again
+    (tmp_path / "a" / "file3").write_text("3")
+    files = manifest.list_tree(str(tmp_path))
+    assert scandir.call_count == 1
+    assert files == walk()
+    assert "a/file3" in files
+
+
+@pytest.mark.plugin("wholetale")
+def test_manifest_cache(server, user, fancy_tale, mock_builder, mocker):
+    parse = mocker.spy(Manifest, "_parse_dataSet")
+    first = Manifest(fancy_tale, user).manifest
+    calls = parse.call_count
+    second = Manifest(fancy_tale, user).manifest
+    assert first == second
+    assert mock_builder.return_value.get_tag.call_count == 1
+    assert parse.call_count == calls
+
+    # a changed build file changes the image
+    workspace = Folder().load(fancy_tale["workspaceId"], force=True)
+    with open(os.path.join(workspace["fsPath"], "apt.txt"), "w") as f:
+        f.write("vim\n")
+    third = Manifest(fancy_tale, user).manifest
+    assert mock_builder.return_value.get_tag.call_count == 2
+    assert {"uri": "./workspace/apt.txt"} in third["aggregates"]
+    assert parse.call_count == calls
+
+    # so does the dataSet
+    tale = Tale().load(fancy_tale["_id"], force=True)
+    tale["dataSet"] = tale["dataSet"][:1]
+    tale = Tale().save(tale)
+    Manifest(tale, user)
+    assert parse.call_count > calls
+    os.remove(os.path.join(workspace["fsPath"], "apt.txt"))
+
+
+@pytest.mark.plugin("wholetale", WholeTalePlugin)
+def test_manifest_cache_checksums(server, user, fancy_tale, mock_builder, mocker):
+    from girder.models.item import Item
+    from girder_wholetale.lib.exporters.native import NativeTaleExporter
+
+    def bbh_events(manifest):
+        return next(
+            agg
+            for agg in manifest["aggregates"]
+            if agg["uri"].endswith("BBH_events_v3.json")
+            and agg["bundledAs"]["folder"] == "./data/"
+        )
+
+    manifest = Manifest(fancy_tale, user).manifest
+    assert "wt:md5" not in bbh_events(manifest)
+    # an export computes the missing checksums and stores them in the items
+    exporter = NativeTaleExporter(user, manifest, {})
+    mocker.patch.object(exporter, "_aggregate_md5", return_value="0" * 32)
+    exporter.verify_aggregate_checksums()
+    itemId = bbh_events(manifest)["wt:identifier"]
+    try:
+        assert bbh_events(Manifest(fancy_tale, user).manifest)["wt:md5"] == "0" * 32
+    finally:
+        Item().update({"_id": ObjectId(itemId)}, {"$unset": {"meta.checksum": True}})
+
+
+@pytest.mark.plugin("wholetale", WholeTalePlugin)
+def test_manifest_cache_folder_contents(server, user, fancy_tale, mock_builder):
+    from girder.models.item import Item
+
+    # the contents of a folder in the dataSet change without updating it
+    folder = next(obj for obj in fancy_tale["dataSet"] if obj["_modelType"] == "folder")
+    folderIds = [folder["itemId"]]
+    item = None
+    while item is None:
+        item = Item().findOne({"folderId": {"$in": folderIds}})
+        folderIds = [f["_id"] for f in Folder().find({"parentId": {"$in": folderIds}})]
+
+    def aggregate(manifest):
+        return next(
+            agg
+            for agg in manifest["aggregates"]
+            if agg.get("wt:identifier") == str(item["_id"])
+        )
+
+    assert aggregate(Manifest(fancy_tale, user).manifest).get("wt:md5") != "0" * 32
+    checksum = item.get("meta", {}).get("checksum", {})
+    Item().update({"_id": item["_id"]}, {"$set": {"meta.checksum": {"md5": "0" * 32}}})
+    try:
+        assert aggregate(Manifest(fancy_tale, user).manifest)["wt:md5"] == "0" * 32
+    finally:
+        Item().update({"_id": item["_id"]}, {"$set": {"meta.checksum": checksum}})
@@ -44,6 +44,11 @@ setup(
         "fs",
         "gwvolman>=2.1.2",
     ],
-    entry_points={"girder.plugin": ["wholetale = girder_wholetale:WholeTalePlugin"]},
+    entry_points={
+        "girder.plugin": ["wholetale = girder_wholetale:WholeTalePlugin"],
+        "girder_worker_plugins": [
+            "wholetale_dm = girder_wholetale.lib.transfer_worker:DMTransferPlugin"
+        ],
+    },
     zip_safe=False,
 )